@@ -1,7 +1,9 @@
 import datetime
 import logging
 import typing
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
 
 from atpy.data.ts_util import overlap_by_symbol
@@ -11,9 +13,14 @@ from pyevents.events import EventFilter
 class DataReplay(object):
     """Replay data from multiple sources, sorted by time. Each source provides a dataframe."""
 
-    def __init__(self):
+    def __init__(self, array_timeline: bool = False):
+        """
+        :param array_timeline: precompute an int64 timeline and positional start/end offsets for each source once per chunk.
+                Each step is then a cursor advance with positional slices instead of label based lookups. The data of each source has to be sorted by timestamp
+        """
         self._sources_defs = list()
         self._is_running = False
+        self._array_timeline = array_timeline
 
     def __iter__(self):
         if self._is_running:
@@ -23,14 +30,19 @@ class DataReplay(object):
 
         self._data = dict()
 
+        self._columns = dict()
+
         self._timeline = None
 
         self._current_time = None
 
         sources = dict()
 
-        for (iterator, name, historical_depth, listeners) in self._sources_defs:
-            sources[name] = (iter(iterator), historical_depth, listeners)
+        for (iterator, name, historical_depth, listeners, zero_copy) in self._sources_defs:
+            if zero_copy and not self._array_timeline:
+                raise Exception("Zero copy source " + name + " requires array_timeline")
+
+            sources[name] = (iter(iterator), historical_depth, listeners, zero_copy)
 
         self._sources = sources
 
@@ -38,7 +50,7 @@ class DataReplay(object):
 
     def __next__(self):
         # delete "expired" dataframes and obtain new data from the providers
-        for e, (dp, historical_depth, listeners) in dict(self._sources).items():
+        for e, (dp, historical_depth, listeners, zero_copy) in dict(self._sources).items():
             if e not in self._data or \
                     (self._current_time is not None and self._get_datetime_level(self._data[e].index)[-1] <= self._current_time):
                 self._timeline = None
@@ -59,12 +71,22 @@ class DataReplay(object):
 
                     if listeners is not None:
                         listeners({'type': 'pre_data', e + '_full': self._data[e]})
+
+                    # after pre_data, so that the columns added by the listeners are included
+                    if zero_copy:
+                        self._columns[e] = ColumnarData(self._data[e])
                 else:
                     if e in self._data:
                         del self._data[e]
 
+                    if e in self._columns:
+                        del self._columns[e]
+
                     del self._sources[e]
 
+        if self._array_timeline:
+            return self._next_array()
+
         # build timeline
         if self._timeline is None and self._data:
             now = datetime.datetime.now()
@@ -105,7 +127,7 @@ class DataReplay(object):
 
             for e in [e for e in row.index if row[e]]:
                 df = self._data[e]
-                _, historical_depth, _ = self._sources[e]
+                _, historical_depth, _, _ = self._sources[e]
                 ind = self._get_datetime_level(df)
                 result[e] = df.loc[ind[max(0, ind.get_loc(self._current_time) - historical_depth)]:self._current_time]
 
@@ -113,6 +135,95 @@ class DataReplay(object):
         else:
             raise StopIteration()
 
+    def _next_array(self):
+        # build timeline and offsets
+        if self._timeline is None and self._data:
+            now = datetime.datetime.now()
+
+            self._build_array_timeline()
+
+            # first timeline moment after the current time
+            self._cursor = 0 if self._current_time is None else int(np.searchsorted(self._timeline_i8, self._current_time.value, side='right'))
+
+            logging.getLogger(__name__).debug('Built array timeline in ' + str(datetime.datetime.now() - now))
+        elif self._timeline is not None:
+            self._cursor += 1
+
+        # produce results
+        if self._timeline is not None:
+            result = dict()
+
+            cursor = self._cursor
+            self._current_time = self._timeline[cursor]
+
+            result['timestamp'] = self._current_time.to_pydatetime()
+
+            for e, starts, ends in self._offsets:
+                start = starts[cursor]
+                if start >= 0:
+                    result[e] = DataWindow(self._columns[e], start, ends[cursor]) if e in self._columns else self._data[e].iloc[start:ends[cursor]]
+
+            return result
+        else:
+            raise StopIteration()
+
+    def _build_array_timeline(self):
+        """
+        Build the merged int64 (ns) timeline of all sources and the positional start/end row offsets of each source for each timeline moment
+        """
+        indices = [self._get_datetime_level(df.index) for df in self._data.values()]
+        tzs = {ind.tz for ind in indices}
+
+        if len(tzs) > 1:
+            raise Exception("Multiple timezones detected")
+
+        tz = tzs.pop()
+
+        timeline = np.unique(np.concatenate([ind.asi8 for ind in indices]))
+
+        self._timeline_i8 = timeline
+        self._timeline = pd.DatetimeIndex(timeline.view('M8[ns]'))
+        if tz is not None:
+            self._timeline = self._timeline.tz_localize('UTC').tz_convert(tz)
+
+        self._offsets = list()
+
+        for e, df in self._data.items():
+            _, historical_depth, _, _ = self._sources[e]
+
+            levels = self._get_datetime_level(df.index).asi8
+            rows = self._get_datetime_values(df.index).asi8
+
+            if rows.size > 1 and (rows[1:] < rows[:-1]).any():
+                raise Exception("Data for " + str(e) + " is not sorted by timestamp")
+
+            # row range of each unique timestamp
+            level_starts = np.searchsorted(rows, levels, side='left')
+            level_ends = np.searchsorted(rows, levels, side='right')
+
+            # position of each timeline moment within the unique timestamps of the source
+            pos = np.searchsorted(levels, timeline)
+            present = pos < levels.size
+            present[present] = levels[pos[present]] == timeline[present]
+
+            starts = np.full(timeline.size, -1, dtype=np.int64)
+            ends = np.full(timeline.size, -1, dtype=np.int64)
+
+            starts[present] = level_starts[np.maximum(pos[present] - historical_depth, 0)]
+            ends[present] = level_ends[pos[present]]
+
+            self._offsets.append((e, starts, ends))
+
+    @staticmethod
+    def _get_datetime_values(index):
+        """
+        :return: datetime values for each row of the index (as opposed to _get_datetime_level, which returns the unique values)
+        """
+        if isinstance(index, pd.DatetimeIndex):
+            return index
+        elif isinstance(index, pd.MultiIndex):
+            return index.get_level_values([i for i, l in enumerate(index.levels) if isinstance(l, pd.DatetimeIndex)][0])
+
     @staticmethod
     def _get_datetime_level(index):
         if isinstance(index, pd.DataFrame) or isinstance(index, pd.Series):
@@ -123,7 +234,7 @@ class DataReplay(object):
         elif isinstance(index, pd.MultiIndex):
             return [l for l in index.levels if isinstance(l, pd.DatetimeIndex)][0]
 
-    def add_source(self, data_provider: typing.Union[typing.Iterator, typing.Callable], name: str, historical_depth: int = 0, listeners: typing.Callable = None):
+    def add_source(self, data_provider: typing.Union[typing.Iterator, typing.Callable], name: str, historical_depth: int = 0, listeners: typing.Callable = None, zero_copy: bool = False):
         """
         Add source for data generation
         :param data_provider: return pd.DataFrame with either DateTimeIndex or MultiIndex, where one of the levels is of datetime type
@@ -132,16 +243,78 @@ class DataReplay(object):
         :param listeners: Fire event after each data provider request.
                 This is necessary, because the data replay functionality is combining the new/old dataframes for continuity.
                 Process data, once obtained from the data provider (applied once for the whole chunk).
+        :param zero_copy: convert each chunk once to contiguous read-only column arrays and return DataWindow views of them instead of dataframe slices.
+                Requires array_timeline
         :return: self
         """
         if self._is_running:
             raise Exception("Cannot add sources while the generator is working")
 
-        self._sources_defs.append((data_provider, name, historical_depth, listeners))
+        self._sources_defs.append((data_provider, name, historical_depth, listeners, zero_copy))
 
         return self
 
 
+class ColumnarData(object):
+    """Contiguous read-only column arrays of a dataframe chunk, which is sorted by timestamp"""
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+        self.columns = OrderedDict()
+        for c in df.columns:
+            self.columns[c] = self._read_only(np.ascontiguousarray(df[c].values))
+
+        self.timestamps = self._read_only(np.ascontiguousarray(DataReplay._get_datetime_values(df.index).values))
+
+    @staticmethod
+    def _read_only(array: np.ndarray):
+        array.flags.writeable = False
+        return array
+
+
+class DataWindow(object):
+    """
+    Lightweight window over the rows [start:end) of ColumnarData.
+    Columns are returned as read-only numpy views and no data is copied, unless a dataframe is requested via to_frame
+    """
+
+    def __init__(self, data: ColumnarData, start: int, end: int):
+        self._data = data
+        self.start = start
+        self.end = end
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self._data.columns[column][self.start:self.end]
+
+    def __contains__(self, column: str):
+        return column in self._data.columns
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def columns(self):
+        return list(self._data.columns.keys())
+
+    @property
+    def empty(self):
+        return self.end <= self.start
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        """datetime64 values for each row of the window"""
+        return self._data.timestamps[self.start:self.end]
+
+    @property
+    def index(self):
+        return self._data.df.index[self.start:self.end]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Dataframe with the window rows, equal to the non zero copy result"""
+        return self._data.df.iloc[self.start:self.end]
+
+
 class DataReplayEvents(object):
     """Add source for data generation"""
 
@@ -11,7 +11,8 @@ import atpy.data.iqfeed.util as iqutil
 from atpy.backtesting.data_replay import DataReplayEvents, DataReplay
 from atpy.backtesting.mock_exchange import MockExchange, StaticSlippageLoss, PerShareCommissionLoss
 from atpy.backtesting.random_strategy import RandomStrategy
-from atpy.data.cache.lmdb_cache import read_pickle
+from atpy.backtesting.recorder import Recorder
+from atpy.data.cache.lmdb_cache import shared_cache
 from atpy.data.cache.postgres_cache import BarsInPeriodProvider
 from atpy.data.quandl.postgres_cache import SFInPeriodProvider
 from atpy.data.ts_util import current_period, current_phase, gaps, rolling_mean, AsyncInPeriodProvider
@@ -22,7 +23,7 @@ def data_replay_events(listeners):
     return DataReplayEvents(listeners, DataReplay(), event_name='data')
 
 
-def add_postgres_ohlc_1m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=300, run_async=False, url: str = None, lmdb_path: str = None):
+def add_postgres_ohlc_1m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=300, run_async=False, url: str = None, lmdb_path: str = None, async_workers: int = 1):
     """
     Create DataReplay environment for bar data using PostgreSQL
     :param dre: DataReplayEvents
@@ -31,24 +32,26 @@ def add_postgres_ohlc_1m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param run_async: generate data asynchronously
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
+    :param async_workers: number of parallel requests (with a separate connection each) if run_async
     :return: filter function, that only accepts this event
     """
 
-    con = psycopg2.connect(url if url is not None else os.environ['POSTGRESQL_CACHE'])
+    url = url if url is not None else os.environ['POSTGRESQL_CACHE']
+    con = functools.partial(psycopg2.connect, url) if run_async and async_workers > 1 else psycopg2.connect(url)
 
     lmdb_path = os.environ['ATPY_LMDB_PATH'] if lmdb_path is None and 'ATPY_LMDB_PATH' in os.environ else lmdb_path
-    cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
+    cache = shared_cache(lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=60, interval_type='s', bars_table='bars_1m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
     if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
+        bars_in_period = AsyncInPeriodProvider(bars_in_period, num_workers=async_workers)
 
     dre.data_replay.add_source(bars_in_period, 'bars_1m', historical_depth=historical_depth, listeners=dre.listeners)
 
     return dre.event_filter_by_source('bars_1m'), dre.event_filter_function('bars_1m')
 
 
-def add_postgres_ohlc_5m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=300, run_async=False, url: str = None, lmdb_path: str = None):
+def add_postgres_ohlc_5m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=300, run_async=False, url: str = None, lmdb_path: str = None, async_workers: int = 1):
     """
     Create DataReplay environment for bar data using PostgreSQL
     :param dre: DataReplayEvents
@@ -57,24 +60,26 @@ def add_postgres_ohlc_5m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param run_async: generate data asynchronously
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
+    :param async_workers: number of parallel requests (with a separate connection each) if run_async
     :return: filter function, that only accepts this event
     """
 
-    con = psycopg2.connect(url if url is not None else os.environ['POSTGRESQL_CACHE'])
+    url = url if url is not None else os.environ['POSTGRESQL_CACHE']
+    con = functools.partial(psycopg2.connect, url) if run_async and async_workers > 1 else psycopg2.connect(url)
 
     lmdb_path = os.environ['ATPY_LMDB_PATH'] if lmdb_path is None and 'ATPY_LMDB_PATH' in os.environ else lmdb_path
-    cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
+    cache = shared_cache(lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=300, interval_type='s', bars_table='bars_5m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
     if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
+        bars_in_period = AsyncInPeriodProvider(bars_in_period, num_workers=async_workers)
 
     dre.data_replay.add_source(bars_in_period, 'bars_5m', historical_depth=historical_depth, listeners=dre.listeners)
 
     return dre.event_filter_by_source('bars_5m'), dre.event_filter_function('bars_5m')
 
 
-def add_postgres_ohlc_60m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=24, run_async=False, url: str = None, lmdb_path: str = None):
+def add_postgres_ohlc_60m(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=24, run_async=False, url: str = None, lmdb_path: str = None, async_workers: int = 1):
     """
     Create DataReplay environment for bar data using PostgreSQL
     :param dre: DataReplayEvents
@@ -83,24 +88,26 @@ def add_postgres_ohlc_60m(dre: DataReplayEvents, bgn_prd: datetime.datetime, his
     :param run_async: generate data asynchronously
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
+    :param async_workers: number of parallel requests (with a separate connection each) if run_async
     :return: filter function, that only accepts this event
     """
 
-    con = psycopg2.connect(url if url is not None else os.environ['POSTGRESQL_CACHE'])
+    url = url if url is not None else os.environ['POSTGRESQL_CACHE']
+    con = functools.partial(psycopg2.connect, url) if run_async and async_workers > 1 else psycopg2.connect(url)
 
     lmdb_path = os.environ['ATPY_LMDB_PATH'] if lmdb_path is None and 'ATPY_LMDB_PATH' in os.environ else lmdb_path
-    cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
+    cache = shared_cache(lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=3300, interval_type='s', bars_table='bars_60m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
     if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
+        bars_in_period = AsyncInPeriodProvider(bars_in_period, num_workers=async_workers)
 
     dre.data_replay.add_source(bars_in_period, 'bars_60m', historical_depth=historical_depth, listeners=dre.listeners)
 
     return dre.event_filter_by_source('bars_60m'), dre.event_filter_function('bars_60m')
 
 
-def add_postgres_ohlc_1d(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=50, run_async=False, url: str = None, lmdb_path: str = None):
+def add_postgres_ohlc_1d(dre: DataReplayEvents, bgn_prd: datetime.datetime, historical_depth=50, run_async=False, url: str = None, lmdb_path: str = None, async_workers: int = 1):
     """
     Create DataReplay environment for bar data using PostgreSQL
     :param dre: DataReplayEvents
@@ -109,17 +116,19 @@ def add_postgres_ohlc_1d(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param run_async: generate data asynchronously
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
+    :param async_workers: number of parallel requests (with a separate connection each) if run_async
     :return: filter function, that only accepts this event
     """
 
-    con = psycopg2.connect(url if url is not None else os.environ['POSTGRESQL_CACHE'])
+    url = url if url is not None else os.environ['POSTGRESQL_CACHE']
+    con = functools.partial(psycopg2.connect, url) if run_async and async_workers > 1 else psycopg2.connect(url)
 
     lmdb_path = os.environ['ATPY_LMDB_PATH'] if lmdb_path is None and 'ATPY_LMDB_PATH' in os.environ else lmdb_path
-    cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
+    cache = shared_cache(lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=1, interval_type='d', bars_table='bars_1d', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
     if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
+        bars_in_period = AsyncInPeriodProvider(bars_in_period, num_workers=async_workers)
 
     dre.data_replay.add_source(bars_in_period, 'bars_1d', historical_depth=historical_depth, listeners=dre.listeners)
 
@@ -288,7 +297,7 @@ def add_mock_exchange(listeners, order_requests_stream, bar_event_stream, slippa
                         commission_loss=PerShareCommissionLoss(commission_per_share) if commission_per_share is not None else None)
 
 
-def add_portfolio_manager(listeners, fulfilled_orders_stream, bar_event_stream, initial_capital: float, existing_orders=None):
+def add_portfolio_manager(listeners, fulfilled_orders_stream, bar_event_stream, initial_capital: float, existing_orders=None, coalesce_value_updates: bool = False):
     """
     Append portfolio manager
     :param listeners: listeners environment
@@ -296,13 +305,15 @@ def add_portfolio_manager(listeners, fulfilled_orders_stream, bar_event_stream,
     :param bar_event_stream: event stream for bar data
     :param initial_capital: starting capital
     :param existing_orders: broker tax per share
+    :param coalesce_value_updates: emit a single portfolio value update per bar (see PortfolioManager)
     """
 
     return PortfolioManager(listeners=listeners,
                             initial_capital=initial_capital,
                             fulfilled_orders_event_stream=fulfilled_orders_stream,
                             bar_event_stream=bar_event_stream,
-                            orders=existing_orders)
+                            orders=existing_orders,
+                            coalesce_value_updates=coalesce_value_updates)
 
 
 def add_random_strategy(listeners, portfolio_manager: PortfolioManager, bar_event_stream, max_buys_per_step=1, max_sells_per_step=1):
@@ -320,3 +331,15 @@ def add_random_strategy(listeners, portfolio_manager: PortfolioManager, bar_even
                           bar_event_stream=bar_event_stream,
                           max_buys_per_step=max_buys_per_step,
                           max_sells_per_step=max_sells_per_step)
+
+
+def add_recorder(listeners, path: str = None, fmt: str = 'npy', chunk_size: int = 100000):
+    """
+    Append recorder of the equity curve and the fills. Should be added before the other components
+    :param listeners: listeners environment
+    :param path: directory for the recorded chunks (in memory if None)
+    :param fmt: 'npy' or 'parquet'
+    :param chunk_size: maximum number of rows kept in memory
+    """
+
+    return Recorder(listeners=listeners, path=path, fmt=fmt, chunk_size=chunk_size)
@@ -2,10 +2,11 @@ import logging
 import threading
 import typing
 
-import pandas as pd
+import numpy as np
 
 import atpy.portfolio.order as orders
-from atpy.data.iqfeed.util import get_last_value
+from atpy.data.iqfeed.util import last_value
+from atpy.data.ts_util import last_rows
 from pyevents.events import EventFilter
 
 
@@ -20,11 +21,13 @@ class MockExchange(object):
                  bar_event_stream=None,
                  tick_event_stream=None,
                  order_processor: typing.Callable = None,
-                 commission_loss: typing.Callable = None):
+                 commission_loss: typing.Callable = None,
+                 tick_batch_event_stream=None):
         """
         :param order_requests_event_stream: event stream for order events
         :param bar_event_stream: event stream for bar data events
         :param tick_event_stream: event stream for tick data events
+        :param tick_batch_event_stream: event stream for batches of tick data (dataframe with one row per tick, see IQFeedLevel1Listener update_batch_interval)
         :param order_processor: a function which takes the current bar/tick volume and price and the current order.
                                 It applies some logic to return allowed volume and price for the order, given the current conditions.
                                 This function might apply slippage and so on
@@ -39,44 +42,54 @@ class MockExchange(object):
         if tick_event_stream is not None:
             tick_event_stream += self.process_tick_data
 
+        if tick_batch_event_stream is not None:
+            tick_batch_event_stream += self.process_tick_batch
+
         self.listeners = listeners
 
-        self.order_processor = order_processor if order_processor is not None else lambda order, price, volume: (price, volume)
+        self.order_processor = order_processor if order_processor is not None else _IdentityOrderProcessor()
         self.commission_loss = commission_loss if commission_loss is not None else lambda o: 0
 
         self._pending_orders = list()
+        self._pending_arrays = None
         self._lock = threading.RLock()
 
     def process_order_request(self, order):
         with self._lock:
             self._pending_orders.append(order)
+            self._pending_arrays = None
 
     def process_tick_data(self, data):
         with self._lock:
             matching_orders = [o for o in self._pending_orders if o.symbol == data['symbol']]
+            if matching_orders:
+                self._pending_arrays = None
+
             for o in matching_orders:
-                data = get_last_value(data)
+                # the data is either a dict of values or a market snapshot (dict of time series). Only the used fields are read
                 if o.order_type == orders.Type.BUY:
                     if 'tick_id' in data:
-                        price, volume = self.order_processor(o, data['ask'], data['last_size'])
+                        price, volume = self.order_processor(o, last_value(data, 'ask'), last_value(data, 'last_size'))
 
                         o.add_position(volume, price)
                     else:
+                        ask_size = last_value(data, 'ask_size')
                         price, volume = self.order_processor(order=o,
-                                                             price=data['ask'] if data['ask_size'] > 0 else data['most_recent_trade'],
-                                                             volume=data['ask_size'] if data['ask_size'] > 0 else data['most_recent_trade_size'])
+                                                             price=last_value(data, 'ask') if ask_size > 0 else last_value(data, 'most_recent_trade'),
+                                                             volume=ask_size if ask_size > 0 else last_value(data, 'most_recent_trade_size'))
 
                         o.add_position(volume, price)
 
                     o.commission = self.commission_loss(o)
                 elif o.order_type == orders.Type.SELL:
                     if 'tick_id' in data:
-                        price, volume = self.order_processor(o, data['bid'], data['last_size'])
+                        price, volume = self.order_processor(o, last_value(data, 'bid'), last_value(data, 'last_size'))
                         o.add_position(price, volume)
                     else:
+                        bid_size = last_value(data, 'bid_size')
                         price, volume = self.order_processor(order=o,
-                                                             price=data['bid'] if data['bid_size'] > 0 else data['most_recent_trade'],
-                                                             volume=data['bid_size'] if data['bid_size'] > 0 else data['most_recent_trade_size'])
+                                                             price=last_value(data, 'bid') if bid_size > 0 else last_value(data, 'most_recent_trade'),
+                                                             volume=bid_size if bid_size > 0 else last_value(data, 'most_recent_trade_size'))
 
                         o.add_position(price, volume)
 
@@ -88,28 +101,80 @@ class MockExchange(object):
 
                     self.listeners({'type': 'order_fulfilled', 'data': o})
 
+    def process_tick_batch(self, data):
+        """
+        Process a batch of ticks. Only the ticks of the symbols with pending orders are processed (in order)
+        :param data: dataframe with one row per tick
+        """
+        with self._lock:
+            if not self._pending_orders:
+                return
+
+            ticks = data.loc[data['symbol'].isin({o.symbol for o in self._pending_orders})]
+
+            for tick in ticks.to_dict('records'):
+                self.process_tick_data(tick)
+
+                if not self._pending_orders:
+                    break
+
     def process_bar_data(self, data):
         with self._lock:
-            symbols = data.index.get_level_values(level='symbol')
+            if not self._pending_orders:
+                return
 
-            symbol_ind = data.index.names.index('symbol')
+            pending = self._order_arrays()
 
-            for o in [o for o in self._pending_orders if o.symbol in symbols]:
-                ix = pd.IndexSlice[:, o.symbol] if symbol_ind == 1 else pd.IndexSlice[o.symbol, :]
-                slc = data.loc[ix, :]
+            rows = last_rows(data, pending.symbols)
+            matched = np.flatnonzero(rows >= 0)
+            if len(matched) == 0:
+                return
 
-                if not slc.empty:
-                    price, volume = self.order_processor(o, slc.iloc[-1]['close'], slc.iloc[-1]['volume'])
+            rows = rows[matched]
+            prices, volumes = self._process_orders(pending, matched, data['close'].values[rows].astype(np.float64), data['volume'].values[rows])
 
-                    o.add_position(min(o.quantity - o.obtained_quantity, volume), price)
+            active, triggered = _active_orders(pending, matched, prices)
 
-                    o.commission = self.commission_loss(o)
+            fulfilled = list()
+            for j in np.flatnonzero(active):
+                i = matched[j]
+                o = pending.orders[i]
+
+                o.add_position(min(o.quantity - o.obtained_quantity, volumes[j]), prices[j])
+                o.commission = self.commission_loss(o)
+
+                pending.triggered[i] = triggered[j]
+
+                if o.fulfill_time is not None:
+                    fulfilled.append(o)
+
+            if fulfilled:
+                fulfilled_ids = set(id(o) for o in fulfilled)
+                self._pending_orders = [o for o in self._pending_orders if id(o) not in fulfilled_ids]
+                self._pending_arrays = None
+
+                for o in fulfilled:
+                    logging.getLogger(__name__).info("Order fulfilled: " + str(o))
+
+                    self.listeners({'type': 'order_fulfilled', 'data': o})
+
+    def _order_arrays(self):
+        if self._pending_arrays is None:
+            self._pending_arrays = _OrderArrays(self._pending_orders)
+
+        return self._pending_arrays
+
+    def _process_orders(self, pending, matched: np.array, prices: np.array, volumes: np.array):
+        """
+        Apply the order processor to all matched orders
+        :return: arrays of (price, volume) for each matched order
+        """
+        if hasattr(self.order_processor, 'process_many'):
+            return self.order_processor.process_many(pending.buy[matched], prices, volumes)
 
-                    if o.fulfill_time is not None:
-                        self._pending_orders.remove(o)
-                        logging.getLogger(__name__).info("Order fulfilled: " + str(o))
+        result = [self.order_processor(pending.orders[i], p, v) for i, p, v in zip(matched, prices, volumes)]
 
-                        self.listeners({'type': 'order_fulfilled', 'data': o})
+        return np.array([r[0] for r in result], dtype=np.float64), np.array([r[1] for r in result])
 
     def fulfilled_orders_stream(self):
         return EventFilter(listeners=self.listeners,
@@ -117,6 +182,65 @@ class MockExchange(object):
                            event_transformer=lambda e: (e['data'],))
 
 
+_OTHER, _LIMIT, _STOP_MARKET, _STOP_LIMIT = 0, 1, 2, 3
+
+
+class _OrderArrays(object):
+    """Array representation of the pending orders"""
+
+    def __init__(self, pending_orders: list):
+        self.orders = list(pending_orders)
+        self.symbols = [o.symbol for o in self.orders]
+        self.buy = np.array([o.order_type == orders.Type.BUY for o in self.orders], dtype=np.bool_)
+        self.sell = np.array([o.order_type == orders.Type.SELL for o in self.orders], dtype=np.bool_)
+
+        self.kind = np.full(len(self.orders), _OTHER, dtype=np.int8)
+        self.price = np.full(len(self.orders), np.nan)
+        self.limit_price = np.full(len(self.orders), np.nan)
+        self.triggered = np.zeros(len(self.orders), dtype=np.bool_)
+
+        for i, o in enumerate(self.orders):
+            if isinstance(o, orders.LimitOrder):
+                self.kind[i], self.price[i] = _LIMIT, o.price
+            elif isinstance(o, orders.StopMarketOrder):
+                self.kind[i], self.price[i], self.triggered[i] = _STOP_MARKET, o.price, o.triggered
+            elif isinstance(o, orders.StopLimitOrder):
+                self.kind[i], self.price[i], self.limit_price[i], self.triggered[i] = _STOP_LIMIT, o.stop_price, o.limit_price, o.triggered
+
+
+def _active_orders(pending: _OrderArrays, matched: np.array, prices: np.array):
+    """
+    Evaluate the trigger conditions of the orders (see atpy.portfolio.order) for the current prices
+    :return: (mask of the orders, whose add_position might have an effect, updated triggered state of the stop orders)
+    """
+    buy, sell, kind = pending.buy[matched], pending.sell[matched], pending.kind[matched]
+    price, limit_price, was_triggered = pending.price[matched], pending.limit_price[matched], pending.triggered[matched]
+
+    # the limit and the stop conditions are the same, but with different meaning
+    price_condition = (buy & (price >= prices)) | (sell & (price <= prices))
+    triggered = was_triggered | ((kind == _STOP_MARKET) | (kind == _STOP_LIMIT)) & price_condition
+
+    stop_limit_fill = (triggered & buy & (limit_price < prices)) | (sell & (limit_price > prices))
+
+    # stop limit orders, which are triggered now, have to update their state even if they are not filled
+    active = (kind == _OTHER) \
+             | ((kind == _LIMIT) & price_condition) \
+             | ((kind == _STOP_MARKET) & triggered) \
+             | ((kind == _STOP_LIMIT) & (stop_limit_fill | (triggered != was_triggered)))
+
+    return active, triggered
+
+
+class _IdentityOrderProcessor:
+    """Default order processor, which returns the price and the volume as they are"""
+
+    def __call__(self, order: orders.BaseOrder, price: float, volume: int):
+        return price, volume
+
+    def process_many(self, buy: np.array, prices: np.array, volumes: np.array):
+        return prices, volumes
+
+
 class StaticSlippageLoss:
     """Apply static loss value to account for slippage per each order"""
 
@@ -134,6 +258,16 @@ class StaticSlippageLoss:
         elif order.order_type == orders.Type.SELL:
             return price - self.loss_rate * price, int(volume * self.max_order_volume)
 
+    def process_many(self, buy: np.array, prices: np.array, volumes: np.array):
+        """
+        Vectorized version of __call__
+        :param buy: boolean mask of the buy orders (the rest are sell orders)
+        :param prices: prices for each order
+        :param volumes: volumes for each order
+        :return: (prices, volumes)
+        """
+        return np.where(buy, prices + self.loss_rate * prices, prices - self.loss_rate * prices), (volumes * self.max_order_volume).astype(np.int64)
+
 
 class PerShareCommissionLoss:
     """Apply commission loss for each share"""
@@ -0,0 +1,337 @@
+import datetime
+import logging
+import multiprocessing
+import pickle
+import queue
+import sys
+import threading
+import traceback
+import typing
+
+import pandas as pd
+
+from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
+from atpy.portfolio.portfolio_manager import PortfolioManager
+from pyevents.events import SyncListeners
+
+
+def portfolio_summary(portfolio_manager: PortfolioManager) -> dict:
+    """
+    Default result of a single sweep run
+    :param portfolio_manager: portfolio manager of the run
+    :return: dict with capital, value of the holdings, total value and number of orders
+    """
+    value = sum(portfolio_manager.value(multiply_by_quantity=True).values())
+
+    return {'capital': portfolio_manager.capital,
+            'value': value,
+            'total': portfolio_manager.capital + value,
+            'orders': len(portfolio_manager.orders)}
+
+
+class ParameterSweep(object):
+    """
+    Run multiple backtest configurations over a single data replay. Each data chunk is loaded once and fanned out to all configurations.
+    Each run has its own listeners and strategy/mock exchange/portfolio manager stack. The data is shared between the runs and should be treated as read-only.
+    """
+
+    def __init__(self, build_run: typing.Callable, configurations: typing.List[dict], event_name: str = 'data', num_processes: int = 0, result: typing.Callable = None, array_timeline: bool = False, max_queued_chunks: int = 2,
+                 poll_interval: float = 1):
+        """
+        :param build_run: function (DataReplayEvents, configuration) -> PortfolioManager, which wires a single run to the listeners of the DataReplayEvents.
+                Sources must be added to the sweep and not to the data replay of the DataReplayEvents. With num_processes > 0 the function has to be picklable
+        :param configurations: list of configurations (dicts of parameters), one for each run
+        :param event_name: name of the data replay event
+        :param num_processes: 0 - run all configurations in this process. Otherwise split the configurations between num_processes processes.
+                The chunks are published once to shared memory and each process copies them out. Requires Python 3.8+
+        :param result: function (PortfolioManager) -> dict with the result of a run (portfolio_summary by default). With num_processes > 0 the function has to be picklable
+        :param array_timeline: use array timeline for the data replay
+        :param max_queued_chunks: maximum number of chunks per source, which are loaded but not yet consumed by each process
+        :param poll_interval: interval in seconds, in which the processes are checked for unexpected exit (for example killed for running out of memory) while waiting for the results
+        """
+        self.build_run = build_run
+        self.configurations = configurations
+        self.event_name = event_name
+        self.num_processes = num_processes
+        self.result = result if result is not None else portfolio_summary
+        self.array_timeline = array_timeline
+        self.max_queued_chunks = max_queued_chunks
+        self.poll_interval = poll_interval
+
+        self._sources_defs = list()
+        self._lock = threading.Lock()
+
+        self.wall_time = None
+        self.chunk_load_time = None
+        self.chunks = 0
+
+    def add_source(self, data_provider: typing.Iterable, name: str, historical_depth: int = 0):
+        """
+        Add source for data generation (see DataReplay.add_source)
+        :param data_provider: iterable of dataframes
+        :param name: data set name
+        :param historical_depth: historical depth of the source
+        :return: self
+        """
+        self._sources_defs.append((data_provider, name, historical_depth))
+
+        return self
+
+    def run(self) -> pd.DataFrame:
+        """
+        Run all configurations
+        :return: DataFrame with one row for each configuration, consisting of the configuration parameters and the result of the run
+        """
+        self.chunk_load_time = datetime.timedelta()
+        self.chunks = 0
+
+        now = datetime.datetime.now()
+
+        if self.num_processes > 0:
+            results = self._run_processes()
+        else:
+            dr = DataReplay(array_timeline=self.array_timeline)
+            for data_provider, name, historical_depth in self._sources_defs:
+                dr.add_source(self._timed(data_provider), name, historical_depth=historical_depth)
+
+            results = _run_configurations(dr, self.build_run, self.configurations, self.event_name, self.result)
+
+        self.wall_time = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).info("Sweep of " + str(len(self.configurations)) + " configurations done in " + str(self.wall_time) + "; " + str(self.chunks) + " chunks loaded in " + str(self.chunk_load_time))
+
+        return pd.DataFrame([dict(c, **r) for c, r in zip(self.configurations, results)])
+
+    def _timed(self, data_provider: typing.Iterable):
+        it = iter(data_provider)
+
+        while True:
+            now = datetime.datetime.now()
+
+            try:
+                df = next(it)
+            except StopIteration:
+                return
+            finally:
+                with self._lock:
+                    self.chunk_load_time += datetime.datetime.now() - now
+
+            with self._lock:
+                self.chunks += 1
+
+            yield df
+
+    def _run_processes(self):
+        # shared memory and out-of-band pickle buffers are only available in the process mode, the in-process mode works with older versions
+        if sys.version_info < (3, 8):
+            raise Exception("ParameterSweep with num_processes > 0 requires Python 3.8 or later (multiprocessing.shared_memory and pickle protocol 5)")
+
+        from multiprocessing import resource_tracker
+
+        ctx = multiprocessing.get_context()
+
+        num_processes = min(self.num_processes, len(self.configurations))
+        configurations = [list(range(len(self.configurations)))[i::num_processes] for i in range(num_processes)]
+
+        sources = [(name, historical_depth) for _, name, historical_depth in self._sources_defs]
+        chunk_queues = [{name: ctx.Queue(maxsize=self.max_queued_chunks) for name, _ in sources} for _ in range(num_processes)]
+        ack_queue, results_queue = ctx.Queue(), ctx.Queue()
+
+        processes = [ctx.Process(target=_sweep_worker,
+                                 args=(i, self.build_run, [self.configurations[c] for c in configurations[i]], sources, self.event_name, self.result, self.array_timeline, chunk_queues[i], ack_queue, results_queue),
+                                 daemon=True)
+                     for i in range(num_processes)]
+
+        # the worker processes share the resource tracker of this process. Otherwise each worker starts its own tracker, which reports the attached segments
+        # as leaked and tries to unlink them at exit
+        resource_tracker.ensure_running()
+
+        for p in processes:
+            p.start()
+
+        published = dict()
+        published_lock = threading.Lock()
+        stopped = threading.Event()
+
+        def put(q, item):
+            # the queue of a dead process is never consumed
+            while not stopped.is_set():
+                try:
+                    q.put(item, timeout=self.poll_interval)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def produce(data_provider, name):
+            for df in self._timed(data_provider):
+                shm, chunk = _publish_chunk(df)
+
+                with published_lock:
+                    if stopped.is_set():
+                        shm.close()
+                        shm.unlink()
+                        return
+
+                    published[shm.name] = [shm, num_processes]
+
+                for q in chunk_queues:
+                    if not put(q[name], chunk):
+                        return
+
+            for q in chunk_queues:
+                if not put(q[name], None):
+                    return
+
+        def release():
+            for shm_name in iter(ack_queue.get, None):
+                with published_lock:
+                    published[shm_name][1] -= 1
+                    if published[shm_name][1] == 0:
+                        shm, _ = published.pop(shm_name)
+                        shm.close()
+                        shm.unlink()
+
+        producers = [threading.Thread(target=produce, args=(data_provider, name), daemon=True) for data_provider, name, _ in self._sources_defs]
+        releaser = threading.Thread(target=release, daemon=True)
+
+        for t in producers + [releaser]:
+            t.start()
+
+        results = [None] * len(self.configurations)
+        try:
+            outstanding, exited = set(range(num_processes)), set()
+            while outstanding:
+                try:
+                    i, worker_results, error = results_queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    # the result of a process is flushed to the queue before the process exits. A process, which was already gone at the previous poll, has died without a result
+                    dead = [j for j in sorted(outstanding) if processes[j].exitcode not in (None, 0) or j in exited]
+                    if dead:
+                        raise Exception("Sweep process " + str(dead[0]) + " exited unexpectedly with exit code " + str(processes[dead[0]].exitcode) + " while running configurations "
+                                        + str([self.configurations[c] for c in configurations[dead[0]]]))
+
+                    exited.update(j for j in outstanding if processes[j].exitcode is not None)
+                    continue
+
+                outstanding.remove(i)
+
+                if error is not None:
+                    raise Exception("Sweep process " + str(i) + " failed:\n" + error)
+
+                for c, r in zip(configurations[i], worker_results):
+                    results[c] = r
+        except Exception:
+            for p in processes:
+                p.terminate()
+
+            # the chunks, which are not consumed anymore, are discarded. Otherwise the exit of this process waits for them to be flushed to the terminated processes
+            for q in [q for qs in chunk_queues for q in qs.values()]:
+                q.cancel_join_thread()
+
+            raise
+        finally:
+            stopped.set()
+
+            for p in processes:
+                p.join()
+
+            ack_queue.put(None)
+            releaser.join()
+
+            with published_lock:
+                for shm, _ in published.values():
+                    shm.close()
+                    shm.unlink()
+
+                published.clear()
+
+        return results
+
+
+def _run_configurations(data_replay: DataReplay, build_run: typing.Callable, configurations: typing.List[dict], event_name: str, result: typing.Callable):
+    runs = list()
+    for c in configurations:
+        dre = DataReplayEvents(listeners=SyncListeners(), data_replay=data_replay, event_name=event_name)
+        runs.append((dre.listeners, build_run(dre, c)))
+
+    for d in data_replay:
+        for listeners, _ in runs:
+            e = dict(d)
+            e['type'] = event_name
+            listeners(e)
+
+    return [result(pm) for _, pm in runs]
+
+
+def _publish_chunk(df: pd.DataFrame):
+    """
+    Serialize dataframe with out-of-band buffers and copy the buffers to a single shared memory block
+    :return: (SharedMemory, (shared memory name, pickle header, [(offset, size), ...]))
+    """
+    from multiprocessing import shared_memory
+
+    buffers = list()
+    header = pickle.dumps(df, protocol=5, buffer_callback=buffers.append)
+    buffers = [b.raw() for b in buffers]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(b.nbytes for b in buffers), 1))
+
+    layout, offset = list(), 0
+    for b in buffers:
+        shm.buf[offset:offset + b.nbytes] = b
+        layout.append((offset, b.nbytes))
+        offset += b.nbytes
+
+    return shm, (shm.name, header, layout)
+
+
+def _shared_memory_chunks(q, ack_queue):
+    """
+    Load the published chunks in this process without copying. The dataframes are read-only views of the shared memory. Each chunk is acknowledged as soon as
+    it is attached: the parent can unlink the segment, because the mapping of this process remains valid until it is closed
+    """
+    from multiprocessing import shared_memory
+
+    for shm_name, header, layout in iter(q.get, None):
+        try:
+            # attaching registers the segment with the resource tracker of the parent process (bpo-38119), where it is already registered
+            shm = shared_memory.SharedMemory(name=shm_name)
+            _attached_segments.append(shm)
+
+            df = pickle.loads(header, buffers=[shm.buf[offset:offset + size].toreadonly() for offset, size in layout])
+        finally:
+            ack_queue.put(shm_name)
+
+        # the segments of the previous chunks are closed as soon as their data is not referenced anymore
+        _attached_segments[:] = [s for s in _attached_segments[:-1] if not _close_segment(s)] + _attached_segments[-1:]
+
+        yield df
+
+
+# segments attached by this process, which are still in use. They are kept until their views are released, because SharedMemory can't be closed before that
+_attached_segments = list()
+
+
+def _close_segment(shm) -> bool:
+    """
+    :param shm: multiprocessing.shared_memory.SharedMemory
+    :return: True if the segment was closed, False if its data is still in use
+    """
+    try:
+        shm.close()
+        return True
+    except BufferError:
+        return False
+
+
+def _sweep_worker(i: int, build_run: typing.Callable, configurations: typing.List[dict], sources: list, event_name: str, result: typing.Callable, array_timeline: bool, chunk_queues: dict, ack_queue, results_queue):
+    try:
+        dr = DataReplay(array_timeline=array_timeline)
+        for name, historical_depth in sources:
+            dr.add_source(_shared_memory_chunks(chunk_queues[name], ack_queue), name, historical_depth=historical_depth)
+
+        results_queue.put((i, _run_configurations(dr, build_run, configurations, event_name, result), None))
+    except Exception:
+        results_queue.put((i, None, traceback.format_exc()))
@@ -0,0 +1,226 @@
+import datetime
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from atpy.portfolio.order import BaseOrder, Type
+
+
+class ColumnBuffer(object):
+    """
+    Preallocated numpy column buffers, which grow by doubling the capacity
+    """
+
+    def __init__(self, dtypes: dict, capacity: int = 1024):
+        """
+        :param dtypes: dict of column name -> numpy dtype
+        :param capacity: initial capacity
+        """
+        self.dtypes = dtypes
+        self._columns = {c: np.empty(capacity, dtype=d) for c, d in dtypes.items()}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(next(iter(self._columns.values())))
+
+    def append(self, **values):
+        if self.size == self.capacity:
+            for c, a in self._columns.items():
+                self._columns[c] = np.resize(a, 2 * len(a))
+
+        for c, v in values.items():
+            self._columns[c][self.size] = v
+
+        self.size += 1
+
+    def set_last(self, **values):
+        for c, v in values.items():
+            self._columns[c][self.size - 1] = v
+
+    def last(self, column: str):
+        return self._columns[column][self.size - 1] if self.size > 0 else None
+
+    def columns(self) -> dict:
+        """
+        :return: dict of views of the filled part of each column
+        """
+        return {c: a[:self.size] for c, a in self._columns.items()}
+
+    def clear(self):
+        self.size = 0
+
+
+class Recorder(object):
+    """
+    Record equity curve and fills of a backtest (or a live session) in numpy column buffers. The buffers are flushed in chunks to parquet or npy files.
+    The equity is recorded on portfolio_update (new order) and portfolio_value_update (new prices) events, once per timestamp.
+    The recorder should be added to the listeners before the other components, so that it sees the timestamp of each data replay event before the orders, which are fulfilled during this event.
+    """
+
+    _EQUITY_DTYPES = {'timestamp': np.int64, 'capital': np.float64, 'value': np.float64, 'total': np.float64}
+
+    _FILLS_DTYPES = {'timestamp': np.int64, 'fulfill_time': np.int64, 'symbol': np.int32, 'order_type': np.int8, 'quantity': np.int64,
+                     'price': np.float64, 'cost': np.float64, 'commission': np.float64}
+
+    def __init__(self, listeners, path: str = None, fmt: str = 'npy', chunk_size: int = 100000):
+        """
+        :param listeners: listeners environment
+        :param path: directory for the flushed chunks. If None, everything is kept in memory
+        :param fmt: 'npy' (one file per column and chunk, which are memory mapped when read) or 'parquet' (one file per chunk)
+        :param chunk_size: number of rows of each of the equity curve and the fills, after which they are flushed to a chunk. Bounds the memory only if path is set
+        """
+        if fmt not in ('npy', 'parquet'):
+            raise Exception("Unsupported format " + fmt)
+
+        self.listeners = listeners
+        listeners += self.on_event
+
+        self.path = path
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        self._equity = ColumnBuffer(self._EQUITY_DTYPES, capacity=min(chunk_size, 1024))
+        self._fills = ColumnBuffer(self._FILLS_DTYPES, capacity=min(chunk_size, 1024))
+        self._chunks = {'equity': 0, 'fills': 0}
+        self._symbols = dict()
+        self._timestamp = None
+        self._lock = threading.RLock()
+
+    def on_event(self, event):
+        if 'type' not in event:
+            return
+
+        if event['type'] == 'order_fulfilled':
+            self.record_fill(event['data'])
+        elif event['type'] in ('portfolio_update', 'portfolio_value_update'):
+            self.record_value(event['data'], mark_to_market=event['mark_to_market'] if 'mark_to_market' in event else None)
+        elif 'timestamp' in event:
+            self._timestamp = event['timestamp']
+
+    def record_fill(self, order: BaseOrder):
+        with self._lock:
+            if order.symbol not in self._symbols:
+                self._symbols[order.symbol] = len(self._symbols)
+
+            if len(self._fills) >= self.chunk_size:
+                self._flush_buffer('fills', self._fills)
+
+            self._fills.append(timestamp=self._current_timestamp(),
+                               fulfill_time=pd.Timestamp(order.fulfill_time).value,
+                               symbol=self._symbols[order.symbol],
+                               order_type=order.order_type.value,
+                               quantity=order.obtained_quantity,
+                               price=order.cost / order.obtained_quantity,
+                               cost=order.cost,
+                               commission=order.commission)
+
+    def record_value(self, portfolio_manager, mark_to_market: dict = None):
+        """
+        Record the equity at the current timestamp. Multiple updates within the same timestamp overwrite each other
+        :param portfolio_manager: PortfolioManager
+        :param mark_to_market: value of each symbol (computed from the portfolio manager if None)
+        """
+        with self._lock:
+            if mark_to_market is None:
+                mark_to_market = portfolio_manager.value(multiply_by_quantity=True)
+
+            capital = portfolio_manager.capital
+            value = sum(mark_to_market.values())
+            timestamp = self._current_timestamp()
+
+            if self._equity.last('timestamp') == timestamp:
+                self._equity.set_last(capital=capital, value=value, total=capital + value)
+            else:
+                if len(self._equity) >= self.chunk_size:
+                    self._flush_buffer('equity', self._equity)
+
+                self._equity.append(timestamp=timestamp, capital=capital, value=value, total=capital + value)
+
+    def flush(self):
+        """
+        Write all buffered rows to disk
+        """
+        with self._lock:
+            if self.path is not None:
+                self._flush_buffer('equity', self._equity)
+                self._flush_buffer('fills', self._fills)
+
+    def equity_curve(self) -> pd.DataFrame:
+        """
+        :return: DataFrame with capital, value (of the holdings) and total for each timestamp
+        """
+        with self._lock:
+            columns = self._read('equity', self._equity)
+
+        result = pd.DataFrame({c: columns[c] for c in ['capital', 'value', 'total']}, index=pd.DatetimeIndex(columns['timestamp'], name='timestamp').tz_localize('UTC'))
+
+        return result
+
+    def fills(self) -> pd.DataFrame:
+        """
+        :return: DataFrame with all fulfilled orders
+        """
+        with self._lock:
+            columns = self._read('fills', self._fills)
+            symbols = list(self._symbols)
+
+        result = pd.DataFrame({'timestamp': pd.DatetimeIndex(columns['timestamp']).tz_localize('UTC'),
+                               'fulfill_time': pd.DatetimeIndex(columns['fulfill_time']).tz_localize('UTC'),
+                               'symbol': pd.Categorical.from_codes(columns['symbol'], categories=symbols),
+                               'order_type': pd.Categorical.from_codes(columns['order_type'] - 1, categories=[t.name for t in Type]),
+                               'quantity': columns['quantity'],
+                               'price': columns['price'],
+                               'cost': columns['cost'],
+                               'commission': columns['commission']})
+
+        return result
+
+    def _current_timestamp(self):
+        return pd.Timestamp(self._timestamp if self._timestamp is not None else datetime.datetime.utcnow()).value
+
+    def _flush_buffer(self, name: str, buffer: ColumnBuffer):
+        if self.path is None:
+            # everything stays in memory
+            return
+
+        if len(buffer) > 0:
+            file_name = os.path.join(self.path, '%s-%05d' % (name, self._chunks[name]))
+
+            if self.fmt == 'parquet':
+                pd.DataFrame(buffer.columns()).to_parquet(file_name + '.parquet')
+            else:
+                for c, a in buffer.columns().items():
+                    np.save(file_name + '.' + c + '.npy', a)
+
+            self._chunks[name] += 1
+            buffer.clear()
+
+        if name == 'fills':
+            with open(os.path.join(self.path, 'symbols.json'), 'w') as f:
+                json.dump(list(self._symbols), f)
+
+    def _read(self, name: str, buffer: ColumnBuffer) -> dict:
+        chunks = list()
+        if self.path is not None:
+            for i in range(self._chunks[name]):
+                file_name = os.path.join(self.path, '%s-%05d' % (name, i))
+
+                if self.fmt == 'parquet':
+                    df = pd.read_parquet(file_name + '.parquet')
+                    chunks.append({c: df[c].values for c in buffer.dtypes})
+                else:
+                    chunks.append({c: np.load(file_name + '.' + c + '.npy', mmap_mode='r') for c in buffer.dtypes})
+
+        chunks.append(buffer.columns())
+
+        return {c: np.concatenate([ch[c] for ch in chunks]).astype(d, copy=False) for c, d in buffer.dtypes.items()}
@@ -1,22 +1,171 @@
+import functools
 import pickle
+import struct
+import threading
+import typing
 import zlib
 
 import lmdb
 
 
+class PickleCodec(object):
+    """
+    Pickle with optional zlib compression. This is the format of write/read
+    """
+
+    def __init__(self, compress=True):
+        self.compress = compress
+
+    def encode(self, value) -> bytes:
+        result = pickle.dumps(value)
+        return zlib.compress(result) if self.compress else result
+
+    def decode(self, value: bytes):
+        return pickle.loads(zlib.decompress(value) if self.compress else value)
+
+
+class Lz4Codec(object):
+    """
+    Pickle with lz4 frame compression. Requires the lz4 package. Faster than zlib at the expense of larger values
+    """
+
+    def __init__(self, compression_level: int = 0):
+        import lz4.frame
+
+        self._lz4 = lz4.frame
+        self.compression_level = compression_level
+
+    def encode(self, value) -> bytes:
+        return self._lz4.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), compression_level=self.compression_level)
+
+    def decode(self, value: bytes):
+        return pickle.loads(self._lz4.decompress(value))
+
+
+class RawBuffersCodec(object):
+    """
+    Uncompressed pickle protocol 5 with out-of-band buffers (the numpy arrays of the DataFrame). Decoding is a single memory copy of the value
+    followed by unpickling of a small header, which references the arrays in place
+    """
+
+    _LENGTH = struct.Struct('<Q')
+
+    def encode(self, value) -> bytes:
+        buffers = list()
+        header = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+
+        return b''.join([self._LENGTH.pack(len(header)), self._LENGTH.pack(len(buffers))]
+                        + [self._LENGTH.pack(b.nbytes) for b in buffers]
+                        + [header] + buffers)
+
+    def decode(self, value: bytes):
+        # the copy is writable and owns the memory of all the arrays
+        value = memoryview(bytearray(value))
+
+        header_len, buffers_count = self._LENGTH.unpack_from(value, 0)[0], self._LENGTH.unpack_from(value, 8)[0]
+        offset = 16 + 8 * buffers_count
+
+        header = value[offset:offset + header_len]
+        offset += header_len
+
+        buffers = list()
+        for i in range(buffers_count):
+            size = self._LENGTH.unpack_from(value, 16 + 8 * i)[0]
+            buffers.append(value[offset:offset + size])
+            offset += size
+
+        return pickle.loads(header, buffers=buffers)
+
+
+class LmdbCache(object):
+    """
+    LMDB cache with a single environment, which is open for the lifetime of the object. Reads are thread-safe and run in parallel (each read uses its own transaction).
+    Writes are serialized. The object is callable with a key, so it can be used as a cache of BarsInPeriodProvider
+    """
+
+    def __init__(self, lmdb_path: str, codec=None, map_size: int = int(1e12), readonly: bool = False, max_readers: int = 126):
+        """
+        :param lmdb_path: path to the lmdb environment
+        :param codec: object with encode(value) -> bytes and decode(bytes) -> value methods. PickleCodec (compatible with write/read) by default
+        :param map_size: lmdb map size
+        :param readonly: open the environment in read-only mode
+        :param max_readers: maximum number of simultaneous read transactions
+        """
+        self.lmdb_path = lmdb_path
+        self.codec = codec if codec is not None else PickleCodec()
+        self.env = lmdb.open(lmdb_path, map_size=map_size, readonly=readonly, max_readers=max_readers)
+        self._write_lock = threading.Lock()
+
+    def __call__(self, key: str):
+        return self.get(key)
+
+    def __contains__(self, key: str):
+        with self.env.begin(buffers=True) as txn:
+            return txn.get(key.encode()) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def get(self, key: str):
+        """
+        :param key: key
+        :return: the decoded value or None, if the key doesn't exist
+        """
+        with self.env.begin() as txn:
+            result = txn.get(key.encode())
+
+        return self.codec.decode(result) if result is not None else None
+
+    def put(self, key: str, value):
+        """
+        :param key: key
+        :param value: value to encode and store
+        """
+        self.put_many([(key, value)])
+
+    def put_many(self, items: typing.Iterable[tuple]):
+        """
+        Store multiple values in a single transaction. The values are encoded before the transaction starts
+        :param items: iterable of (key, value) tuples
+        """
+        items = [(k.encode(), self.codec.encode(v)) for k, v in items]
+
+        with self._write_lock, self.env.begin(write=True) as txn:
+            for k, v in items:
+                txn.put(k, v)
+
+    def keys(self) -> typing.List[str]:
+        with self.env.begin() as txn:
+            return [k.decode() for k in txn.cursor().iternext(keys=True, values=False)]
+
+    def close(self):
+        self.env.close()
+
+
+@functools.lru_cache(maxsize=None)
+def shared_cache(lmdb_path: str) -> LmdbCache:
+    """
+    LMDB environment should be opened only once per process. This returns a single LmdbCache (with the default codec) for each path, which stays open for the lifetime of the process
+    :param lmdb_path: path to the lmdb environment
+    :return: LmdbCache
+    """
+    return LmdbCache(lmdb_path)
+
+
 def write(key: str, value, lmdb_path: str, compress=True):
     with lmdb.open(lmdb_path, map_size=int(1e12)) as lmdb_env, lmdb_env.begin(write=True) as lmdb_txn:
-        lmdb_txn.put(key.encode(), zlib.compress(pickle.dumps(value)) if compress else pickle.dumps(value))
+        lmdb_txn.put(key.encode(), PickleCodec(compress=compress).encode(value))
 
 
 def read(key: str, lmdb_path: str, decompress=True):
     with lmdb.open(lmdb_path) as lmdb_env, lmdb_env.begin() as lmdb_txn:
         result = lmdb_txn.get(key.encode())
         if result is not None:
-            if decompress:
-                result = zlib.decompress(result)
-
-            result = pickle.loads(result)
+            result = PickleCodec(compress=decompress).decode(result)
 
         return result
 
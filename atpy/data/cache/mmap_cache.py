@@ -0,0 +1,251 @@
+"""
+Columnar memory-mapped store for OHLCV bars. Each key (for example the weekly chunks of BarsInPeriodProvider) is stored in a separate directory,
+which contains a single binary file with one contiguous block per column and a small json index.
+The rows are ordered by symbol and then by timestamp, so that the time range of a single symbol is a contiguous slice of each column.
+"""
+
+import functools
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from atpy.data.cache.lmdb_cache import LmdbCache
+
+_DATA_FILE = 'columns.bin'
+_INDEX_FILE = 'index.json'
+_ALIGNMENT = 64
+
+
+def write(key: str, df: pd.DataFrame, mmap_path: str):
+    """
+    Store bars dataframe. Float columns are stored as float32 and integer columns are stored with their own dtype
+    :param key: key (for example BarsInPeriodProvider.current_cache_key())
+    :param df: dataframe with either timestamp/symbol MultiIndex or timestamp index
+    :param mmap_path: root path of the store
+    """
+    names = list(df.index.names)
+    if 'timestamp' not in names or (len(names) > 1 and (len(names) != 2 or 'symbol' not in names)):
+        raise Exception("Index must be either timestamp or timestamp/symbol, got " + str(names))
+
+    timestamps = df.index.get_level_values('timestamp') if len(names) > 1 else df.index
+    if not isinstance(timestamps, pd.DatetimeIndex):
+        raise Exception("Timestamp must be DatetimeIndex")
+
+    ts_i8 = timestamps.asi8
+
+    if len(names) > 1:
+        codes, symbol_names = pd.factorize(df.index.get_level_values('symbol'), sort=True)
+        symbol_names = list(symbol_names)
+    else:
+        codes, symbol_names = np.zeros(len(df), dtype=np.int64), [None]
+
+    # symbol major, timestamp minor
+    order = np.lexsort((ts_i8, codes))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(symbol_names)))))
+
+    # position of each original row in the stored order
+    row_order = np.empty(len(df), dtype=np.int64)
+    row_order[order] = np.arange(len(df), dtype=np.int64)
+
+    blocks = [('timestamp', ts_i8.take(order)), ('row_order', row_order)]
+    dtypes = dict()
+    for c in df.columns:
+        values = df[c].values
+        if c in ('timestamp', 'row_order'):
+            raise Exception("Column name " + c + " is reserved")
+        elif np.issubdtype(values.dtype, np.floating):
+            stored = values.astype(np.float32)
+        elif np.issubdtype(values.dtype, np.integer):
+            stored = values
+        else:
+            raise Exception("Column " + str(c) + " of type " + str(values.dtype) + " is not supported")
+
+        blocks.append((c, stored.take(order)))
+        dtypes[c] = values.dtype.str
+
+    path = _key_path(mmap_path, key)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    os.makedirs(tmp_path)
+
+    layout, offset = list(), 0
+    with open(os.path.join(tmp_path, _DATA_FILE), 'wb') as f:
+        for name, values in blocks:
+            padding = -offset % _ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+
+            f.write(np.ascontiguousarray(values).tobytes())
+            layout.append({'name': name, 'dtype': values.dtype.str, 'offset': offset})
+            offset += values.nbytes
+
+    index = {'key': key,
+             'rows': len(df),
+             'index_names': names,
+             'tz': str(timestamps.tz) if timestamps.tz is not None else None,
+             'symbols': symbol_names,
+             'offsets': offsets.tolist(),
+             'layout': layout,
+             'dtypes': dtypes}
+
+    with open(os.path.join(tmp_path, _INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    os.rename(tmp_path, path)
+
+    _open.cache_clear()
+
+
+def read(key: str, mmap_path: str):
+    """
+    Read the bars dataframe, stored with write. Replacement for lmdb_cache.read_pickle: the columns are restored to their original dtype,
+    but the float columns are stored as float32, therefore their values have float32 precision (relative error up to 2 ** -24).
+    The values are exact only if they are representable as float32 (for example the real prices of postgres_cache)
+    :param key: key
+    :param mmap_path: root path of the store
+    :return: dataframe or None, if the key doesn't exist
+    """
+    chunk = _open(mmap_path, key)
+    if chunk is None:
+        return None
+
+    index, columns = chunk
+    row_order = columns['row_order']
+
+    data = {c: columns[c].take(row_order).astype(dtype, copy=False) for c, dtype in index['dtypes'].items()}
+
+    timestamps = columns['timestamp'].take(row_order)
+    tz = index['tz']
+
+    if len(index['index_names']) == 1:
+        df_index = _datetime_index(timestamps, tz)
+    else:
+        sizes = np.diff(index['offsets'])
+        symbol_codes = np.repeat(np.arange(len(sizes)), sizes).take(row_order)
+
+        if len(timestamps) > 0 and (timestamps[1:] >= timestamps[:-1]).all():
+            new_value = np.empty(len(timestamps), dtype=np.bool_)
+            new_value[0] = True
+            np.not_equal(timestamps[1:], timestamps[:-1], out=new_value[1:])
+            timestamp_codes = np.cumsum(new_value) - 1
+            timestamp_level = timestamps[new_value]
+        else:
+            timestamp_level, timestamp_codes = np.unique(timestamps, return_inverse=True)
+
+        levels = {'timestamp': (_datetime_index(timestamp_level, tz), timestamp_codes),
+                  'symbol': (pd.Index(index['symbols'], name='symbol'), symbol_codes)}
+
+        df_index = pd.MultiIndex(levels=[levels[n][0] for n in index['index_names']],
+                                 codes=[levels[n][1] for n in index['index_names']],
+                                 names=index['index_names'],
+                                 verify_integrity=False)
+
+    return pd.DataFrame(data, index=df_index, columns=list(index['dtypes'].keys()))
+
+
+def read_symbol(key: str, symbol: str, mmap_path: str, bgn_prd=None, end_prd=None):
+    """
+    Zero-copy read of the bars of a single symbol within a time range
+    :param key: key
+    :param symbol: symbol (None, if the dataframe was stored with timestamp index only)
+    :param mmap_path: root path of the store
+    :param bgn_prd: include bars with timestamp >= bgn_prd (all if None)
+    :param end_prd: include bars with timestamp <= end_prd (all if None)
+    :return: dict of read-only memory mapped column slices (timestamp is int64 UTC nanoseconds) or None, if the key or the symbol don't exist
+    """
+    chunk = _open(mmap_path, key)
+    if chunk is None:
+        return None
+
+    index, columns = chunk
+
+    try:
+        i = index['symbols'].index(symbol)
+    except ValueError:
+        return None
+
+    start, end = index['offsets'][i], index['offsets'][i + 1]
+    timestamps = columns['timestamp'][start:end]
+
+    if bgn_prd is not None:
+        start += int(np.searchsorted(timestamps, pd.Timestamp(bgn_prd).value, side='left'))
+
+    if end_prd is not None:
+        end = index['offsets'][i] + int(np.searchsorted(timestamps, pd.Timestamp(end_prd).value, side='right'))
+
+    return {c: columns[c][start:end] for c in ['timestamp'] + list(index['dtypes'].keys())}
+
+
+def symbols(key: str, mmap_path: str):
+    """
+    :param key: key
+    :param mmap_path: root path of the store
+    :return: list of stored symbols or None, if the key doesn't exist
+    """
+    chunk = _open(mmap_path, key)
+    return list(chunk[0]['symbols']) if chunk is not None else None
+
+
+def lmdb_to_mmap(lmdb_path: str, mmap_path: str, codec=None, overwrite=False):
+    """
+    Convert all dataframes, stored in LMDB cache (for example by postgres_cache.bars_to_lmdb) to the memory mapped store
+    :param lmdb_path: LMDB path
+    :param mmap_path: root path of the store
+    :param codec: codec of the LMDB values (see LmdbCache)
+    :param overwrite: overwrite already existing keys
+    :return: list of the converted keys
+    """
+    result = list()
+
+    with LmdbCache(lmdb_path, codec=codec, readonly=True) as cache:
+        for key in cache.keys():
+            if not overwrite and os.path.exists(os.path.join(_key_path(mmap_path, key), _INDEX_FILE)):
+                continue
+
+            df = cache.get(key)
+            if isinstance(df, pd.DataFrame):
+                write(key, df, mmap_path)
+                result.append(key)
+
+    return result
+
+
+def _key_path(mmap_path: str, key: str):
+    return os.path.join(mmap_path, re.sub(r'[^0-9A-Za-z.+-]', '_', key))
+
+
+def _datetime_index(values: np.array, tz: str):
+    result = pd.DatetimeIndex(values, name='timestamp')
+    return result.tz_localize('UTC').tz_convert(tz) if tz is not None else result
+
+
+@functools.lru_cache(maxsize=64)
+def _open(mmap_path: str, key: str):
+    path = _key_path(mmap_path, key)
+
+    try:
+        with open(os.path.join(path, _INDEX_FILE)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if index['key'] != key:
+        raise Exception("Key " + key + " collides with " + index['key'])
+
+    data_path = os.path.join(path, _DATA_FILE)
+    if index['rows'] > 0:
+        data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        columns = {l['name']: data[l['offset']:l['offset'] + index['rows'] * np.dtype(l['dtype']).itemsize].view(l['dtype']) for l in index['layout']}
+    else:
+        columns = {l['name']: np.empty(0, dtype=l['dtype']) for l in index['layout']}
+
+    return index, columns
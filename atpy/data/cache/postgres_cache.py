@@ -12,7 +12,7 @@ import psycopg2
 from dateutil import tz
 from dateutil.relativedelta import relativedelta
 
-from atpy.data.cache.lmdb_cache import write
+from atpy.data.cache.lmdb_cache import LmdbCache
 from atpy.data.ts_util import slice_periods
 
 
@@ -255,6 +255,30 @@ def request_symbol_counts(conn, bars_table: str, interval_len: int, interval_typ
     return result['count']
 
 
+def request_coverage(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None):
+    """
+    Request the first and the last bar of each symbol and day (US/Eastern), which can be used to plan the backfill requests (see iqfeed_history_planner.BackfillPlanner)
+    :param conn: connection
+    :param bars_table: table name
+    :param interval_len: interval len
+    :param interval_type: interval type
+    :param symbol: symbol or a list of symbols
+    :param bgn_prd: start period (including)
+    :param end_prd: end period (excluding)
+    :return: dict of symbol -> list of (first, last) timestamps (UTC)
+    """
+    where, params = __bars_query_where(interval_len=interval_len, interval_type=interval_type, symbol=symbol, bgn_prd=bgn_prd, end_prd=end_prd)
+
+    df = pd.read_sql("SELECT symbol, min(timestamp) as first, max(timestamp) as last FROM " + bars_table + where +
+                     " GROUP BY symbol, date_trunc('day', timezone('US/Eastern', timezone('UTC', timestamp))) ORDER BY symbol, first", con=conn, params=params)
+
+    result = dict()
+    for s, first, last in zip(df['symbol'], df['first'].dt.tz_localize('UTC'), df['last'].dt.tz_localize('UTC')):
+        result.setdefault(s, list()).append((first, last))
+
+    return result
+
+
 def __bars_query_where(interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None):
     where = " WHERE 1=1"
     params = list()
@@ -387,11 +411,14 @@ def request_adjustments(conn, table_name: str, symbol: typing.Union[list, str] =
 
 class BarsInPeriodProvider(object):
     """
-    OHLCV Bars in period provider
+    OHLCV Bars in period provider. Supports random access to the periods (len() and []), which allows parallel requests (see ts_util.AsyncInPeriodProvider)
     """
 
     def __init__(self, conn, bars_table: str, bgn_prd: datetime.datetime, delta: relativedelta, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, ascend: bool = True, overlap: relativedelta = None,
                  cache: typing.Callable = None):
+        """
+        :param conn: db connection or connection factory. If factory is used, each thread requests data with its own connection
+        """
         self._periods = slice_periods(bgn_prd=bgn_prd, delta=delta, ascend=ascend, overlap=overlap)
 
         self.conn = conn
@@ -401,6 +428,7 @@ class BarsInPeriodProvider(object):
         self.symbol = symbol
         self.ascending = ascend
         self.cache = cache
+        self._local = threading.local()
 
     def __iter__(self):
         self._deltas = -1
@@ -410,26 +438,60 @@ class BarsInPeriodProvider(object):
         self._deltas += 1
 
         if self._deltas < len(self._periods):
-            if self.cache is not None:
-                result = self.cache(self.current_cache_key())
-                if result is not None:
-                    return result
-
-            return request_bars(conn=self.conn, bars_table=self.bars_table, symbol=self.symbol, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=self._periods[self._deltas][0],
-                                end_prd=self._periods[self._deltas][1], ascending=self.ascending)
+            return self[self._deltas]
         else:
             raise StopIteration
 
+    def __len__(self):
+        return len(self._periods)
+
+    def __getitem__(self, i: int):
+        if self.cache is not None:
+            result = self.cache(self.cache_key(i))
+            if result is not None:
+                return result
+
+        return request_bars(conn=self._conn(), bars_table=self.bars_table, symbol=self.symbol, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=self._periods[i][0],
+                            end_prd=self._periods[i][1], ascending=self.ascending)
+
+    def _conn(self):
+        if not callable(self.conn):
+            return self.conn
+
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = self.conn()
+
+        return self._local.conn
+
+    def cache_key(self, i: int):
+        return str(self._periods[i][0]) + ' - ' + str(self._periods[i][1]) + ' - ' + str(self.interval_len) + str(self.interval_type)
+
     def current_cache_key(self):
-        return str(self._periods[self._deltas][0]) + ' - ' + str(self._periods[self._deltas][1]) + ' - ' + str(self.interval_len) + str(self.interval_type)
+        return self.cache_key(self._deltas)
 
 
-def bars_to_lmdb(provider: BarsInPeriodProvider, lmdb_path: str = None):
+def bars_to_lmdb(provider: BarsInPeriodProvider, lmdb_path: str = None, codec=None, batch_size: int = 16):
+    """
+    Store all periods of the provider in LMDB cache
+    :param provider: BarsInPeriodProvider
+    :param lmdb_path: LMDB path (can be obtained via env variable)
+    :param codec: codec of the values (see LmdbCache)
+    :param batch_size: number of periods, which are written in a single transaction
+    """
     if lmdb_path is None:
         lmdb_path = os.environ['ATPY_LMDB_PATH']
 
-    for df in provider:
-        write(provider.current_cache_key(), df, lmdb_path)
+    with LmdbCache(lmdb_path, codec=codec) as cache:
+        batch = list()
+        for df in provider:
+            batch.append((provider.current_cache_key(), df))
+
+            if len(batch) >= batch_size:
+                cache.put_many(batch)
+                batch = list()
+
+        if batch:
+            cache.put_many(batch)
 
 
 class BarsBySymbolProvider(object):
@@ -1,18 +1,18 @@
-import datetime
-from collections import Iterable
-
-from dateutil import tz
+import threading
+import time
+from collections import Iterable, OrderedDict
 
 from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends
 from atpy.data.iqfeed.util import *
 from atpy.data.splits_dividends import adjust_df
+from atpy.data.ts_util import RingBuffer
 from pyevents.events import EventFilter
 
 
 class IQFeedBarDataListener(iq.SilentBarListener):
     """Real-time bar data"""
 
-    def __init__(self, listeners, interval_len, interval_type='s', mkt_snapshot_depth=0, adjust_history=True, update_interval=0):
+    def __init__(self, listeners, interval_len, interval_type='s', mkt_snapshot_depth=0, adjust_history=True, update_interval=0, event_frames=True, bar_matrix_depth=0, bar_matrix_grace: float = 5):
         """
         :param listeners: listeners to notify for incombing bars
         :param interval_len: interval length
@@ -20,6 +20,11 @@ class IQFeedBarDataListener(iq.SilentBarListener):
         :param mkt_snapshot_depth: construct and maintain dataframe representing the current market snapshot with depth. If 0, then don't construct, otherwise construct for the past periods
         :param adjust_history: adjust historical bars for splits and dividends
         :param update_interval: how often to update each bar
+        :param event_frames: the bars of each symbol are kept in a fixed-depth ring buffer of pyiqfeed records (atpy.data.ts_util.RingBuffer). If True, the events carry
+        a dataframe of the buffer, otherwise they carry the buffer itself (mapping of field -> zero-copy view, with the raw pyiqfeed field names) and the dataframe is built on demand with bars_frame
+        :param bar_matrix_depth: if > 0, maintain an aligned symbol x time x field array of the last bar_matrix_depth closed bars of all watched symbols (see BarMatrix)
+        and fire a bar_matrix event once per interval
+        :param bar_matrix_grace: an interval is complete after all watched symbols closed their bar, or bar_matrix_grace seconds after the first of them
         """
         super().__init__(name="Bar data listener %d%s" % (interval_len, interval_type))
 
@@ -33,9 +38,18 @@ class IQFeedBarDataListener(iq.SilentBarListener):
         self.mkt_snapshot_depth = mkt_snapshot_depth
         self.adjust_history = adjust_history
         self.update_interval = update_interval
+        self.event_frames = event_frames
         self.watched_symbols = dict()
+        self._history_done = set()
+        self._bar_keys = dict()
+        self._layout = None
         self.bar_updates = 0
 
+        self.bar_matrix = BarMatrix(depth=bar_matrix_depth, grace=bar_matrix_grace, on_complete=self._fire_bar_matrix) if bar_matrix_depth > 0 else None
+        self._bar_matrix_cond = threading.Condition()
+        self._bar_matrix_timer = None
+        self._stopped = False
+
     def __enter__(self):
         launch_service()
 
@@ -48,12 +62,25 @@ class IQFeedBarDataListener(iq.SilentBarListener):
             self.streaming_conn = iq.QuoteConn()
             self.streaming_conn.connect()
 
+        if self.bar_matrix is not None:
+            self._stopped = False
+            self._bar_matrix_timer = threading.Thread(target=self._expire_bar_matrix, name="Bar matrix timer", daemon=True)
+            self._bar_matrix_timer.start()
+
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         """Disconnect connection etc"""
         self.conn.remove_listener(self)
 
+        if self._bar_matrix_timer is not None:
+            with self._bar_matrix_cond:
+                self._stopped = True
+                self._bar_matrix_cond.notify_all()
+
+            self._bar_matrix_timer.join()
+            self._bar_matrix_timer = None
+
         self.conn.disconnect()
 
         self.conn = None
@@ -81,89 +108,132 @@ class IQFeedBarDataListener(iq.SilentBarListener):
         if bad_symbol in self.watched_symbols and bad_symbol in self.watched_symbols:
             del self.watched_symbols[bad_symbol]
 
-    def _process_bar_update(self, bar_data: np.array) -> pd.DataFrame:
-        bar_data = bar_data[0] if len(bar_data) == 1 else bar_data
+        if self.bar_matrix is not None:
+            with self._bar_matrix_cond:
+                self.bar_matrix.remove_symbol(bad_symbol)
 
-        symbol = bar_data[0].decode("ascii")
+    def _process_bar_update(self, bar_data: np.array) -> RingBuffer:
+        if self._layout is None:
+            # byte ranges of the symbol and the (date, time) fields of the records
+            fields = bar_data.dtype.fields
+            self._layout = (slice(fields['symbol'][1], fields['symbol'][1] + fields['symbol'][0].itemsize),
+                            slice(fields['date'][1], fields['date'][1] + fields['date'][0].itemsize),
+                            slice(fields['time'][1], fields['time'][1] + fields['time'][0].itemsize))
 
-        df = self.watched_symbols[symbol]
+        raw = bar_data.tobytes()
+        symbol = raw[self._layout[0]].rstrip(b'\x00').decode("ascii")
+        key = raw[self._layout[1]] + raw[self._layout[2]]
 
-        if df is None:
-            self.watched_symbols[symbol] = self._bar_to_df(bar_data)
+        bars = self.watched_symbols.get(symbol)
+
+        if bars is None:
+            bars = RingBuffer(iqfeed_dtype(bar_data.dtype), max(self.mkt_snapshot_depth, 1), constants={'symbol': symbol})
+
+            # updates, which arrive after unwatch, don't watch the symbol again
+            if symbol in self.watched_symbols:
+                self.watched_symbols[symbol] = bars
+
+            bars.append(bar_data)
+        elif self._bar_keys.get(symbol) == key:
+            # the same bar is updated in place (the timestamps are compared in US/Eastern, without conversion)
+            bars.replace_last(bar_data)
         else:
-            bar_timestamp = (bar_data[1] + np.timedelta64(bar_data[2], 'us')) \
-                .astype(datetime.datetime) \
-                .replace(tzinfo=tz.gettz('US/Eastern')) \
-                .astimezone(tz.gettz('UTC'))
-
-            timestamp_ind = df.index.names.index('timestamp')
-            df_timestamp = df.index[-1][timestamp_ind]
-
-            if df_timestamp != bar_timestamp:
-                data = self._bar_to_df(bar_data)
-                df = df.append(data) if self.mkt_snapshot_depth > 0 else data
-                if df.shape[0] > self.mkt_snapshot_depth:
-                    df = df.iloc[df.shape[0] - self.mkt_snapshot_depth:]
-
-                df.index = df.index.set_levels(pd.to_datetime(df.index.levels[timestamp_ind], utc=True), level='timestamp')
-
-                self.watched_symbols[symbol] = df
-            else:
-                df.iloc[-1] = bar_data['open_p'], \
-                              bar_data['high_p'], \
-                              bar_data['low_p'], \
-                              bar_data['close_p'], \
-                              bar_data['tot_vlm'], \
-                              bar_data['prd_vlm'], \
-                              bar_data['num_trds']
+            bars.append(bar_data)
+
+        self._bar_keys[symbol] = key
 
         self.bar_updates = (self.bar_updates + 1) % 1000000007
 
         if self.bar_updates % 100 == 0:
             logging.getLogger(__name__).debug("%d bar updates" % self.bar_updates)
 
-        return df
+        return bars
+
+    def _event_data(self, bars: RingBuffer):
+        return self._buffer_to_df(bars) if self.event_frames else bars
+
+    def bars_frame(self, symbol: str) -> pd.DataFrame:
+        """
+        :param symbol: symbol
+        :return: dataframe of the current bars of the symbol (None if there are no bars)
+        """
+        bars = self.watched_symbols.get(symbol)
+        return self._buffer_to_df(bars) if bars is not None else None
 
     def process_latest_bar_update(self, bar_data: np.array) -> None:
-        df = self._process_bar_update(bar_data)
-        symbol = bar_data[0].decode("ascii")
+        bars = self._process_bar_update(bar_data)
 
         self.listeners({'type': 'latest_bar_update',
-                        'data': df,
-                        'symbol': symbol,
+                        'data': self._event_data(bars),
+                        'symbol': bars['symbol'],
                         'interval_type': self.interval_type,
                         'interval_len': self.interval_len})
 
     def process_live_bar(self, bar_data: np.array) -> None:
-        df = self._process_bar_update(bar_data)
-        symbol = bar_data[0].decode("ascii")
+        bars = self._process_bar_update(bar_data)
 
         self.listeners({'type': 'live_bar',
-                        'data': df,
-                        'symbol': symbol,
+                        'data': self._event_data(bars),
+                        'symbol': bars['symbol'],
                         'interval_type': self.interval_type,
                         'interval_len': self.interval_len})
 
-    def process_history_bar(self, bar_data: np.array) -> None:
-        bar_data = (bar_data[0] if len(bar_data) == 1 else bar_data).copy()
+        if self.bar_matrix is not None:
+            bar = bars.last_record()
 
-        symbol = bar_data[0].decode("ascii")
+            with self._bar_matrix_cond:
+                self.bar_matrix.update(bars['symbol'], bar['date'] + bar['time'].astype('m8[us]'), (bar['open_p'], bar['high_p'], bar['low_p'], bar['close_p'], bar['prd_vlm']))
+                self._bar_matrix_cond.notify_all()
 
-        if self.watched_symbols[symbol] is None:
-            self.watched_symbols[symbol] = list()
+    def _fire_bar_matrix(self, bar_matrix):
+        """fire the bar matrix of each completed interval (executed under lock, so that the events are fired in order)"""
+        self.listeners({'type': 'bar_matrix',
+                        'data': bar_matrix.values.copy(),
+                        'symbols': list(bar_matrix.symbols),
+                        'timestamps': bar_matrix.utc_timestamps(),
+                        'fields': list(bar_matrix.fields),
+                        'interval_type': self.interval_type,
+                        'interval_len': self.interval_len})
 
-        self.watched_symbols[symbol].append(bar_data)
+    def _expire_bar_matrix(self):
+        """complete the intervals after their grace period (executed in the timer thread)"""
+        with self._bar_matrix_cond:
+            while not self._stopped:
+                deadline = self.bar_matrix.next_deadline()
 
-        if len(self.watched_symbols[symbol]) == self.mkt_snapshot_depth:
-            df = self._bars_to_df(self.watched_symbols[symbol])
+                if deadline is None:
+                    self._bar_matrix_cond.wait()
+                elif deadline > time.time():
+                    self._bar_matrix_cond.wait(deadline - time.time())
+                else:
+                    self.bar_matrix.expire(time.time())
+
+    def process_history_bar(self, bar_data: np.array) -> None:
+        bars = self._process_bar_update(bar_data)
+        symbol = bars['symbol']
+
+        if bars.size == self.mkt_snapshot_depth and symbol not in self._history_done:
+            self._history_done.add(symbol)
+
+            df = self._buffer_to_df(bars)
 
             if self.adjust_history:
                 adjust_df(df, get_splits_dividends(symbol, self.streaming_conn))
 
-            self.watched_symbols[symbol] = df
+                # the live bars are appended to the adjusted history
+                adjusted = bars.last().copy()
+                for c, f in (('open', 'open_p'), ('high', 'high_p'), ('low', 'low_p'), ('close', 'close_p'), ('total_volume', 'tot_vlm'), ('volume', 'prd_vlm')):
+                    adjusted[f] = df[c].values
+
+                bars = RingBuffer(bars.last().dtype, bars.maxlen, constants=bars.constants)
+                for i in range(len(adjusted)):
+                    bars.append(adjusted[i:i + 1])
+
+                if symbol in self.watched_symbols:
+                    self.watched_symbols[symbol] = bars
 
             self.listeners({'type': 'history_bars',
-                            'data': df,
+                            'data': df if self.event_frames else bars,
                             'symbol': symbol,
                             'interval_type': self.interval_type,
                             'interval_len': self.interval_len})
@@ -178,6 +248,12 @@ class IQFeedBarDataListener(iq.SilentBarListener):
                            else False,
                            event_transformer=lambda e: (e['data'], e['symbol']))
 
+    def bar_matrix_event_stream(self):
+        return EventFilter(listeners=self.listeners,
+                           event_filter=
+                           lambda e: True if 'type' in e and e['type'] == 'bar_matrix' and e['interval_type'] == self.interval_type and e['interval_len'] == self.interval_len else False,
+                           event_transformer=lambda e: (e['data'], e['symbols'], e['timestamps']))
+
     def all_full_bars_event_stream(self):
         return EventFilter(listeners=self.listeners,
                            event_filter=
@@ -195,57 +271,179 @@ class IQFeedBarDataListener(iq.SilentBarListener):
                      'update': self.update_interval,
                      'lookback_bars': self.mkt_snapshot_depth}
 
-        if isinstance(symbol, str) and symbol not in self.watched_symbols:
-            self.watched_symbols[symbol] = None
+        new_symbols = [symbol] if isinstance(symbol, str) else list(symbol) if isinstance(symbol, Iterable) else list()
+        new_symbols = [s for s in new_symbols if s not in self.watched_symbols]
+
+        if self.bar_matrix is not None:
+            with self._bar_matrix_cond:
+                self.bar_matrix.add_symbols(new_symbols)
+
+        for s in new_symbols:
+            data_copy['symbol'] = s
+            self.watched_symbols[s] = None
+            self._history_done.discard(s)
             self.conn.watch(**data_copy)
-        elif isinstance(symbol, Iterable):
-            for s in [s for s in data_copy['symbol'] if s not in self.watched_symbols]:
-                data_copy['symbol'] = s
-                self.watched_symbols[s] = None
-                self.conn.watch(**data_copy)
 
     @staticmethod
-    def _bars_to_df(bars: list) -> pd.DataFrame:
-        if len(bars) == 0:
-            return pd.DataFrame()
+    def _buffer_to_df(bars: RingBuffer) -> pd.DataFrame:
+        data = bars.last()
+
+        result = pd.DataFrame(OrderedDict([('symbol', bars['symbol']),
+                                           ('open', data['open_p']),
+                                           ('high', data['high_p']),
+                                           ('low', data['low_p']),
+                                           ('close', data['close_p']),
+                                           ('total_volume', data['tot_vlm']),
+                                           ('volume', data['prd_vlm']),
+                                           ('number_of_trades', data['num_trds'])]),
+                              index=eastern_to_utc(data['date'] + data['time'].astype('m8[us]')).rename('timestamp'))
 
-        df = iqfeed_to_df(bars)
+        return result
 
-        df['timestamp'] = pd.Index(df['date'] + pd.to_timedelta(df['time'], unit='us')) \
-            .tz_localize('US/Eastern') \
-            .tz_convert('UTC')
 
-        df = df.rename(index=str,
-                       columns={'open_p': 'open',
-                                'high_p': 'high',
-                                'low_p': 'low',
-                                'close_p': 'close',
-                                'tot_vlm': 'total_volume',
-                                'prd_vlm': 'volume',
-                                'num_trds': 'number_of_trades'}) \
-            .set_index('timestamp', drop=True, append=False) \
-            .drop(['date', 'time'], axis=1)
+class BarMatrix(object):
+    """
+    Aligned symbol x time x field array of the last closed bars of a symbol universe. An interval is complete when all symbols closed their bar for it
+    (or for a later interval), or when its grace period expires. The missing bars are forward filled: open/high/low/close with the last close and volume with 0
+    """
 
-        return df
+    fields = ('open', 'high', 'low', 'close', 'volume')
 
-    @staticmethod
-    def _bar_to_df(bar_data) -> pd.DataFrame:
-        result = dict()
+    def __init__(self, depth: int, grace: float = 5, on_complete: typing.Callable = None):
+        """
+        :param depth: number of intervals
+        :param grace: the intervals are completed grace seconds after the first bar, even if some symbols are missing
+        :param on_complete: called with the matrix after each completed interval
+        """
+        self.depth = depth
+        self.grace = grace
+        self.on_complete = on_complete
 
-        bar_data = (bar_data[0] if len(bar_data) == 1 else bar_data).copy()
+        self.symbols = list()
+        self._rows = dict()
+        self._expected = np.zeros(0, dtype=np.bool_)
 
-        result['timestamp'] = (datetime.datetime.combine(bar_data['date'].astype(datetime.datetime), datetime.datetime.min.time())
-                               + datetime.timedelta(microseconds=bar_data['time'].astype(np.uint64) / 1)) \
-            .replace(tzinfo=tz.gettz('US/Eastern')).astimezone(tz.gettz('UTC'))
+        self.values = np.full((0, depth, len(self.fields)), np.nan)
 
-        result['open'] = bar_data['open_p']
-        result['high'] = bar_data['high_p']
-        result['low'] = bar_data['low_p']
-        result['close'] = bar_data['close_p']
-        result['total_volume'] = bar_data['tot_vlm']
-        result['volume'] = bar_data['prd_vlm']
-        result['number_of_trades'] = bar_data['num_trds']
+        # US/Eastern labels of the intervals
+        self.timestamps = np.full(depth, np.datetime64('NaT'), dtype='M8[us]')
 
-        result = pd.DataFrame(result, index=result['timestamp']).drop('timestamp', axis=1)
+        self._last_close = np.zeros(0)
 
-        return result
+        # interval -> [deadline, mask of the symbols, which are done, bars]
+        self._pending = OrderedDict()
+
+    def add_symbols(self, symbols: typing.List[str]):
+        for s in [s for s in symbols if s in self._rows]:
+            self._expected[self._rows[s]] = True
+
+        symbols = [s for s in symbols if s not in self._rows]
+        if not symbols:
+            return
+
+        self._rows.update({s: len(self.symbols) + i for i, s in enumerate(symbols)})
+        self.symbols.extend(symbols)
+
+        n = len(symbols)
+        self._expected = np.concatenate([self._expected, np.ones(n, dtype=np.bool_)])
+        self.values = np.concatenate([self.values, np.full((n, self.depth, len(self.fields)), np.nan)])
+        self._last_close = np.concatenate([self._last_close, np.full(n, np.nan)])
+
+        for p in self._pending.values():
+            p[1] = np.concatenate([p[1], np.zeros(n, dtype=np.bool_)])
+            p[2] = np.concatenate([p[2], np.full((n, len(self.fields)), np.nan)])
+
+    def remove_symbol(self, symbol: str) -> int:
+        """
+        The symbol is not expected anymore (its row remains)
+        :return: number of completed intervals
+        """
+        if symbol in self._rows:
+            self._expected[self._rows[symbol]] = False
+
+        return self._complete_ready()
+
+    def update(self, symbol: str, interval: np.datetime64, values: typing.Tuple) -> int:
+        """
+        :param symbol: symbol
+        :param interval: US/Eastern label of the closed bar
+        :param values: bar values in the order of fields
+        :return: number of completed intervals
+        """
+        row = self._rows.get(symbol)
+        if row is None:
+            return 0
+
+        interval = np.datetime64(interval, 'us')
+
+        if not np.isnat(self.timestamps[-1]) and interval <= self.timestamps[-1]:
+            logging.getLogger(__name__).debug("Bar of " + symbol + " at " + str(interval) + " arrived after the interval was completed")
+            return 0
+
+        if interval not in self._pending:
+            self._pending[interval] = [time.time() + self.grace, np.zeros(len(self.symbols), dtype=np.bool_), np.full((len(self.symbols), len(self.fields)), np.nan)]
+
+            # a lagging symbol may open an earlier interval
+            if any(k > interval for k in self._pending):
+                self._pending = OrderedDict(sorted(self._pending.items()))
+
+        self._pending[interval][2][row] = values
+
+        for k, p in self._pending.items():
+            if k <= interval:
+                p[1][row] = True
+
+        return self._complete_ready()
+
+    def next_deadline(self) -> typing.Optional[float]:
+        return min(p[0] for p in self._pending.values()) if self._pending else None
+
+    def expire(self, now: float) -> int:
+        """
+        complete the intervals, whose grace period has expired (and the intervals before them)
+        :param now: current time
+        :return: number of completed intervals
+        """
+        expired = [k for k, p in self._pending.items() if p[0] <= now]
+        if not expired:
+            return 0
+
+        last = max(expired)
+        completed = 0
+        for k in [k for k in self._pending if k <= last]:
+            self._complete(k)
+            completed += 1
+
+        return completed + self._complete_ready()
+
+    def utc_timestamps(self) -> pd.DatetimeIndex:
+        return eastern_to_utc(self.timestamps)
+
+    def _complete_ready(self) -> int:
+        completed = 0
+        while self._pending:
+            interval, (_, done, _) = next(iter(self._pending.items()))
+            if not done[self._expected].all():
+                break
+
+            self._complete(interval)
+            completed += 1
+
+        return completed
+
+    def _complete(self, interval: np.datetime64):
+        _, _, bars = self._pending.pop(interval)
+
+        self.values[:, :-1] = self.values[:, 1:]
+        self.timestamps[:-1] = self.timestamps[1:]
+
+        missing = np.isnan(bars[:, 3])
+        bars[missing, :4] = self._last_close[missing, np.newaxis]
+        bars[missing, 4] = np.where(np.isnan(self._last_close[missing]), np.nan, 0)
+
+        self.values[:, -1] = bars
+        self.timestamps[-1] = interval
+        self._last_close = bars[:, 3].copy()
+
+        if self.on_complete is not None:
+            self.on_complete(self)
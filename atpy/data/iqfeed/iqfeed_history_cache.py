@@ -0,0 +1,221 @@
+import collections
+import hashlib
+import logging
+import os
+import threading
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+class _InFlight(object):
+    """
+    Request in progress, which is shared by all identical concurrent requests
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class HistoryResponseCache(object):
+    """
+    On-disk cache of the raw IQFeed history responses (pyiqfeed structured arrays), stored as npy files. The key is the filter without the timeout.
+    Only the responses for periods, which end before the current day (US/Eastern), are cached, because the data of the current session can still change.
+    The least recently used responses are evicted, when the size of the cache exceeds max_size. Concurrent identical requests are coalesced into one request
+    """
+
+    def __init__(self, path: str, max_size: int = 10 * 1024 ** 3):
+        """
+        :param path: directory of the cache
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._in_flight = dict()
+        self.hits = 0
+        self.misses = 0
+
+        # file name -> size in the order of the last access
+        self._entries = collections.OrderedDict()
+        files = [e for e in os.scandir(path) if e.is_file() and e.name.endswith('.npy')]
+        for e in sorted(files, key=lambda e: e.stat().st_mtime):
+            self._entries[e.name] = e.stat().st_size
+
+        self._size = sum(self._entries.values())
+
+    @property
+    def size(self) -> int:
+        """
+        :return: size of the cached responses in bytes
+        """
+        return self._size
+
+    @staticmethod
+    def key(f: typing.NamedTuple) -> str:
+        """
+        :param f: history filter with a single ticker
+        :return: cache key, which doesn't depend on the timeout
+        """
+        if 'timeout' in f._fields:
+            f = f._replace(timeout=None)
+
+        return type(f).__name__ + repr(tuple(f))
+
+    @staticmethod
+    def is_cacheable(f: typing.NamedTuple) -> bool:
+        """
+        :param f: history filter
+        :return: True, if the filter requests a period, which ends before the current day (US/Eastern)
+        """
+        today = pd.Timestamp.now(tz='US/Eastern').tz_localize(None).normalize()
+
+        if 'end_prd' in f._fields:
+            if f.end_prd is None:
+                return False
+
+            end_prd = pd.Timestamp(f.end_prd)
+            if end_prd.tzinfo is not None:
+                end_prd = end_prd.tz_convert('US/Eastern').tz_localize(None)
+
+            return end_prd < today
+        elif 'end_dt' in f._fields:
+            return f.end_dt is not None and pd.Timestamp(f.end_dt) < today
+
+        return False
+
+    def get(self, f: typing.NamedTuple):
+        """
+        :param f: history filter
+        :return: cached response or None
+        """
+        name = self._file_name(f)
+
+        with self._lock:
+            if name not in self._entries:
+                return None
+
+            self._entries.move_to_end(name)
+
+        file_path = os.path.join(self.path, name)
+
+        try:
+            result = np.load(file_path, allow_pickle=False)
+            os.utime(file_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._entries.pop(name, 0)
+
+            return None
+
+        return result
+
+    def put(self, f: typing.NamedTuple, data: np.ndarray):
+        """
+        Store response. The least recently used responses are evicted, if the cache is full
+        :param f: history filter
+        :param data: structured array
+        """
+        name = self._file_name(f)
+        file_path = os.path.join(self.path, name)
+        tmp_path = file_path + '.' + str(threading.get_ident()) + '.tmp'
+
+        with open(tmp_path, 'wb') as fl:
+            np.save(fl, data, allow_pickle=False)
+
+        os.replace(tmp_path, file_path)
+
+        evicted = list()
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = os.path.getsize(file_path)
+            self._size += self._entries[name]
+
+            while self._size > self.max_size and len(self._entries) > 1:
+                evicted_name, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                evicted.append(evicted_name)
+
+        for e in evicted:
+            try:
+                os.remove(os.path.join(self.path, e))
+            except FileNotFoundError:
+                pass
+
+    def request(self, f: typing.NamedTuple, fn: typing.Callable):
+        """
+        Return the cached response or execute the request. Identical concurrent requests wait for the first one
+        :param f: history filter
+        :param fn: function without arguments, which executes the request
+        :return: response
+        """
+        key = self.key(f)
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = _InFlight()
+                self._in_flight[key] = in_flight
+
+        if not owner:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+
+            return in_flight.result
+
+        try:
+            cacheable = self.is_cacheable(f)
+            result = self.get(f) if cacheable else None
+
+            if result is not None:
+                with self._lock:
+                    self.hits += 1
+            else:
+                with self._lock:
+                    self.misses += 1
+
+                result = fn()
+
+                if cacheable and result is not None:
+                    try:
+                        self.put(f, result)
+                    except Exception as err:
+                        logging.getLogger(__name__).exception(err)
+
+            in_flight.result = result
+
+            return result
+        except Exception as err:
+            in_flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+            in_flight.event.set()
+
+    def clear(self):
+        """
+        Remove all cached responses
+        """
+        with self._lock:
+            names = list(self._entries)
+            self._entries.clear()
+            self._size = 0
+
+        for n in names:
+            try:
+                os.remove(os.path.join(self.path, n))
+            except FileNotFoundError:
+                pass
+
+    def _file_name(self, f: typing.NamedTuple) -> str:
+        return hashlib.sha1(self.key(f).encode()).hexdigest() + '.npy'
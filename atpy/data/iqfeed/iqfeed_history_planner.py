@@ -0,0 +1,216 @@
+import datetime
+import typing
+
+import numpy as np
+import pandas as pd
+
+import atpy.data.tradingcalendar as tcal
+from atpy.data.iqfeed.iqfeed_history_provider import BarsInPeriodFilter, TicksInPeriodFilter
+
+_MIN = np.iinfo(np.int64).min
+_MAX = np.iinfo(np.int64).max
+
+
+def trading_sessions(bgn_prd: datetime.datetime, end_prd: datetime.datetime, bgn_time: datetime.time = datetime.time(9, 30), end_time: datetime.time = datetime.time(16, 0)) -> pd.DataFrame:
+    """
+    Sessions of the trading days (from the trading calendar) between bgn_prd and end_prd. The sessions of the early close days end 3 hours earlier
+    :param bgn_prd: begin period (naive US/Eastern)
+    :param end_prd: end period (naive US/Eastern)
+    :param bgn_time: start of each session (US/Eastern)
+    :param end_time: end of each session (US/Eastern)
+    :return: dataframe with session_bgn and session_end columns (naive US/Eastern), clipped to the period
+    """
+    bgn_prd, end_prd = pd.Timestamp(bgn_prd), pd.Timestamp(end_prd)
+
+    days = tcal.trading_days[(tcal.trading_days >= pd.Timestamp(bgn_prd.date(), tz='UTC')) & (tcal.trading_days <= pd.Timestamp(end_prd.date(), tz='UTC'))]
+    early = days.isin(tcal.early_closes)
+    days = days.tz_localize(None)
+
+    bgn = days + pd.Timedelta(hours=bgn_time.hour, minutes=bgn_time.minute, seconds=bgn_time.second)
+    end = days + pd.Timedelta(hours=end_time.hour, minutes=end_time.minute, seconds=end_time.second) - pd.to_timedelta(np.where(early, 3, 0), unit='h')
+
+    result = pd.DataFrame({'session_bgn': bgn.where(bgn > bgn_prd, bgn_prd), 'session_end': end.where(end < end_prd, end_prd)}, index=days)
+    result = result[result['session_bgn'] < result['session_end']]
+
+    return result
+
+
+def coverage_from_ranges(ranges: dict, interval_len: int, interval_type: str) -> dict:
+    """
+    :param ranges: result of influxdb_cache.ranges
+    :param interval_len: interval length
+    :param interval_type: interval type
+    :return: dict of symbol -> list of (first, last) timestamps of the existing data
+    """
+    return {k[0]: [v] for k, v in ranges.items() if k[1] == interval_len and k[2] == interval_type}
+
+
+def _to_eastern(t) -> np.ndarray:
+    """
+    :param t: list of timestamps. Naive timestamps are UTC
+    :return: int64 array of naive US/Eastern timestamps
+    """
+    t = pd.DatetimeIndex(t)
+    if t.tz is None:
+        t = t.tz_localize('UTC')
+
+    return t.tz_convert('US/Eastern').tz_localize(None).values.astype(np.int64)
+
+
+class BackfillPlanner(object):
+    """
+    Plan the history requests, which fill the gaps in the existing data. Only the sessions of the trading days (see trading_sessions) are requested and the parts,
+    which are already covered by the existing data, are skipped. The gaps in consecutive sessions are combined in one request, as long as the estimated number of rows is below max_rows.
+    Symbols with the same gaps are combined in one filter
+    """
+
+    def __init__(self, interval_len: int = None, interval_type: str = 's', bgn_time: datetime.time = datetime.time(9, 30), end_time: datetime.time = datetime.time(16, 0),
+                 tolerance: datetime.timedelta = datetime.timedelta(minutes=15), max_rows: int = 100000, ascend: bool = True, timeout: int = None):
+        """
+        :param interval_len: interval length of the bars. Ticks are requested if None
+        :param interval_type: interval type ('s' - time bars, 't' - tick bars, 'v' - volume bars)
+        :param bgn_time: start of each session (US/Eastern)
+        :param end_time: end of each session (US/Eastern)
+        :param tolerance: gaps, which are not longer than this, are ignored (for example, illiquid symbols without bars at the end of the session)
+        :param max_rows: maximum estimated number of rows of each request. The estimate is one row per bar interval for time bars and one row per second otherwise
+        :param ascend: ascending order of the data
+        :param timeout: timeout of each request
+        """
+        self.interval_len = interval_len
+        self.interval_type = interval_type
+        self.bgn_time = bgn_time
+        self.end_time = end_time
+        self.tolerance = tolerance
+        self.max_rows = max_rows
+        self.ascend = ascend
+        self.timeout = timeout
+
+        # the timestamp of each time bar is the end of the interval
+        self._interval = pd.Timedelta(seconds=interval_len).value if interval_len is not None and interval_type == 's' else 0
+        self._row_time = pd.Timedelta(seconds=interval_len if interval_len is not None and interval_type == 's' else 1).value
+
+    def sessions(self, bgn_prd: datetime.datetime, end_prd: datetime.datetime) -> pd.DataFrame:
+        return trading_sessions(bgn_prd=bgn_prd, end_prd=end_prd, bgn_time=self.bgn_time, end_time=self.end_time)
+
+    def gaps(self, sessions: pd.DataFrame, covered: list = None) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Parts of the sessions, which are not covered by the existing data
+        :param sessions: result of sessions
+        :param covered: list of (first, last) timestamps of the existing data (UTC if naive)
+        :return: int64 arrays of the begin and end (naive US/Eastern) of each gap and the index of its session
+        """
+        s_bgn = sessions['session_bgn'].values.astype(np.int64)
+        s_end = sessions['session_end'].values.astype(np.int64)
+
+        if covered:
+            c_bgn = _to_eastern([c[0] for c in covered]) - self._interval
+            c_end = _to_eastern([c[1] for c in covered])
+
+            # merge the overlapping coverage intervals
+            order = np.argsort(c_bgn, kind='mergesort')
+            c_bgn, c_end = c_bgn[order], c_end[order]
+
+            starts = np.ones(len(c_bgn), dtype=bool)
+            starts[1:] = c_bgn[1:] > np.maximum.accumulate(c_end)[:-1]
+            starts = np.flatnonzero(starts)
+
+            c_bgn, c_end = c_bgn[starts], np.maximum.reduceat(c_end, starts)
+
+            # complement of the coverage
+            u_bgn, u_end = np.concatenate([[_MIN], c_end]), np.concatenate([c_bgn, [_MAX]])
+        else:
+            u_bgn, u_end = np.array([_MIN]), np.array([_MAX])
+
+        # intersection of the sessions and the complement of the coverage
+        lo = np.searchsorted(u_end, s_bgn, side='right')
+        hi = np.searchsorted(u_bgn, s_end, side='left')
+        counts = np.maximum(hi - lo, 0)
+
+        session = np.repeat(np.arange(len(s_bgn)), counts)
+        u = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        bgn = np.maximum(s_bgn[session], u_bgn[u])
+        end = np.minimum(s_end[session], u_end[u])
+
+        duration = end - bgn
+        mask = (duration > pd.Timedelta(self.tolerance).value) & (duration >= max(self._interval, 1))
+
+        return bgn[mask], end[mask], session[mask]
+
+    def periods(self, sessions: pd.DataFrame, covered: list = None) -> typing.List[typing.Tuple[datetime.datetime, datetime.datetime]]:
+        """
+        Combine the gaps into request periods
+        :param sessions: result of sessions
+        :param covered: list of (first, last) timestamps of the existing data (UTC if naive)
+        :return: list of (bgn_prd, end_prd) periods (naive US/Eastern)
+        """
+        bgn, end, session = self.gaps(sessions, covered)
+
+        s_bgn = sessions['session_bgn'].values.astype(np.int64)
+        s_end = sessions['session_end'].values.astype(np.int64)
+
+        # gaps, which end with their session and are followed by a gap, which starts with the next session, are continuous
+        continuous = np.zeros(len(bgn), dtype=bool)
+        continuous[1:] = (end[:-1] == s_end[session[:-1]]) & (bgn[1:] == s_bgn[session[1:]]) & (session[1:] == session[:-1] + 1)
+
+        max_time = self.max_rows * self._row_time
+
+        result = list()
+        rows_time = 0
+        for b, e, c in zip(bgn.tolist(), end.tolist(), continuous.tolist()):
+            if c and rows_time + (e - b) <= max_time:
+                result[-1][1] = e
+                rows_time += e - b
+                continue
+
+            # gaps, which are longer than max_rows, are split
+            while e - b > max_time:
+                result.append([b, b + max_time])
+                b += max_time
+
+            result.append([b, e])
+            rows_time = e - b
+
+        return [(pd.Timestamp(b).to_pydatetime(), pd.Timestamp(e).to_pydatetime()) for b, e in result]
+
+    def plan(self, symbols: typing.Iterable[str], bgn_prd: datetime.datetime, end_prd: datetime.datetime = None, coverage: dict = None, group: bool = True) -> list:
+        """
+        Minimal list of filters, which fill the gaps in the existing data
+        :param symbols: symbols
+        :param bgn_prd: begin period (naive US/Eastern)
+        :param end_prd: end period (naive US/Eastern). Current time by default
+        :param coverage: dict of symbol -> list of (first, last) timestamps of the existing data (UTC if naive). See postgres_cache.request_coverage and coverage_from_ranges
+        :param group: combine symbols with the same gaps in one filter
+        :return: list of BarsInPeriodFilter (or TicksInPeriodFilter) ordered by period
+        """
+        if end_prd is None:
+            end_prd = pd.Timestamp.now(tz='US/Eastern').tz_localize(None).to_pydatetime()
+
+        coverage = coverage if coverage is not None else dict()
+        sessions = self.sessions(bgn_prd, end_prd)
+
+        # the symbols with the same coverage (for example, without data) share the periods
+        by_coverage = dict()
+        for s in symbols:
+            by_coverage.setdefault(tuple(coverage.get(s, list())), list()).append(s)
+
+        by_period = dict()
+        for covered, tickers in by_coverage.items():
+            for p in self.periods(sessions, list(covered)):
+                by_period.setdefault(p, list()).extend(tickers)
+
+        result = list()
+        for (bgn, end), tickers in sorted(by_period.items(), reverse=not self.ascend):
+            if group:
+                result.append(self._filter(sorted(tickers) if len(tickers) > 1 else tickers[0], bgn, end))
+            else:
+                result += [self._filter(t, bgn, end) for t in sorted(tickers)]
+
+        return result
+
+    def _filter(self, ticker: typing.Union[list, str], bgn_prd: datetime.datetime, end_prd: datetime.datetime):
+        if self.interval_len is None:
+            return TicksInPeriodFilter(ticker=ticker, bgn_prd=bgn_prd, end_prd=end_prd, bgn_flt=self.bgn_time, end_flt=self.end_time, ascend=self.ascend, timeout=self.timeout)
+
+        return BarsInPeriodFilter(ticker=ticker, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=bgn_prd, end_prd=end_prd, bgn_flt=self.bgn_time, end_flt=self.end_time,
+                                  ascend=self.ascend, timeout=self.timeout)
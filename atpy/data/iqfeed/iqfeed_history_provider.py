@@ -1,18 +1,22 @@
+import concurrent.futures
 import datetime
 import logging
 import queue
 import threading
+import time
 import typing
-from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 import pyiqfeed
 import pyiqfeed as iq
 from atpy.data.iqfeed.filters import *
+from atpy.data.iqfeed.iqfeed_history_cache import HistoryResponseCache
+from atpy.data.iqfeed.iqfeed_history_scheduler import HistoryConnectionPool, estimate_cost
 from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends
-from atpy.data.iqfeed.util import launch_service, IQFeedDataProvider
+from atpy.data.iqfeed.util import launch_service, IQFeedDataProvider, eastern_to_utc
 from atpy.data.ts_util import slice_periods
 from atpy.data.splits_dividends import adjust_df
 
@@ -182,43 +186,181 @@ class BarsMonthlyFilter(NamedTuple):
 BarsMonthlyFilter.__new__.__defaults__ = (True, None)
 
 
+def _fill_forward(values: np.ndarray, isnull: np.ndarray):
+    """
+    In-place forward fill of the null values along the time axis (axis 1) of a symbol x time array
+    :param values: 2-D array
+    :param isnull: null mask of the values
+    """
+    idx = np.where(isnull, -1, np.arange(values.shape[1]))
+    np.maximum.accumulate(idx, axis=1, out=idx)
+
+    fill = isnull & (idx >= 0)
+    values[fill] = np.take_along_axis(values, np.maximum(idx, 0), axis=1)[fill]
+    isnull &= ~fill
+
+
+def _fill_backward(values: np.ndarray, isnull: np.ndarray):
+    """
+    In-place backward fill of the null values along the time axis (axis 1) of a symbol x time array
+    :param values: 2-D array
+    :param isnull: null mask of the values
+    """
+    _fill_forward(values[:, ::-1], isnull[:, ::-1])
+
+
+def _fill_previous(values: np.ndarray, isnull: np.ndarray, previous: np.ndarray):
+    """
+    In-place fill of the null values of each symbol (row) with the last value of the symbol in the previous batch
+    :param values: 2-D array
+    :param isnull: null mask of the values
+    :param previous: 1-D array of the last values for each symbol
+    """
+    previous = np.broadcast_to(previous[:, np.newaxis], values.shape)
+    fill = isnull & ~pd.isnull(previous)
+    values[fill] = previous[fill]
+    isnull &= ~fill
+
+
+def _synchronize_bars(signals: dict, col: str, previous_batch: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Align the bars of multiple symbols to the same timestamps. Each column is a dense symbol x time array, where the missing values are
+    forward filled, then filled with the last values of the previous batch (if any) and then backward filled. Missing volume and number of trades are 0 and missing open/high/low are equal to the close
+    :param signals: dict of dataframes for each symbol (see _process_bars)
+    :param col: timestamp column
+    :param previous_batch: previous synchronized batch or None
+    :return: dataframe with symbol/timestamp multiindex
+    """
+    signals = pd.concat(signals.values(), ignore_index=True)
+
+    symbol_codes, symbols = pd.factorize(signals['symbol'], sort=True)
+    time_codes, times = pd.factorize(signals[col], sort=True)
+
+    times = pd.Index(times)
+    symbols = pd.Index(symbols)
+    shape = (len(symbols), len(times))
+
+    position = symbol_codes * shape[1] + time_codes
+    if len(np.unique(position)) < len(position):
+        raise Exception("Duplicate timestamps for the same symbol")
+
+    complete = len(position) == shape[0] * shape[1]
+
+    if 'open' in signals:
+        for symbol in symbols[np.unique(symbol_codes[signals['open'].values == 0])]:
+            logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column before timestamp sync")
+
+    columns = [c for c in signals.columns if c not in ('symbol', col)]
+    data = dict()
+    for c in columns:
+        values = signals[c].values
+
+        if complete:
+            dense = np.empty(shape[0] * shape[1], dtype=values.dtype)
+        elif values.dtype.kind == 'f':
+            dense = np.full(shape[0] * shape[1], np.nan, dtype=values.dtype)
+        elif values.dtype.kind in 'mM':
+            dense = np.full(shape[0] * shape[1], np.datetime64('NaT') if values.dtype.kind == 'M' else np.timedelta64('NaT'), dtype=values.dtype)
+        elif values.dtype.kind in 'iu':
+            dense = np.full(shape[0] * shape[1], np.nan, dtype=np.float64)
+        else:
+            dense = np.full(shape[0] * shape[1], np.nan, dtype=object)
+
+        dense[position] = values
+        data[c] = dense.reshape(shape)
+
+    isnull = {c: pd.isnull(v) for c, v in data.items()}
+
+    if previous_batch is not None and previous_batch.index.levels[0].equals(symbols):
+        previous = previous_batch.groupby(level=0).last()
+    else:
+        previous = None
+
+    for c in [c for c in ['volume', 'number_of_trades'] if c in data]:
+        data[c][isnull[c]] = 0
+        isnull[c][:] = False
+
+    if 'close' in data:
+        _fill_forward(data['close'], isnull['close'])
+
+        if previous is not None:
+            _fill_previous(data['close'], isnull['close'], previous['close'].values)
+
+        _fill_backward(data['close'], isnull['close'])
+
+        for c in [c for c in ['open', 'high', 'low'] if c in data]:
+            fill = isnull[c] & ~isnull['close']
+            data[c][fill] = data['close'][fill]
+            isnull[c] &= ~fill
+
+    for c in columns:
+        if isnull[c].any():
+            _fill_forward(data[c], isnull[c])
+
+            if previous is not None and c in previous:
+                _fill_previous(data[c], isnull[c], previous[c].values)
+
+            _fill_backward(data[c], isnull[c])
+
+    if 'open' in data:
+        for symbol in symbols[(data['open'] == 0).any(axis=1)]:
+            logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column after timestamp sync")
+
+    result = pd.DataFrame({c: v.ravel() for c, v in data.items()}, columns=columns)
+    result.insert(0, 'symbol', symbols.values.repeat(shape[1]))
+    result.insert(1, col, times[np.tile(np.arange(shape[1]), shape[0])])
+    result.index = pd.MultiIndex.from_product([symbols, times], names=['symbol', col])
+
+    return result
+
+
 class IQFeedHistoryProvider(object):
     """
     IQFeed historical data provider. See the unit test on how to use
     """
 
-    def __init__(self, num_connections=10, key_suffix=''):
+    def __init__(self, num_connections=10, key_suffix='', min_connections=1, conn_factory=None, max_retries=3, cache: HistoryResponseCache = None):
         """
-        :param num_connections: number of connections to use when requesting data
+        :param num_connections: maximum number of connections to use when requesting data
         :param key_suffix: suffix for field names
+        :param min_connections: minimum number of connections. The pool grows up to num_connections, when there are many pending requests
+        :param conn_factory: callable, which returns a new HistoryConn (iq.HistoryConn by default, which requires the IQFeed service)
+        :param max_retries: maximum number of retries of failed requests
+        :param cache: HistoryResponseCache for the responses of closed periods (no caching by default)
         """
         self.num_connections = num_connections
+        self.min_connections = min_connections
         self.key_suffix = key_suffix
-        self.conn = None
+        self.conn_factory = conn_factory
+        self.max_retries = max_retries
+        self.cache = cache
+        self.pool = None
         self.current_batch = None
         self.current_filter = None
 
     def __enter__(self):
-        launch_service()
+        if self.conn_factory is None:
+            launch_service()
 
-        self.conn = [iq.HistoryConn() for _ in range(self.num_connections)]
-        for c in self.conn:
-            c.connect()
+        self.pool = HistoryConnectionPool(conn_factory=self.conn_factory if self.conn_factory is not None else iq.HistoryConn, min_connections=self.min_connections, max_connections=self.num_connections,
+                                          max_retries=self.max_retries)
 
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        for c in self.conn:
-            c.disconnect()
-
-        self.conn = None
+        self.pool.close()
+        self.pool = None
 
     def __del__(self):
-        if self.conn is not None:
-            for c in self.conn:
-                c.disconnect()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
-            self.conn = None
+    def connection_stats(self) -> pd.DataFrame:
+        """
+        :return: dataframe with the number of requests, retries, failures, steals, rows and throughput of each connection
+        """
+        return self.pool.stats()
 
     def request_data(self, f, sync_timestamps=True):
         """
@@ -227,78 +369,192 @@ class IQFeedHistoryProvider(object):
         :param sync_timestamps: synchronize timestamps between symbols
         :return:
         """
+        return self._combine_signals(self._request_signals(f), f, sync_timestamps=sync_timestamps)
+
+    def _request_signals(self, f):
+        """
+        request the data of each symbol without combining them. This is the part of request_data, which doesn't depend on the previous batch
+        :param f: filter tuple
+        :return: dataframe (single ticker), dict of symbol -> dataframe (list of tickers) or None
+        """
         if isinstance(f.ticker, str):
-            data = self.request_raw_symbol_data(f, self.conn[0])
+            data = self.pool.request(self._request_raw_data, f)
             if data is None:
                 logging.getLogger(__name__).warning("No data found for filter: " + str(f))
                 return
 
-            data = self._process_data(data, f)
-
-            return data
+            return self._process_data(data, f)
         elif isinstance(f.ticker, list):
             q = queue.Queue()
             self.request_data_by_filters([f._replace(ticker=t) for t in f.ticker], q)
 
-            signals = {d[0].ticker: d[1] for d in iter(q.get, None)}
+            return {d[0].ticker: d[1] for d in iter(q.get, None)}
 
-            if sync_timestamps:
-                signals = self.synchronize_timestamps(signals, f)
+    def _combine_signals(self, signals, f, sync_timestamps=True):
+        """
+        synchronize and combine the result of _request_signals
+        :param signals: result of _request_signals
+        :param f: filter tuple
+        :param sync_timestamps: synchronize timestamps between symbols
+        :return:
+        """
+        if not isinstance(signals, dict):
+            return signals
 
-            if isinstance(signals, dict) and len(signals) > 0:
-                signals = pd.concat(signals)
-                signals.index.set_names('symbol', level=0, inplace=True)
-                signals.sort_index(inplace=True, ascending=f.ascend)
+        if sync_timestamps:
+            signals = self.synchronize_timestamps(signals, f)
 
-            return signals if len(signals) > 0 else None
+        return self._concat_signals(signals, f)
 
-    def request_data_by_filters(self, filters: list, q: queue.Queue):
+    def request_data_stream(self, f, max_pending: int = None):
         """
-        request data for multiple filters
+        request history data for multiple symbols and yield the data of each symbol as soon as its request completes.
+        At most max_pending results are requested ahead of the consumer, so that large universes are downloaded in bounded memory
+        :param f: filter tuple with list of tickers
+        :param max_pending: maximum number of requests in progress or waiting to be consumed (2 * num_connections by default)
+        :return: generator of (filter, dataframe) tuples in the order of completion. The filter has a single ticker. Symbols without data are skipped
+        """
+        tickers = f.ticker if isinstance(f.ticker, list) else [f.ticker]
+
+        for _, ft, data in self._request_stream([f._replace(ticker=t) for t in tickers], max_pending=max_pending):
+            if data is not None:
+                yield ft, data
+
+    def request_synchronized_windows(self, f, window: typing.Union[relativedelta, datetime.timedelta], sync_timestamps=True, max_pending: int = None):
+        """
+        request history data for multiple symbols in consecutive time windows and yield each window as soon as the data of all symbols for this window is available.
+        The windows are requested in order (chronological if f.ascend, reverse chronological otherwise). The timestamps of the bars of each window are synchronized
+        and the missing values at the beginning of the window are filled from the previous window
+        :param f: TicksInPeriodFilter or BarsInPeriodFilter with list of tickers. If f.end_prd is None, the data is requested until now
+        :param window: window length
+        :param sync_timestamps: synchronize timestamps between symbols
+        :param max_pending: maximum number of requests in progress or waiting to be consumed (2 * num_connections by default)
+        :return: generator of (window filter, dataframe) tuples
+        """
+        if not isinstance(f, (TicksInPeriodFilter, BarsInPeriodFilter)):
+            raise Exception("Synchronized windows are supported only for TicksInPeriodFilter and BarsInPeriodFilter")
+
+        tickers = f.ticker if isinstance(f.ticker, list) else [f.ticker]
+        end_prd = f.end_prd if f.end_prd is not None else datetime.datetime.now()
+
+        # consecutive windows don't overlap (the periods of IQFeed are inclusive and have 1 second resolution)
+        windows = list()
+        bgn_prd = f.bgn_prd
+        while bgn_prd <= end_prd:
+            windows.append(f._replace(bgn_prd=bgn_prd, end_prd=min(bgn_prd + window - datetime.timedelta(seconds=1), end_prd)))
+            bgn_prd = bgn_prd + window
+
+        if not f.ascend:
+            windows.reverse()
+
+        filters = [w._replace(ticker=t) for w in windows for t in tickers]
+        remaining = [len(tickers)] * len(windows)
+        signals = [dict() for _ in windows]
+        previous_batch = None
+        current = 0
+
+        for i, ft, data in self._request_stream(filters, max_pending=max_pending, largest_first=False):
+            w = i // len(tickers)
+            if data is not None:
+                signals[w][ft.ticker] = data
+
+            remaining[w] -= 1
+
+            while current < len(windows) and remaining[current] == 0:
+                result, signals[current] = signals[current], None
+
+                if sync_timestamps:
+                    result = self._synchronize_timestamps(result, windows[current], previous_batch)
+
+                result = self._concat_signals(result, windows[current])
+
+                if result is not None:
+                    previous_batch = result
+                    yield windows[current], result
+
+                current += 1
+
+    def _request_stream(self, filters: list, max_pending: int = None, largest_first: bool = True):
+        """
+        request data for multiple filters using the connection pool
         :param filters: list of filters
-        :param q: queue to populate the results as they come. When all the results are returned, None is inserted to signal that no more are coming.
-        :return: None
+        :param max_pending: maximum number of requests in progress or waiting to be consumed (2 * num_connections by default)
+        :param largest_first: dispatch the requests in order of decreasing estimated cost. Otherwise they are dispatched in the order of the filters
+        :return: generator of (index of the filter, filter, processed data or None) tuples in the order of completion
         """
+        max_pending = max_pending if max_pending is not None else 2 * self.num_connections
 
-        self._global_counter = 0
-        self._global_not_found_counter = 0
+        results = queue.Queue()
+        slots = threading.Semaphore(max_pending)
+        stopped = threading.Event()
 
-        lock = threading.Lock()
-        no_data = set()
+        def process(ft, conn):
+            raw_data = self._request_raw_data(ft, conn)
+            return self._process_data(raw_data, ft) if raw_data is not None else None
 
-        def mp_worker(p):
-            ft, conn = p
+        order = list(range(len(filters)))
+        costs = [estimate_cost(ft) for ft in filters]
+        if largest_first:
+            order.sort(key=lambda i: -costs[i])
 
-            try:
-                raw_data = self.request_raw_symbol_data(ft, conn)
-                if raw_data is not None:
-                    q.put((ft, self._process_data(raw_data, ft)))
-            except Exception as err:
-                raw_data = None
-                logging.getLogger(__name__).exception(err)
-
-            if raw_data is not None:
-                with lock:
-                    self._global_counter += 1
-                    if self._global_counter % 20 == 0 or self._global_counter == len(filters):
-                        log = "Found " + str(self._global_counter)
-                        if len(no_data) > 0:
-                            no_data_list = list(no_data)
-                            no_data_list.sort()
-                            log += "; not found " + str(len(no_data_list)) + " (total " + str(self._global_not_found_counter) + "): " + str(no_data_list)
-                            no_data.clear()
-
-                        logging.getLogger(__name__).info(log)
-            else:
-                self._global_not_found_counter += 1
-                no_data.add(ft.ticker)
+        def dispatch():
+            for i in order:
+                slots.acquire()
+                if stopped.is_set():
+                    break
+
+                try:
+                    self.pool.submit(process, filters[i], cost=costs[i], callback=lambda ft, data, error, i=i: results.put((i, ft, data)))
+                except Exception as err:
+                    logging.getLogger(__name__).exception(err)
+                    results.put((i, filters[i], None))
 
-        pool = ThreadPool(self.num_connections)
-        pool.map(mp_worker, ((f, self.conn[i % self.num_connections]) for i, f in enumerate(filters)))
-        pool.close()
+        threading.Thread(target=dispatch, daemon=True).start()
+
+        found, not_found, no_data = 0, 0, set()
+
+        def log_progress():
+            log = "Found " + str(found)
+            if len(no_data) > 0:
+                log += "; not found " + str(len(no_data)) + " (total " + str(not_found) + "): " + str(sorted(no_data))
+                no_data.clear()
+
+            logging.getLogger(__name__).info(log)
+
+        try:
+            for _ in range(len(filters)):
+                result = results.get()
+                slots.release()
 
-        del self._global_counter
-        del self._global_not_found_counter
+                if result[2] is None:
+                    not_found += 1
+                    no_data.add(result[1].ticker)
+                else:
+                    found += 1
+
+                # periodic progress with the symbols without data since the last log
+                if (result[2] is not None and found % 20 == 0) or found + not_found == len(filters):
+                    log_progress()
+
+                yield result
+        finally:
+            # unblock the dispatcher, if the consumer stops early
+            stopped.set()
+            slots.release()
+
+            if found + not_found < len(filters):
+                log_progress()
+
+    def request_data_by_filters(self, filters: list, q: queue.Queue):
+        """
+        request data for multiple filters
+        :param filters: list of filters
+        :param q: queue to populate the results as they come. When all the results are returned, None is inserted to signal that no more are coming.
+        :return: None
+        """
+        for _, ft, data in self._request_stream(filters, max_pending=len(filters)):
+            if data is not None:
+                q.put((ft, data))
 
         q.put(None)
 
@@ -309,6 +565,20 @@ class IQFeedHistoryProvider(object):
         :param f: filter tuple
         :return:
         """
+        previous_batch = None
+        if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None:
+            previous_batch = self.current_batch
+
+        return self._synchronize_timestamps(signals, f, previous_batch)
+
+    def _synchronize_timestamps(self, signals: map, f: NamedTuple, previous_batch: pd.DataFrame = None):
+        """
+        synchronize timestamps between historical signals
+        :param signals: map of dataframes for each equity
+        :param f: filter tuple
+        :param previous_batch: previous synchronized batch. The missing values at the beginning of the current batch are filled from it (ascending filters only)
+        :return:
+        """
         if signals is None or len(signals) <= 1:
             result = signals
         elif 'tick_id' + self.key_suffix in iter(signals.values()).__next__():
@@ -320,60 +590,29 @@ class IQFeedHistoryProvider(object):
         else:
             col = 'timestamp' + self.key_suffix if 'timestamp' + self.key_suffix in list(signals.values())[0] else 'date' + self.key_suffix if 'date' + self.key_suffix in list(signals.values())[0] else None
             if col is not None:
-                signals = pd.concat(signals)
-                signals.index.set_names('symbol', level=0, inplace=True)
-
-                for symbol in signals.index.levels[0].unique():
-                    if 0 in signals.loc[symbol, 'open'].values:
-                        logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column before timestamp sync")
-
-                multi_index = pd.MultiIndex.from_product([signals['symbol'].unique(), signals[col].unique()], names=['symbol', col]).sort_values()
-
-                signals = signals.reindex(multi_index)
-                signals.drop(['symbol', col], axis=1, inplace=True)
-                signals.reset_index(inplace=True)
-                signals.set_index(multi_index, inplace=True)
-
-                for c in [c for c in ['volume', 'number_of_trades'] if c in signals.columns]:
-                    signals[c].fillna(0, inplace=True)
-
-                if 'close' in signals.columns:
-                    signals['close'] = signals.groupby(level=0)['close'].fillna(method='ffill')
-
-                    if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
-                        last = self.current_batch.groupby(level=0)['close'].last()
-                        signals['close'] = signals.groupby(level=0)['close'].apply(lambda x: x.fillna(last[last.index.get_loc(x.name)]))
-
-                    signals['close'] = signals.groupby(level=0)['close'].fillna(method='backfill')
-
-                    op = signals['close']
-
-                    for c in [c for c in ['open', 'high', 'low'] if c in signals.columns]:
-                        signals[c].fillna(op, inplace=True)
-
-                signals = signals.groupby(level=0).fillna(method='ffill')
-
-                if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
-                    last = self.current_batch.groupby(level=0).last()
-                    signals = signals.groupby(level=0).apply(lambda x: x.fillna(last.iloc[last.index.get_loc(x.name)]))
+                result = _synchronize_bars(signals, col, previous_batch if f.ascend is True else None)
 
-                signals = signals.groupby(level=0).fillna(method='backfill')
+                if not f.ascend:
+                    result = result.iloc[::-1]
 
-                zero_values = list()
+            logging.getLogger(__name__).info("Generated data of shape: " + str(result.shape))
 
-                for symbol in signals.index.levels[0].unique():
-                    if 0 in signals.loc[symbol, 'open'].values:
-                        logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column after timestamp sync")
-                        zero_values.append(symbol)
+        return result
 
-                if not f.ascend:
-                    signals.sort_index(level=['symbol', col], inplace=True, ascending=False)
+    @staticmethod
+    def _concat_signals(signals, f: NamedTuple):
+        if isinstance(signals, dict) and len(signals) > 0:
+            signals = pd.concat(signals)
+            signals.index.set_names('symbol', level=0, inplace=True)
+            signals.sort_index(inplace=True, ascending=f.ascend)
 
-                result = signals
+        return signals if len(signals) > 0 else None
 
-            logging.getLogger(__name__).info("Generated data of shape: " + str(result.shape))
+    def _request_raw_data(self, f, conn):
+        if self.cache is None:
+            return self.request_raw_symbol_data(f, conn)
 
-        return result
+        return self.cache.request(f, lambda: self.request_raw_symbol_data(f, conn))
 
     @staticmethod
     def request_raw_symbol_data(f, conn):
@@ -420,33 +659,28 @@ class IQFeedHistoryProvider(object):
             return self._process_daily(data, data_filter)
 
     def _process_ticks(self, data, data_filter):
-        result = pd.DataFrame(data)
-        sf = self.key_suffix
-
-        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
-        result.set_index('timestamp' + sf, inplace=True, drop=False)
-        result.drop(['date', 'time'], axis=1, inplace=True)
-
-        result.rename(
-            {"last": "last" + sf, "last_sz": "last_size" + sf, "tot_vlm": "total_volume" + sf, "bid": "bid" + sf, "ask": "ask" + sf, "tick_id": "tick_id" + sf, "last_type": "basis_for_last" + sf, "mkt_ctr": "trade_market_center" + sf},
-            axis="columns", copy=False, inplace=True)
-        result['symbol'] = data_filter.ticker
-
-        return result
+        return self._records_to_df(data, data_filter, {"last": "last", "last_sz": "last_size", "tot_vlm": "total_volume", "bid": "bid", "ask": "ask", "tick_id": "tick_id", "last_type": "basis_for_last", "mkt_ctr": "trade_market_center"})
 
     def _process_bars(self, data, data_filter):
-        result = pd.DataFrame(data)
+        return self._records_to_df(data, data_filter, {"high_p": "high", "low_p": "low", "open_p": "open", "close_p": "close", "tot_vlm": "total_volume", "prd_vlm": "volume", "num_trds": "number_of_trades"})
+
+    def _records_to_df(self, data, data_filter, names: dict):
+        """
+        Convert pyiqfeed structured array with date and time fields to dataframe. Each field is mapped to a renamed column
+        :param data: structured array
+        :param data_filter: filter
+        :param names: dict of field name -> column name (without suffix). The suffix is added only to the renamed columns
+        :return: dataframe with UTC timestamp index
+        """
         sf = self.key_suffix
 
-        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
-        result.set_index('timestamp' + sf, inplace=True, drop=False)
-        result.drop(['date', 'time'], axis=1, inplace=True)
+        timestamp = eastern_to_utc(data['date'] + data['time'])
 
-        result.rename({"high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "tot_vlm": "total_volume" + sf, "prd_vlm": "volume" + sf, "num_trds": "number_of_trades" + sf}, axis="columns",
-                      copy=False, inplace=True)
-        result['symbol'] = data_filter.ticker
+        columns = {names[n] + sf if n in names else n: data[n] for n in data.dtype.names if n not in ('date', 'time')}
+        columns['timestamp' + sf] = timestamp
+        columns['symbol'] = data_filter.ticker
 
-        return result
+        return pd.DataFrame(columns, index=timestamp.rename('timestamp' + sf))
 
     def _process_daily(self, data, data_filter):
         result = pd.DataFrame(data)
@@ -477,7 +711,8 @@ class IQFeedHistoryEvents(IQFeedHistoryProvider):
     IQFeed historical data events. See the unit test on how to use
     """
 
-    def __init__(self, listeners, fire_batches=False, run_async=True, num_connections=10, key_suffix='', filter_provider=None, sync_timestamps=True, adjust_data=True, timestamp_first=False):
+    def __init__(self, listeners, fire_batches=False, run_async=True, num_connections=10, key_suffix='', filter_provider=None, sync_timestamps=True, adjust_data=True, timestamp_first=False, cache: HistoryResponseCache = None,
+                 min_connections=1, conn_factory=None, adjustments_ttl: float = 3600):
         """
         :param listeners: event listeners
         :param fire_batches: raise event for each batch
@@ -488,8 +723,12 @@ class IQFeedHistoryEvents(IQFeedHistoryProvider):
         :param sync_timestamps: synchronize timestamps for each symbol
         :param adjust_data: adjust data
         :param timestamp_first: timestamp/symbol multiindex (symbol/timestamp) by default
+        :param cache: HistoryResponseCache for the responses of closed periods (no caching by default)
+        :param min_connections: minimum number of connections. The pool grows up to num_connections, when there are many pending requests
+        :param conn_factory: callable, which returns a new HistoryConn (iq.HistoryConn by default, which requires the IQFeed service)
+        :param adjustments_ttl: the splits/dividends of each symbol set are cached for the session and refreshed in the background after this many seconds
         """
-        super().__init__(num_connections=num_connections, key_suffix=key_suffix)
+        super().__init__(num_connections=num_connections, key_suffix=key_suffix, min_connections=min_connections, conn_factory=conn_factory, cache=cache)
 
         self.listeners = listeners
         self.fire_batches = fire_batches
@@ -501,13 +740,18 @@ class IQFeedHistoryEvents(IQFeedHistoryProvider):
         self.adjust_data = adjust_data
         self.timestamp_first = timestamp_first
         self.streaming_conn = None
+        self.adjustments_ttl = adjustments_ttl
+
+        # symbol set -> {'future', 'time', 'refresh'}
+        self._adjustments = dict()
+        self._adjustments_lock = threading.Lock()
+        self._fundamentals_executor = None
 
     def __enter__(self):
         super().__enter__()
 
-        # streaming conn for fundamental data
-        self.streaming_conn = iq.QuoteConn()
-        self.streaming_conn.connect()
+        # single thread for the fundamental data requests, which share the streaming conn
+        self._fundamentals_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
         return self
 
@@ -522,6 +766,14 @@ class IQFeedHistoryEvents(IQFeedHistoryProvider):
 
         self.listeners({'type': 'no_data'})
 
+        if self._fundamentals_executor is not None:
+            self._fundamentals_executor.shutdown(wait=True)
+            self._fundamentals_executor = None
+
+        if self.streaming_conn is not None:
+            self.streaming_conn.disconnect()
+            self.streaming_conn = None
+
         super().__exit__(exception_type, exception_value, traceback)
 
     def start(self):
@@ -550,32 +802,144 @@ class IQFeedHistoryEvents(IQFeedHistoryProvider):
                 self.listeners({'type': 'no_data'})
 
     def next_batch(self):
-        for f in self.filter_provider:
-            logging.getLogger(__name__).info("Loading data for filter " + str(f))
+        """
+        Two stage pipeline. A background thread requests the history data of the next filter, while the current batch is synchronized, adjusted and consumed.
+        The splits/dividends of each symbol set are requested in parallel with the first history request of the set and are cached for the session
+        """
+        batches = queue.Queue(maxsize=1)
+        stopped = threading.Event()
 
-            d = self.request_data(f, sync_timestamps=self.sync_timestamps)
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
 
-            if d is None:
-                break
+            return False
 
-            if isinstance(d.index, pd.MultiIndex) and (self.adjust_data or self.timestamp_first):
-                d = d.swaplevel(0, 1)
-                d.sort_index(inplace=True)
+        def produce():
+            try:
+                for f in self.filter_provider:
+                    if self.adjust_data:
+                        self._adjustments_future(f.ticker)
 
-            if self.adjust_data:
-                adjustments = get_splits_dividends(symbol=f.ticker, conn=self.streaming_conn)
-                adjust_df(data=d, adjustments=adjustments)
+                    logging.getLogger(__name__).info("Loading data for filter " + str(f))
 
-                if isinstance(d.index, pd.MultiIndex) and not self.timestamp_first:
+                    signals = self._request_signals(f)
+                    if not put((f, signals)) or signals is None:
+                        return
+            except Exception as err:
+                put((None, err))
+                return
+
+            put((None, None))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                f, signals = batches.get()
+                if f is None:
+                    if signals is not None:
+                        raise signals
+
+                    break
+
+                # the synchronization depends on the previous batch, therefore it's not part of the background stage
+                d = self._combine_signals(signals, f, sync_timestamps=self.sync_timestamps)
+
+                if d is None:
+                    break
+
+                if isinstance(d.index, pd.MultiIndex) and (self.adjust_data or self.timestamp_first):
                     d = d.swaplevel(0, 1)
+                    d.sort_index(inplace=True)
+
+                if self.adjust_data:
+                    adjust_df(data=d, adjustments=self._get_adjustments(f.ticker))
+
+                    if isinstance(d.index, pd.MultiIndex) and not self.timestamp_first:
+                        d = d.swaplevel(0, 1)
 
-            self.current_filter = f
-            self.current_batch = d
+                self.current_filter = f
+                self.current_batch = d
 
-            yield d, f
+                yield d, f
+        finally:
+            stopped.set()
 
         self.listeners({'type': 'no_data'})
 
+    def _fetch_adjustments(self, ticker: typing.Union[list, str]) -> pd.DataFrame:
+        """
+        request the splits/dividends (executed in the fundamentals thread)
+        :param ticker: symbol or list of symbols
+        :return: dataframe in the format of get_splits_dividends
+        """
+        if self.streaming_conn is None:
+            self.streaming_conn = iq.QuoteConn()
+            self.streaming_conn.connect()
+
+        return get_splits_dividends(symbol=ticker, conn=self.streaming_conn)
+
+    def _adjustments_future(self, ticker: typing.Union[list, str]) -> concurrent.futures.Future:
+        """
+        cached splits/dividends of the symbol set. The first call requests the data and the calls after adjustments_ttl refresh it in the background,
+        while the previous value is still in use
+        :param ticker: symbol or list of symbols
+        :return: future with the splits/dividends
+        """
+        key = ticker if isinstance(ticker, str) else frozenset(ticker)
+
+        refresh = None
+
+        with self._adjustments_lock:
+            entry = self._adjustments.get(key)
+
+            if entry is None:
+                entry = {'future': self._fundamentals_executor.submit(self._fetch_adjustments, ticker), 'time': time.time(), 'refresh': None}
+                self._adjustments[key] = entry
+            elif entry['refresh'] is None and time.time() - entry['time'] > self.adjustments_ttl:
+                refresh = entry['refresh'] = self._fundamentals_executor.submit(self._fetch_adjustments, ticker)
+
+            result = entry['future']
+
+        if refresh is not None:
+            def refreshed(future):
+                with self._adjustments_lock:
+                    if future.exception() is None:
+                        entry['future'], entry['time'] = future, time.time()
+                    else:
+                        logging.getLogger(__name__).error("Failed to refresh splits/dividends: " + str(future.exception()))
+
+                    entry['refresh'] = None
+
+            # outside of the lock, because the callback is executed in this thread if the refresh is already done
+            refresh.add_done_callback(refreshed)
+
+        return result
+
+    def _get_adjustments(self, ticker: typing.Union[list, str]) -> pd.DataFrame:
+        """
+        :param ticker: symbol or list of symbols
+        :return: cached splits/dividends of the symbol set
+        """
+        future = self._adjustments_future(ticker)
+
+        try:
+            return future.result()
+        except Exception:
+            # the next batch tries again
+            with self._adjustments_lock:
+                key = ticker if isinstance(ticker, str) else frozenset(ticker)
+                if key in self._adjustments and self._adjustments[key]['future'] is future:
+                    del self._adjustments[key]
+
+            raise
+
     def stop(self):
         self._is_running = False
 
@@ -0,0 +1,354 @@
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+import typing
+
+import pandas as pd
+
+# fraction of the calendar time, when the regular session is open
+_TRADING_TIME = 6.5 / 24 * 5 / 7
+
+
+def estimate_cost(f: typing.NamedTuple) -> float:
+    """
+    Rough estimate of the number of rows, returned by a history request. It is used to order the requests (largest first)
+    :param f: history filter with a single ticker
+    :return: estimated number of rows
+    """
+    fields = f._fields
+    ticks = 'interval_len' not in fields and 'max_ticks' in fields
+    intraday = 'interval_len' in fields or ticks
+
+    if 'bgn_prd' in fields:
+        end_prd = f.end_prd if f.end_prd is not None else datetime.datetime.now(tz=f.bgn_prd.tzinfo)
+        span = (end_prd - f.bgn_prd).total_seconds()
+    elif 'bgn_dt' in fields:
+        end_dt = f.end_dt if f.end_dt is not None else datetime.date.today()
+        span = (end_dt - f.bgn_dt).days * 86400
+    elif 'num_days' in fields:
+        span = f.num_days * 86400
+    elif 'days' in fields:
+        span = f.days * 86400
+    elif 'num_weeks' in fields:
+        span = f.num_weeks * 7 * 86400
+    elif 'num_months' in fields:
+        span = f.num_months * 30 * 86400
+    else:
+        span = None
+
+    if span is None:
+        result = 100000
+    elif ticks:
+        # 1 tick per second on average
+        result = span * _TRADING_TIME
+    elif intraday:
+        result = span * _TRADING_TIME / (f.interval_len if f.interval_type == 's' else 60)
+    elif 'num_weeks' in fields:
+        result = f.num_weeks
+    elif 'num_months' in fields:
+        result = f.num_months
+    else:
+        result = span / 86400
+
+    limit = getattr(f, 'max_ticks', None) or getattr(f, 'max_bars', None) or getattr(f, 'max_days', None)
+
+    return max(min(result, limit) if limit else result, 1)
+
+
+class _Worker(object):
+    """
+    Connection with its own queue of tasks and statistics
+    """
+
+    def __init__(self, worker_id: int):
+        self.id = worker_id
+        self.conn = None
+        self.queue = list()
+        self.load = 0
+        self.thread = None
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.steals = 0
+        self.rows = 0
+        self.busy_time = 0.0
+
+
+class HistoryConnectionPool(object):
+    """
+    Pool of history connections with a cost-aware scheduler. Each connection is served by its own thread, which has a queue of tasks ordered by cost (largest first).
+    New tasks go to the connection with the smallest load (queued and running cost) and idle connections steal tasks from the most loaded ones.
+    New connections are opened, when there are more than grow_threshold queued tasks per connection, and connections are closed after idle_timeout seconds without work.
+    Tasks, which fail with a connection or timeout error (retry_errors), are retried with exponential backoff on a new connection. Other errors fail the task immediately
+    """
+
+    def __init__(self, conn_factory: typing.Callable, min_connections: int = 1, max_connections: int = 10, grow_threshold: float = 2, idle_timeout: float = 10, max_retries: int = 3, backoff: float = 0.5,
+                 retry_errors: tuple = (OSError,)):
+        """
+        :param conn_factory: callable, which returns a new (not connected) connection, for example pyiqfeed.HistoryConn
+        :param min_connections: minimum number of connections, which are kept open
+        :param max_connections: maximum number of connections
+        :param grow_threshold: open a new connection, if the number of queued tasks per connection exceeds this
+        :param idle_timeout: close idle connections (above min_connections) after this many seconds
+        :param max_retries: maximum number of retries of each task
+        :param backoff: delay before the first retry in seconds. The delay doubles with each retry
+        :param retry_errors: exception types, which are retried (OSError covers ConnectionError and socket.timeout). Any other exception fails the task without retry
+        """
+        self.conn_factory = conn_factory
+        self.min_connections = max(min(min_connections, max_connections), 1)
+        self.max_connections = max_connections
+        self.grow_threshold = grow_threshold
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_errors = retry_errors
+
+        self._cond = threading.Condition()
+        self._workers = list()
+        self._all_workers = list()
+        self._pending = 0
+        self._counter = itertools.count()
+        self._closed = False
+
+        with self._cond:
+            for _ in range(self.min_connections):
+                self._add_worker()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    @property
+    def num_connections(self) -> int:
+        with self._cond:
+            return len(self._workers)
+
+    def submit(self, fn: typing.Callable, task, cost: float = None, callback: typing.Callable = None):
+        """
+        Schedule a task
+        :param fn: function(task, conn), which executes the task
+        :param task: task (for example history filter)
+        :param cost: cost of the task (estimate_cost(task) by default)
+        :param callback: function(task, result, error), which is called in the worker thread when the task is done. error is None if the task succeeded
+        """
+        cost = cost if cost is not None else estimate_cost(task)
+
+        with self._cond:
+            if self._closed:
+                raise Exception("The pool is closed")
+
+            if len(self._workers) < self.max_connections and (len(self._workers) == 0 or self._pending + 1 > self.grow_threshold * len(self._workers)):
+                self._add_worker()
+
+            target = min(self._workers, key=lambda w: w.load)
+            heapq.heappush(target.queue, (-cost, next(self._counter), fn, task, callback))
+            target.load += cost
+            self._pending += 1
+
+            self._cond.notify_all()
+
+    def request(self, fn: typing.Callable, task, cost: float = None):
+        """
+        Execute a task and wait for the result
+        :param fn: function(task, conn), which executes the task
+        :param task: task (for example history filter)
+        :param cost: cost of the task (estimate_cost(task) by default)
+        :return: result of fn
+        """
+        done = threading.Event()
+        outcome = dict()
+
+        def callback(_, result, error):
+            outcome['result'], outcome['error'] = result, error
+            done.set()
+
+        self.submit(fn, task, cost=cost, callback=callback)
+        done.wait()
+
+        if outcome['error'] is not None:
+            raise outcome['error']
+
+        return outcome['result']
+
+    def stats(self) -> pd.DataFrame:
+        """
+        :return: dataframe with the statistics of each connection (including the closed ones)
+        """
+        with self._cond:
+            result = pd.DataFrame([{'connection': w.id, 'active': w in self._workers, 'requests': w.requests, 'retries': w.retries, 'failures': w.failures, 'steals': w.steals,
+                                    'rows': w.rows, 'busy_time': w.busy_time} for w in self._all_workers],
+                                  columns=['connection', 'active', 'requests', 'retries', 'failures', 'steals', 'rows', 'busy_time'])
+
+        result.set_index('connection', inplace=True)
+        busy = result['busy_time'].where(result['busy_time'] > 0)
+        result['requests_per_second'] = (result['requests'] / busy).fillna(0)
+        result['rows_per_second'] = (result['rows'] / busy).fillna(0)
+
+        return result
+
+    def close(self):
+        """
+        Close all connections. The running tasks are completed and the queued ones fail
+        """
+        with self._cond:
+            self._closed = True
+            threads = [w.thread for w in self._workers]
+
+            for w in self._workers:
+                self._fail(w.queue, Exception("The pool is closed"))
+                w.queue, w.load = list(), 0
+
+            self._pending = 0
+            self._cond.notify_all()
+
+        for t in threads:
+            if t is not threading.current_thread():
+                t.join()
+
+    def _add_worker(self):
+        worker = _Worker(len(self._all_workers))
+        worker.thread = threading.Thread(target=self._work, args=(worker,), daemon=True)
+
+        self._workers.append(worker)
+        self._all_workers.append(worker)
+
+        worker.thread.start()
+
+    def _remove_worker(self, worker: _Worker):
+        if worker in self._workers:
+            self._workers.remove(worker)
+
+        # the queued tasks go to the other connections
+        for item in worker.queue:
+            if len(self._workers) > 0:
+                target = min(self._workers, key=lambda w: w.load)
+                heapq.heappush(target.queue, item)
+                target.load += -item[0]
+            else:
+                self._pending -= 1
+                self._fail([item], Exception("No available connections"))
+
+        worker.queue, worker.load = list(), 0
+        self._cond.notify_all()
+
+    @staticmethod
+    def _fail(items: list, error: Exception):
+        for _, _, _, task, callback in items:
+            if callback is not None:
+                callback(task, None, error)
+
+    def _next(self, worker: _Worker):
+        if len(worker.queue) > 0:
+            item = heapq.heappop(worker.queue)
+        else:
+            victims = [w for w in self._workers if w is not worker and len(w.queue) > 0]
+            if len(victims) == 0:
+                return None
+
+            victim = max(victims, key=lambda w: w.load)
+            item = heapq.heappop(victim.queue)
+            victim.load -= -item[0]
+            worker.load += -item[0]
+            worker.steals += 1
+
+        self._pending -= 1
+
+        return item
+
+    def _connect(self, worker: _Worker):
+        if worker.conn is not None:
+            try:
+                worker.conn.disconnect()
+            except Exception as err:
+                logging.getLogger(__name__).exception(err)
+
+            worker.conn = None
+
+        conn = self.conn_factory()
+        conn.connect()
+        worker.conn = conn
+
+    def _work(self, worker: _Worker):
+        try:
+            self._connect(worker)
+        except Exception as err:
+            logging.getLogger(__name__).exception(err)
+
+            with self._cond:
+                self._remove_worker(worker)
+
+            return
+
+        try:
+            while True:
+                with self._cond:
+                    item = self._next(worker)
+                    while item is None:
+                        if self._closed:
+                            return
+
+                        idle = not self._cond.wait(timeout=self.idle_timeout)
+                        item = self._next(worker)
+
+                        if item is None and idle and len(self._workers) > self.min_connections:
+                            return
+
+                self._execute(worker, item)
+        finally:
+            with self._cond:
+                self._remove_worker(worker)
+
+            if worker.conn is not None:
+                worker.conn.disconnect()
+
+    def _execute(self, worker: _Worker, item: tuple):
+        cost, _, fn, task, callback = item
+        cost = -cost
+
+        now = time.time()
+        result, error = None, None
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                result, error = fn(task, worker.conn), None
+                break
+            except Exception as err:
+                error = err
+
+                if not isinstance(err, self.retry_errors):
+                    break
+
+                if attempt < self.max_retries:
+                    logging.getLogger(__name__).warning("Retrying " + str(task) + " after error: " + str(err))
+
+                    with self._cond:
+                        worker.retries += 1
+
+                    time.sleep(self.backoff * 2 ** attempt)
+
+                    try:
+                        self._connect(worker)
+                    except Exception as conn_err:
+                        logging.getLogger(__name__).exception(conn_err)
+
+        with self._cond:
+            worker.load -= cost
+            worker.requests += 1
+            worker.busy_time += time.time() - now
+
+            if error is not None:
+                worker.failures += 1
+            elif result is not None:
+                worker.rows += len(result) if hasattr(result, '__len__') else 1
+
+        if error is not None:
+            logging.getLogger(__name__).error("Request " + str(task) + " failed: " + str(error))
+
+        if callback is not None:
+            callback(task, result, error)
@@ -1,20 +1,33 @@
+import concurrent.futures
 import logging
 import queue
 import threading
+import time
 import typing
-from collections import Iterable
+from collections import Iterable, OrderedDict
 
 import numpy as np
 import pandas as pd
 
 import pyiqfeed as iq
-from atpy.data.iqfeed.util import launch_service, iqfeed_to_dict, iqfeed_to_deque
-from pyevents.events import SyncListeners, EventFilter
+from atpy.data.iqfeed.util import launch_service, iqfeed_to_dict, iqfeed_dtype, iqfeed_array_to_df
+from atpy.data.ts_util import RingBuffer
+from pyevents.events import EventFilter
 
 
 class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
-    def __init__(self, listeners, mkt_snapshot_depth=0, conn: iq.QuoteConn = None):
+    def __init__(self, listeners, mkt_snapshot_depth=0, conn: iq.QuoteConn = None, update_batch_interval: float = 0, update_batch_size: int = 0):
+        """
+        :param listeners: listeners
+        :param mkt_snapshot_depth: if > 0, keep the last mkt_snapshot_depth updates of each symbol in a preallocated ring buffer (atpy.data.ts_util.RingBuffer).
+        The level_1_update events carry the ring buffer of the symbol, which maps each field to a zero-copy view of its last values (the text fields are bytes).
+        The views change with the next update, therefore the listeners should copy the data they want to keep
+        :param conn: shared QuoteConn (optional)
+        :param update_batch_interval: if > 0, the updates are accumulated for update_batch_interval seconds (counted from the first update of the batch)
+        and fired as a single level_1_update_batch event instead of one level_1_update event per update
+        :param update_batch_size: if > 0, the updates are fired as level_1_update_batch events of up to update_batch_size updates
+        """
         super().__init__(name="Level 1 listener")
 
         self.listeners = listeners
@@ -29,6 +42,15 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
         self.total_updates = 0
 
+        self.update_batch_interval = update_batch_interval
+        self.update_batch_size = update_batch_size
+        self._batch = None
+        self._batch_len = 0
+        self._batch_time = None
+        self._batch_cond = threading.Condition()
+        self._batch_flusher = None
+        self._stopped = False
+
     def __enter__(self):
         if self._own_conn:
             launch_service()
@@ -40,12 +62,27 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
         self.queue = queue.Queue()
 
+        if self.update_batch_interval > 0:
+            self._stopped = False
+            self._batch_flusher = threading.Thread(target=self._flush_batches, name="Level 1 batch flusher", daemon=True)
+            self._batch_flusher.start()
+
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         """Disconnect connection etc"""
         self.conn.remove_listener(self)
 
+        if self._batch_flusher is not None:
+            with self._batch_cond:
+                self._stopped = True
+                self._batch_cond.notify_all()
+
+            self._batch_flusher.join()
+            self._batch_flusher = None
+
+        self.flush_batch()
+
         if self._own_conn:
             self.conn.disconnect()
 
@@ -114,30 +151,16 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
     def process_summary(self, summary: np.array):
         if self.mkt_snapshot_depth > 0:
-            s = iqfeed_to_deque([summary], maxlen=self.mkt_snapshot_depth)
-
-            # no need for deque for the symbol
-            symbol = s['symbol'][0]
-            s['symbol'] = symbol
-
-            self.watched_symbols[symbol] = s
+            self._update_snapshot(summary)
 
         self.listeners({'type': 'level_1_summary', 'data': iqfeed_to_dict(summary)})
 
     def process_update(self, update: np.array):
-        if self.mkt_snapshot_depth > 0:
-            update = update[0] if len(update) == 1 else update
-            symbol = update[0].decode("ascii")
+        batch = self.update_batch_interval > 0 or self.update_batch_size > 0
 
-            data = self.watched_symbols[symbol]
-
-            for key, v in zip(data, update):  # skip symbol
-                if key != 'symbol':
-                    if isinstance(v, bytes):
-                        v = v.decode('ascii')
-
-                    data[key].append(v)
-        else:
+        if self.mkt_snapshot_depth > 0:
+            data = self._update_snapshot(update)
+        elif not batch:
             data = iqfeed_to_dict(update)
 
         self.total_updates = (self.total_updates + 1) % 1000000007
@@ -145,7 +168,84 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
         if self.total_updates % 1000 == 0:
             logging.getLogger(__name__).debug("%d total updates" % self.total_updates)
 
-        self.listeners({'type': 'level_1_update', 'data': data})
+        if batch:
+            self._add_to_batch(update)
+        else:
+            self.listeners({'type': 'level_1_update', 'data': data})
+
+    def _add_to_batch(self, update: np.array):
+        """
+        copy the update to the current batch and fire the batch if it's full
+        :param update: pyiqfeed update (array of a single record)
+        """
+        with self._batch_cond:
+            if self._batch is None:
+                self._batch = np.empty(self.update_batch_size if self.update_batch_size > 0 else 1024, dtype=iqfeed_dtype(update.dtype))
+            elif self._batch_len == len(self._batch):
+                # only the interval limits the batch
+                self._batch = np.concatenate([self._batch, np.empty_like(self._batch)])
+
+            raw_dtype = np.dtype((np.void, self._batch.dtype.itemsize))
+            self._batch.view(raw_dtype)[self._batch_len] = update.view(raw_dtype)[0]
+            self._batch_len += 1
+
+            if self._batch_len == 1:
+                self._batch_time = time.time()
+                self._batch_cond.notify_all()
+
+            if self._batch_len == self.update_batch_size:
+                self._fire_batch()
+
+    def flush_batch(self):
+        """fire the accumulated updates (if any) as a level_1_update_batch event"""
+        with self._batch_cond:
+            self._fire_batch()
+
+    def _fire_batch(self):
+        """fire the current batch (executed under lock, so that the batches are fired in order)"""
+        if self._batch_len == 0:
+            return
+
+        # the buffer is reused
+        data = iqfeed_array_to_df(self._batch[:self._batch_len].copy())
+        self._batch_len = 0
+        self._batch_time = None
+
+        self.listeners({'type': 'level_1_update_batch', 'data': data})
+
+    def _flush_batches(self):
+        """fire the batches, which are older than update_batch_interval (executed in the flusher thread)"""
+        with self._batch_cond:
+            while not self._stopped:
+                if self._batch_time is None:
+                    self._batch_cond.wait()
+                else:
+                    remaining = self._batch_time + self.update_batch_interval - time.time()
+                    if remaining > 0:
+                        self._batch_cond.wait(remaining)
+                    else:
+                        self._fire_batch()
+
+    def _update_snapshot(self, data: np.array) -> RingBuffer:
+        """
+        write the record to the ring buffer of the symbol
+        :param data: pyiqfeed summary/update (array of a single record)
+        :return: the ring buffer of the symbol
+        """
+        symbol = data[data.dtype.names[0]][0].decode("ascii")
+
+        snapshot = self.watched_symbols.get(symbol)
+
+        if snapshot is None:
+            snapshot = RingBuffer(iqfeed_dtype(data.dtype), self.mkt_snapshot_depth, constants={'symbol': symbol})
+
+            # updates, which arrive after unwatch, don't watch the symbol again
+            if symbol in self.watched_symbols:
+                self.watched_symbols[symbol] = snapshot
+
+        snapshot.append(data)
+
+        return snapshot
 
     def news_filter(self):
         return EventFilter(listeners=self.listeners,
@@ -167,6 +267,11 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
                            event_filter=lambda e: True if 'type' in e and e['type'] == 'level_1_summary' else False,
                            event_transformer=lambda e: (e['data'],))
 
+    def level_1_update_batch_filter(self):
+        return EventFilter(listeners=self.listeners,
+                           event_filter=lambda e: True if 'type' in e and e['type'] == 'level_1_update_batch' else False,
+                           event_transformer=lambda e: (e['data'],))
+
     def level_1_update_filter(self):
         return EventFilter(listeners=self.listeners,
                            event_filter=lambda e: True if 'type' in e and e['type'] == 'level_1_update' else False,
@@ -182,43 +287,235 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
                            event_transformer=lambda e: (e['data'],))
 
 
-def get_fundamentals(symbol: typing.Union[str, Iterable], conn: iq.QuoteConn = None):
-    result = dict()
-    invalid = set()
+class IQFeedFundamentalsProvider(iq.SilentQuoteListener):
+    """
+    Fundamentals service over a single QuoteConn. The requested symbols are watched in bounded windows and each symbol is unwatched as soon as its
+    fundamentals arrive. Every symbol is resolved as a future: with the fundamentals dict, or with None if the symbol is invalid or doesn't respond in time.
+    The results are cached for ttl seconds
+    """
 
-    if isinstance(symbol, str):
-        symbol = {symbol}
-    elif not isinstance(symbol, set) and isinstance(symbol, Iterable):
-        symbol = set(symbol)
+    def __init__(self, conn: iq.QuoteConn = None, window: int = 500, timeout: float = 10, ttl: float = 3600):
+        """
+        :param conn: shared QuoteConn. If None, the provider creates its own connection. The symbols are unwatched after their fundamentals arrive,
+        therefore the connection shouldn't be used to stream the same symbols at the same time
+        :param window: maximum number of symbols, which are watched at the same time
+        :param timeout: the symbols, which don't respond within timeout seconds after they are watched, are resolved with None
+        :param ttl: the fundamentals are cached for ttl seconds
+        """
+        super().__init__(name="Fundamentals provider")
 
-    e = threading.Event()
+        self.conn = conn
+        self._own_conn = conn is None
 
-    class TmpIQFeedLevel1Listener(IQFeedLevel1Listener):
-        def process_invalid_symbol(self, bad_symbol: str) -> None:
-            super().process_invalid_symbol(bad_symbol)
-            invalid.add(bad_symbol)
-            if (result.keys() | invalid) - symbol == {}:
-                e.set()
+        self.window = window
+        self.timeout = timeout
+        self.ttl = ttl
 
-        def process_fundamentals(self, fund: np.array):
-            fundamentals = iqfeed_to_dict(fund)
-            s = fundamentals['symbol']
-            result[s] = fundamentals
-            if len(symbol - (result.keys() | invalid)) == 0:
-                e.set()
+        # symbol -> [resolve time, future]
+        self._cache = dict()
 
-    with TmpIQFeedLevel1Listener(listeners=SyncListeners(), conn=conn) as listener:
-        listener.watch(symbol)
-        e.wait()
+        # symbol -> future (waiting to be watched)
+        self._pending = OrderedDict()
 
-    return result
+        # symbol -> (deadline, future)
+        self._watched = dict()
+
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._worker = None
+
+    def __enter__(self):
+        if self._own_conn:
+            launch_service()
+            self.conn = iq.QuoteConn()
+            self.conn.add_listener(self)
+            self.conn.connect()
+        else:
+            self.conn.add_listener(self)
+
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name="Fundamentals provider", daemon=True)
+        self._worker.start()
+
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        self._worker.join()
+        self._worker = None
+
+        with self._cond:
+            watched = list(self._watched)
+            futures = list(self._pending.values()) + [f for _, f in self._watched.values()]
+
+            self._pending.clear()
+            self._watched.clear()
+            self._cache = {s: e for s, e in self._cache.items() if e[1].done()}
+
+        for s in watched:
+            self.conn.unwatch(s)
+
+        for f in futures:
+            f.cancel()
+
+        self.conn.remove_listener(self)
+
+        if self._own_conn:
+            self.conn.disconnect()
+
+        self.conn = None
+
+    def request(self, symbol: typing.Union[str, Iterable]) -> typing.Dict[str, concurrent.futures.Future]:
+        """
+        request fundamentals without blocking. Cached symbols are not requested again
+        :param symbol: symbol or list of symbols
+        :return: dict of symbol -> future
+        """
+        symbols = [symbol] if isinstance(symbol, str) else symbol
+
+        result = dict()
+
+        with self._cond:
+            now = time.time()
+
+            for s in symbols:
+                entry = self._cache.get(s)
+
+                if entry is None or (entry[1].done() and now - entry[0] > self.ttl):
+                    entry = [None, concurrent.futures.Future()]
+                    self._cache[s] = entry
+                    self._pending[s] = entry[1]
+
+                result[s] = entry[1]
+
+            if self._pending:
+                self._cond.notify_all()
+
+        return result
+
+    def fundamentals(self, symbol: typing.Union[str, Iterable]) -> dict:
+        """
+        :param symbol: symbol or list of symbols
+        :return: dict of symbol -> fundamentals. Invalid symbols and symbols, which timed out, are not included
+        """
+        result = dict()
+
+        for s, future in self.request(symbol).items():
+            f = future.result()
+            if f is not None:
+                result[s] = f
+
+        return result
+
+    def splits_dividends(self, symbol: typing.Union[str, Iterable]) -> pd.DataFrame:
+        """
+        :param symbol: symbol or list of symbols
+        :return: splits/dividends dataframe in the format of get_splits_dividends
+        """
+        return _splits_dividends_df(self.fundamentals(symbol).values())
+
+    def process_fundamentals(self, fund: np.array):
+        f = iqfeed_to_dict(fund)
+        self._resolve(f['symbol'], f)
+
+    def process_invalid_symbol(self, bad_symbol: str) -> None:
+        logging.getLogger(__name__).warning("Invalid symbol request: " + str(bad_symbol))
+        self._resolve(bad_symbol, None)
+
+    def _resolve(self, symbol: str, fundamentals: typing.Optional[dict]):
+        with self._cond:
+            watched = self._watched.pop(symbol, None)
+            pending = self._pending.pop(symbol, None)
+            entry = self._cache.get(symbol)
+
+            if entry is not None and not entry[1].done():
+                entry[0] = time.time()
+                future = entry[1]
+            elif fundamentals is not None:
+                # not requested (or timed out earlier), but it's still worth caching
+                future = concurrent.futures.Future()
+                self._cache[symbol] = [time.time(), future]
+            else:
+                future = None
+
+            if watched is not None:
+                self._cond.notify_all()
+
+        if watched is not None:
+            self.conn.unwatch(symbol)
+
+        for f in {future, pending, None if watched is None else watched[1]} - {None}:
+            if not f.done():
+                f.set_result(fundamentals)
+
+    def _next_actions(self):
+        """
+        find the expired symbols and fill the watch window (executed under lock)
+        :return: (list of expired (symbol, future) pairs, list of symbols to watch)
+        """
+        now = time.time()
+
+        expired = [s for s, (deadline, _) in self._watched.items() if deadline <= now]
+        expired = [(s, self._watched.pop(s)[1]) for s in expired]
+
+        for s, _ in expired:
+            # the next request tries again
+            self._cache.pop(s, None)
+
+        to_watch = list()
+        while self._pending and len(self._watched) < self.window:
+            s, future = self._pending.popitem(last=False)
+            self._watched[s] = (now + self.timeout, future)
+            to_watch.append(s)
+
+        return expired, to_watch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired, to_watch = self._next_actions()
+
+                while not self._stopped and not expired and not to_watch:
+                    deadlines = [d for d, _ in self._watched.values()]
+                    self._cond.wait(max(min(deadlines) - time.time(), 0) if deadlines else None)
+                    expired, to_watch = self._next_actions()
+
+                if self._stopped:
+                    return
+
+            if expired:
+                logging.getLogger(__name__).warning("Fundamentals request timed out for " + str(len(expired)) + " symbols: " + str([s for s, _ in expired][:10]))
+
+            for s, future in expired:
+                self.conn.unwatch(s)
+                if not future.done():
+                    future.set_result(None)
+
+            for s in to_watch:
+                self.conn.watch(s)
+
+
+def get_fundamentals(symbol: typing.Union[str, Iterable], conn: iq.QuoteConn = None, timeout: float = 10) -> dict:
+    """
+    :param symbol: symbol or list of symbols
+    :param conn: shared QuoteConn (optional)
+    :param timeout: symbols, which don't respond within timeout seconds, are skipped
+    :return: dict of symbol -> fundamentals. Invalid symbols are not included
+    """
+    with IQFeedFundamentalsProvider(conn=conn, timeout=timeout) as provider:
+        return provider.fundamentals(symbol)
 
 
 def get_splits_dividends(symbol: typing.Union[set, str], conn: iq.QuoteConn = None):
-    funds = get_fundamentals(symbol=symbol, conn=conn)
+    return _splits_dividends_df(get_fundamentals(symbol=symbol, conn=conn).values())
+
 
+def _splits_dividends_df(funds: Iterable) -> pd.DataFrame:
     points = {'timestamp': list(), 'symbol': list(), 'type': list(), 'value': list()}
-    for f in funds.values():
+    for f in funds:
         if f['split_factor_1_date'] is not None and f['split_factor_1'] is not None:
             points['timestamp'].append(f['split_factor_1_date'])
             points['symbol'].append(f['symbol'])
@@ -32,6 +32,51 @@ def launch_service():
     svc.launch(headless=headless)
 
 
+_DAY_NS = 24 * 3600 * 10 ** 9
+
+_TRANSITION = np.iinfo(np.int64).min
+
+_eastern_offsets_table = None
+
+
+def eastern_offsets() -> np.ndarray:
+    """
+    Lazily computed table of the UTC offsets of US/Eastern for each day since 1970 (until 2100). The offset of the days with DST transition is _TRANSITION
+    :return: int64 array of the offsets in nanoseconds (UTC - local time)
+    """
+    global _eastern_offsets_table
+
+    if _eastern_offsets_table is None:
+        days = pd.date_range('1970-01-01', '2100-01-01', freq='D')
+
+        # DST transitions happen at 2 AM, so the offsets at midnight and at noon differ only on the transition days
+        offsets = [d.tz_localize('US/Eastern').tz_convert('UTC').tz_localize(None).asi8 - d.asi8 for d in [days, days + pd.Timedelta(hours=12)]]
+
+        _eastern_offsets_table = np.where(offsets[0] == offsets[1], offsets[0], _TRANSITION)
+
+    return _eastern_offsets_table
+
+
+def eastern_to_utc(local: np.ndarray) -> pd.DatetimeIndex:
+    """
+    Convert US/Eastern wall time to UTC using the per-day offsets table. Only the days with DST transition (and the days outside of the table) are converted with tz_localize
+    :param local: datetime64 array of US/Eastern wall times
+    :return: UTC DatetimeIndex
+    """
+    local = local.astype('M8[ns]').view(np.int64)
+    offsets = eastern_offsets()
+
+    offset = offsets[np.clip(local // _DAY_NS, 0, len(offsets) - 1)]
+    exact = (offset == _TRANSITION) | (local < 0) | (local >= len(offsets) * _DAY_NS)
+
+    result = local + np.where(exact, 0, offset)
+
+    if exact.any():
+        result[exact] = pd.DatetimeIndex(local[exact].view('M8[ns]')).tz_localize('US/Eastern').tz_convert('UTC').asi8
+
+    return pd.DatetimeIndex(result.view('M8[ns]')).tz_localize('UTC')
+
+
 def iqfeed_to_df(data: typing.Collection):
     """
     Create minibatch-type data frame based on the pyiqfeed data format
@@ -59,6 +104,24 @@ def iqfeed_to_df(data: typing.Collection):
     return pd.DataFrame(result)
 
 
+def iqfeed_array_to_df(data: np.ndarray) -> pd.DataFrame:
+    """
+    Create minibatch-type data frame from a structured array of pyiqfeed records (without per record processing)
+    :param data: structured array
+    :return:
+    """
+    result = OrderedDict()
+
+    for n in data.dtype.names:
+        column = data[n]
+        if column.dtype.kind == 'S':
+            column = np.char.decode(column, 'ascii').astype(object)
+
+        result[n.replace(" ", "_").lower()] = column
+
+    return pd.DataFrame(result)
+
+
 def iqfeed_to_deque(data: typing.Iterable, maxlen: int = None):
     """
     Create minibatch-type dict of deques based on the pyiqfeed data format
@@ -87,13 +150,36 @@ def iqfeed_to_deque(data: typing.Iterable, maxlen: int = None):
     return result
 
 
+def iqfeed_dtype(dtype: np.dtype) -> np.dtype:
+    """
+    pyiqfeed record dtype with the field names of iqfeed_to_dict, but with the same memory layout
+    :param dtype: pyiqfeed dtype
+    :return:
+    """
+    return np.dtype({'names': [n.replace(" ", "_").lower() for n in dtype.names],
+                     'formats': [dtype.fields[n][0] for n in dtype.names],
+                     'offsets': [dtype.fields[n][1] for n in dtype.names],
+                     'itemsize': dtype.itemsize})
+
+
 def get_last_value(data: dict) -> dict:
     """
     If the data is a result is a time-serires (dict of collections), return the last one
     :param data: data list
     :return:
     """
-    return OrderedDict([(k, v[-1] if isinstance(v, typing.Collection) else v) for k, v in data.items()])
+    return OrderedDict([(k, v[-1] if isinstance(v, typing.Collection) and not isinstance(v, (str, bytes)) else v) for k, v in data.items()])
+
+
+def last_value(data: dict, key: str):
+    """
+    Same as get_last_value, but for a single field
+    :param data: dict of values or dict of collections
+    :param key: field name
+    :return:
+    """
+    v = data[key]
+    return v[-1] if isinstance(v, typing.Collection) and not isinstance(v, (str, bytes)) else v
 
 
 def iqfeed_to_dict(data):
@@ -5,6 +5,217 @@ from collections import OrderedDict
 from atpy.data.iqfeed.util import *
 
 
+def _nullable(dtype: np.dtype) -> np.dtype:
+    """dtype, which supports missing values"""
+    return np.dtype(np.float64) if dtype.kind in 'iu' else dtype if dtype.kind in 'fcMmO' else np.dtype(object)
+
+
+def _missing(dtype: np.dtype):
+    return np.nan if dtype.kind in 'fc' else np.datetime64('NaT') if dtype.kind in 'Mm' else None
+
+
+class SlotFrame(object):
+    """
+    Dataframe of the rows of the latest timestamp slots. The rows are appended into preallocated column blocks, each row is tagged with the id of its slot.
+    The slots are numbered in the order of insertion, therefore the oldest slot is evicted in O(1) by moving the first live id. The evicted rows are dropped
+    when the blocks are compacted (on growth). The dataframe is materialized lazily and is cached until the next mutation
+    """
+
+    def __init__(self, depth: int = 0):
+        """
+        :param depth: maximum number of slots (0 for unlimited)
+        """
+        self.depth = depth
+
+        self._slots = OrderedDict()
+        self._next_slot = 0
+
+        self._columns = OrderedDict()
+        self._dtypes = dict()
+        self._slot_ids = np.zeros(0, dtype=np.int64)
+        self._timestamps = np.zeros(0, dtype='M8[ns]')
+        self._end = 0
+
+        # the rows are ordered by slot as long as no earlier slot is extended
+        self._ordered = True
+
+        self._tz = None
+        self._names = None
+
+        self._frame = None
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, timestamp):
+        return timestamp in self._slots
+
+    def append(self, timestamp, rows: pd.DataFrame):
+        """
+        :param timestamp: slot timestamp. A new timestamp is a new slot, otherwise the rows are added to the existing slot
+        :param rows: rows of the slot (the timestamp level is not part of the index)
+        """
+        self._frame = None
+
+        if timestamp not in self._slots:
+            self._slots[timestamp] = self._next_slot
+            self._next_slot += 1
+
+            if 0 < self.depth < len(self._slots):
+                self._slots.popitem(last=False)
+
+        n = len(rows)
+        if n == 0:
+            return
+
+        if self._end + n > len(self._slot_ids):
+            self._compact(n)
+
+        if self._names is None:
+            self._names = list(rows.index.names) if not isinstance(rows.index, (pd.RangeIndex, pd.DatetimeIndex)) else list()
+
+        s = slice(self._end, self._end + n)
+
+        slot = self._slots[timestamp]
+        if self._end > 0 and slot < self._slot_ids[self._end - 1]:
+            self._ordered = False
+
+        self._slot_ids[s] = slot
+
+        if isinstance(timestamp, pd.Timestamp) and timestamp.tz is not None:
+            self._tz = timestamp.tz
+            self._timestamps[s] = timestamp.tz_convert('UTC').tz_localize(None).to_datetime64()
+        else:
+            self._timestamps[s] = np.datetime64(timestamp, 'ns')
+
+        index = rows.index.to_frame(index=False) if not isinstance(rows.index, (pd.RangeIndex, pd.DatetimeIndex)) else pd.DataFrame(index=range(n))
+        index.columns = ['__level_' + str(i) for i in range(index.shape[1])]
+
+        for df in (index, rows):
+            for c in df:
+                self._set_column(c, s, df[c])
+
+        # the columns, which are not part of the rows are missing
+        for c in [c for c in self._columns if c not in rows and c not in index]:
+            block = self._column_for(c, None)
+            block[s] = _missing(block.dtype)
+
+        self._end += n
+
+    def frame(self) -> pd.DataFrame:
+        """
+        :return: dataframe with MultiIndex [timestamp, <rows index>] of the live slots (oldest first). The result is cached until the next mutation
+        """
+        if self._frame is None:
+            self._frame = self._materialize()
+
+        return self._frame
+
+    def _live(self) -> np.ndarray:
+        """indices of the live rows in slot order"""
+        if not self._slots:
+            return np.zeros(0, dtype=np.int64)
+
+        first = next(iter(self._slots.values()))
+        slot_ids = self._slot_ids[:self._end]
+
+        if self._ordered:
+            return np.arange(np.searchsorted(slot_ids, first), self._end)
+
+        live = np.flatnonzero(slot_ids >= first)
+        return live[np.argsort(slot_ids[live], kind='mergesort')]
+
+    def _compact(self, n: int):
+        """drop the evicted rows and grow the blocks if necessary"""
+        live = self._live()
+        self._ordered = True
+
+        size = len(live) + n
+        capacity = max(len(self._slot_ids), 16)
+        while capacity < 2 * size:
+            capacity *= 2
+
+        def compacted(block):
+            result = np.empty(capacity, dtype=block.dtype)
+            result[:len(live)] = block[live]
+            return result
+
+        self._slot_ids = compacted(self._slot_ids)
+        self._timestamps = compacted(self._timestamps)
+        for c, block in self._columns.items():
+            self._columns[c] = compacted(block)
+
+        self._end = len(live)
+
+    def _column_for(self, column, values: typing.Optional[np.ndarray]) -> np.ndarray:
+        """column block, which can hold the values (missing values if None)"""
+        block = self._columns.get(column)
+
+        if block is None:
+            # the existing rows of a new column are missing
+            dtype = values.dtype if values is not None else np.dtype(np.float64)
+            block = np.empty(len(self._slot_ids), dtype=dtype if self._end == 0 else _nullable(dtype))
+            if self._end > 0:
+                block[:self._end] = _missing(block.dtype)
+
+            self._columns[column] = block
+
+        if values is None:
+            dtype = _nullable(block.dtype)
+        elif block.dtype == values.dtype:
+            dtype = block.dtype
+        elif block.dtype.kind in 'iuf' and values.dtype.kind in 'iuf':
+            dtype = np.result_type(block.dtype, values.dtype)
+        else:
+            dtype = np.dtype(object)
+
+        if block.dtype != dtype:
+            block = block.astype(dtype)
+            self._columns[column] = block
+
+        return block
+
+    def _set_column(self, column, s: slice, values: pd.Series):
+        dtype = values.dtype
+
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            self._dtypes[column] = dtype
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None).values
+        elif isinstance(dtype, np.dtype):
+            values = values.values
+        else:
+            values = values.astype(object).values
+
+        self._column_for(column, values)[s] = values
+
+    def _materialize(self) -> pd.DataFrame:
+        live = self._live()
+
+        timestamps = pd.DatetimeIndex(self._timestamps[live])
+        if self._tz is not None:
+            timestamps = timestamps.tz_localize('UTC').tz_convert(self._tz)
+
+        data = OrderedDict()
+        for c, block in self._columns.items():
+            values = block[live]
+            if c in self._dtypes and values.dtype.kind == 'M':
+                values = pd.DatetimeIndex(values).tz_localize('UTC').tz_convert(self._dtypes[c].tz).array
+
+            data[c] = values
+
+        result = pd.DataFrame(data)
+
+        levels = [c for c in result if isinstance(c, str) and c.startswith('__level_')]
+        if levels:
+            arrays = [timestamps] + [result[c] for c in levels]
+            result = result.drop(levels, axis=1)
+            result.index = pd.MultiIndex.from_arrays(arrays, names=[None] + (self._names if len(self._names) == len(levels) else [None] * len(levels)))
+        else:
+            result.index = timestamps
+
+        return result
+
+
 class LatestDataSnapshot(object):
     """Listen and maintain a dataframe of the latest data events"""
 
@@ -12,7 +223,7 @@ class LatestDataSnapshot(object):
         """
         :param listeners: listeners
         :param event: event or list of events to accept
-        :param depth: keep depth of the snapshot
+        :param depth: keep depth of the snapshot (number of the latest timestamps). 0 means unlimited
         :param fire_update: whether to fire an event in case of snapshot update
         """
 
@@ -22,7 +233,7 @@ class LatestDataSnapshot(object):
         self.depth = depth
         self.event = {event} if isinstance(event, str) else event
         self._fire_update = fire_update
-        self._snapshot = OrderedDict()
+        self._snapshot = SlotFrame(depth=depth)
 
         self._rlock = threading.RLock()
 
@@ -30,7 +241,7 @@ class LatestDataSnapshot(object):
 
     def update_snapshot(self, data):
         with self._rlock:
-            timestamp_cols = [c for c in data if pd.core.dtypes.common.is_datetimelike(data[c])]
+            timestamp_cols = [c for c in data if pd.api.types.is_datetime64_any_dtype(data[c])]
             if timestamp_cols:
                 ind = data[timestamp_cols[0]].unique()
             else:
@@ -44,16 +255,33 @@ class LatestDataSnapshot(object):
                 if not isinstance(ind, pd.DatetimeIndex):
                     raise Exception("Only first level DateTimeIndex is supported")
 
+            by_index = isinstance(data.index, pd.DatetimeIndex) or (isinstance(data.index, pd.MultiIndex) and isinstance(data.index.levels[0], pd.DatetimeIndex))
+
             for i in ind[-self.depth:]:
-                self._snapshot[i] = pd.concat([self._snapshot[i], data.loc[i]]) if i in self._snapshot else data.loc[i]
+                if not by_index:
+                    rows = data[data[timestamp_cols[0]] == i]
+                elif len(ind) == 1 and isinstance(data.index, pd.MultiIndex):
+                    rows = data.droplevel(0)
+                else:
+                    rows = data.loc[i]
+
+                if isinstance(rows, pd.Series):
+                    rows = rows.to_frame().T.infer_objects()
 
-            while len(self._snapshot) > self.depth:
-                self._snapshot.popitem()
+                self._snapshot.append(pd.Timestamp(i), rows)
+
+    def snapshot(self) -> pd.DataFrame:
+        """
+        :return: dataframe of the snapshot with MultiIndex [timestamp, ...]. The dataframe is cached until the next update
+        """
+        with self._rlock:
+            return self._snapshot.frame()
 
     def on_event(self, event):
         if event['type'] in self.event:
             self.update_snapshot(event['data'])
             if self._fire_update:
-                self.listeners({'type': event['type'] + '_snapshot', 'data': pd.concat(self._snapshot), 'new_data': pd.concat(self._snapshot)})
+                snapshot = self.snapshot()
+                self.listeners({'type': event['type'] + '_snapshot', 'data': snapshot, 'new_data': snapshot})
         elif event['type'] == 'request_latest':
-            self.listeners({'type': 'snapshot', 'data': pd.concat(self._snapshot)})
+            self.listeners({'type': 'snapshot', 'data': self.snapshot()})
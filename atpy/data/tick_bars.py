@@ -0,0 +1,336 @@
+import datetime
+import typing
+
+import numba
+import numpy as np
+import pandas as pd
+
+from pyevents.events import EventFilter
+
+BAR_TYPES = {'time': 0, 'tick': 1, 'volume': 2, 'dollar': 3}
+
+_STATE_DTYPES = {'bucket': np.int64, 'timestamp': np.int64, 'open': np.float64, 'high': np.float64, 'low': np.float64, 'close': np.float64, 'volume': np.float64, 'value': np.float64, 'count': np.int64}
+
+_BAR_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'vwap', 'number_of_trades']
+
+
+@numba.jit(nopython=True, nogil=True)
+def _emit(c, timestamp, s_open, s_high, s_low, s_close, s_volume, s_value, s_count,
+          o_code, o_timestamp, o_open, o_high, o_low, o_close, o_volume, o_value, o_count, n):
+    o_code[n] = c
+    o_timestamp[n] = timestamp
+    o_open[n] = s_open[c]
+    o_high[n] = s_high[c]
+    o_low[n] = s_low[c]
+    o_close[n] = s_close[c]
+    o_volume[n] = s_volume[c]
+    o_value[n] = s_value[c]
+    o_count[n] = s_count[c]
+
+    s_volume[c] = 0
+    s_value[c] = 0
+    s_count[c] = 0
+
+
+@numba.jit(nopython=True, nogil=True)
+def _aggregate_ticks(codes: np.array, timestamps: np.array, prices: np.array, sizes: np.array, bar_type: int, threshold: float, interval: int, period_right: bool,
+                     s_bucket: np.array, s_timestamp: np.array, s_open: np.array, s_high: np.array, s_low: np.array, s_close: np.array, s_volume: np.array, s_value: np.array, s_count: np.array,
+                     o_code: np.array, o_timestamp: np.array, o_open: np.array, o_high: np.array, o_low: np.array, o_close: np.array, o_volume: np.array, o_value: np.array, o_count: np.array):
+    """
+    Single pass aggregation of ticks to bars. The partial bar of each symbol is kept in the state arrays (s_*), which are updated in place.
+    Each tick closes at most one bar, therefore the output arrays (o_*) have the same length as the input
+    :param codes: symbol code of each tick (index in the state arrays)
+    :param timestamps: int64 timestamp of each tick
+    :param prices: price of each tick
+    :param sizes: size of each tick
+    :param bar_type: value of BAR_TYPES
+    :param threshold: number of ticks, volume or dollar value, which closes a bar (tick, volume and dollar bars)
+    :param interval: bar interval (time bars)
+    :param period_right: time bars are closed on the right (the timestamp is the end of the interval). Otherwise closed on the left and the timestamp is the beginning of the interval
+    :return: number of closed bars
+    """
+    n = 0
+
+    for i in range(codes.size):
+        c = codes[i]
+        t = timestamps[i]
+        p = prices[i]
+        v = sizes[i]
+
+        if bar_type == 0:
+            bucket = (t - 1) // interval + 1 if period_right else t // interval
+
+            if s_count[c] > 0 and bucket != s_bucket[c]:
+                _emit(c, s_bucket[c] * interval, s_open, s_high, s_low, s_close, s_volume, s_value, s_count,
+                      o_code, o_timestamp, o_open, o_high, o_low, o_close, o_volume, o_value, o_count, n)
+                n += 1
+
+            s_bucket[c] = bucket
+
+        if s_count[c] == 0:
+            s_open[c] = s_high[c] = s_low[c] = p
+        elif p > s_high[c]:
+            s_high[c] = p
+        elif p < s_low[c]:
+            s_low[c] = p
+
+        s_close[c] = p
+        s_volume[c] += v
+        s_value[c] += p * v
+        s_count[c] += 1
+        s_timestamp[c] = t
+
+        if (bar_type == 1 and s_count[c] >= threshold) or (bar_type == 2 and s_volume[c] >= threshold) or (bar_type == 3 and s_value[c] >= threshold):
+            _emit(c, t, s_open, s_high, s_low, s_close, s_volume, s_value, s_count,
+                  o_code, o_timestamp, o_open, o_high, o_low, o_close, o_volume, o_value, o_count, n)
+            n += 1
+
+    return n
+
+
+class TickBarAggregator(object):
+    """
+    Streaming aggregation of ticks to time, tick, volume or dollar bars with OHLCV, VWAP and number of trades. The data is processed in a single linear pass (numba).
+    The partial bar of each symbol is carried over to the next chunk, so that processing the data in chunks gives the same result as processing it at once.
+    Call flush at the end of the data to obtain the partial bars.
+    Tick, volume and dollar bars are closed by the tick, which reaches the threshold (the ticks are not split between bars) and the timestamp of the bar is the timestamp of this tick
+    """
+
+    def __init__(self, bar_type: str = 'volume', threshold: float = 1000, period_id: str = 'right', price_column: str = 'last', size_column: str = 'last_size'):
+        """
+        :param bar_type: 'time', 'tick', 'volume' or 'dollar'
+        :param threshold: interval length in seconds (time bars), number of ticks (tick bars), volume (volume bars) or volume * price (dollar bars) of each bar
+        :param period_id: whether to associate the time bars with the beginning or the end of the interval (the inclusion is also closed to the left or right respectively)
+        :param price_column: price column of the tick data
+        :param size_column: size column of the tick data
+        """
+        if bar_type not in BAR_TYPES:
+            raise Exception("Unsupported bar type " + str(bar_type))
+
+        if period_id not in ('left', 'right'):
+            raise Exception("period_id must be 'left' or 'right'")
+
+        self.bar_type = bar_type
+        self.threshold = threshold
+        self.period_id = period_id
+        self.price_column = price_column
+        self.size_column = size_column
+
+        self._interval = pd.Timedelta(seconds=threshold).value if bar_type == 'time' else 1
+        self._codes = dict()
+        self._symbols = list()
+        self._state = {c: np.zeros(16, dtype=d) for c, d in _STATE_DTYPES.items()}
+        self._tz = None
+        self._multiindex = True
+
+    @property
+    def symbols(self) -> list:
+        return list(self._symbols)
+
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Aggregate a chunk of ticks. The ticks of each symbol must be in ascending order
+        :param df: tick data with price and size columns. The symbol is taken from the symbol level of the MultiIndex or the symbol column (otherwise a single unnamed symbol).
+                   The timestamp is taken from the timestamp level/column or the DatetimeIndex
+        :return: closed bars. MultiIndex [symbol, timestamp] for MultiIndex input and DatetimeIndex otherwise
+        """
+        multiindex = self._multiindex = isinstance(df.index, pd.MultiIndex)
+
+        if multiindex and 'symbol' in df.index.names:
+            symbols = df.index.get_level_values('symbol')
+        elif 'symbol' in df.columns:
+            symbols = df['symbol']
+        else:
+            symbols = None
+
+        if multiindex and 'timestamp' in df.index.names:
+            timestamps = df.index.get_level_values('timestamp')
+        elif 'timestamp' in df.columns:
+            timestamps = df['timestamp']
+        else:
+            timestamps = df.index
+
+        result = self.aggregate(symbols=symbols if symbols is not None else np.zeros(len(df), dtype=object), timestamps=timestamps,
+                                prices=df[self.price_column].values, sizes=df[self.size_column].values)
+
+        return self._format(result, multiindex)
+
+    def aggregate(self, symbols: typing.Iterable, timestamps: typing.Iterable, prices: np.array, sizes: np.array) -> pd.DataFrame:
+        """
+        Aggregate ticks given as arrays
+        :param symbols: symbol of each tick
+        :param timestamps: timestamp of each tick
+        :param prices: price of each tick
+        :param sizes: size of each tick
+        :return: closed bars with MultiIndex [symbol, timestamp]
+        """
+        timestamps = pd.DatetimeIndex(timestamps)
+        if self._tz is None and timestamps.tz is not None:
+            self._tz = timestamps.tz
+
+        codes = self._encode(symbols)
+        n = len(codes)
+
+        out = {c: np.empty(n, dtype=d) for c, d in _STATE_DTYPES.items() if c != 'bucket'}
+        out['code'] = np.empty(n, dtype=np.int64)
+
+        s = self._state
+        closed = _aggregate_ticks(codes, timestamps.values.view(np.int64), np.asarray(prices, dtype=np.float64), np.asarray(sizes, dtype=np.float64),
+                                  BAR_TYPES[self.bar_type], float(self.threshold), self._interval, self.period_id == 'right',
+                                  s['bucket'], s['timestamp'], s['open'], s['high'], s['low'], s['close'], s['volume'], s['value'], s['count'],
+                                  out['code'], out['timestamp'], out['open'], out['high'], out['low'], out['close'], out['volume'], out['value'], out['count'])
+
+        return self._to_df({c: a[:closed] for c, a in out.items()})
+
+    def flush(self, until: datetime.datetime = None) -> pd.DataFrame:
+        """
+        Close the partial bars
+        :param until: if not None, close only the time bars, whose interval ended before this time (the rest stay open). Used for live data
+        :return: closed bars in the format of update (MultiIndex [symbol, timestamp] by default)
+        """
+        s = self._state
+        active = s['count'][:len(self._symbols)] > 0
+
+        if self.bar_type == 'time':
+            timestamps = s['bucket'][:len(self._symbols)] * self._interval
+
+            if until is not None:
+                until = pd.Timestamp(until)
+                if until.tzinfo is not None:
+                    until = until.tz_convert('UTC').tz_localize(None)
+
+                # the bars, which are closed on the right, include the ticks at the end of the interval
+                active &= timestamps < until.value if self.period_id == 'right' else timestamps + self._interval <= until.value
+        elif until is not None:
+            return self._format(self._to_df({c: np.empty(0, dtype=d) for c, d in dict(_STATE_DTYPES, code=np.int64).items()}), self._multiindex)
+        else:
+            timestamps = s['timestamp'][:len(self._symbols)]
+
+        codes = np.flatnonzero(active)
+        result = {c: s[c][codes] for c in _STATE_DTYPES}
+        result['timestamp'] = timestamps[codes]
+        result['code'] = codes
+
+        for c in ('volume', 'value', 'count'):
+            s[c][codes] = 0
+
+        return self._format(self._to_df(result), self._multiindex)
+
+    def _encode(self, symbols) -> np.array:
+        uniques_codes, uniques = pd.factorize(np.asarray(symbols, dtype=object))
+
+        mapping = np.empty(len(uniques), dtype=np.int64)
+        for i, u in enumerate(uniques):
+            if u not in self._codes:
+                self._codes[u] = len(self._symbols)
+                self._symbols.append(u)
+
+            mapping[i] = self._codes[u]
+
+        capacity = len(self._state['count'])
+        if len(self._symbols) > capacity:
+            capacity = max(2 * capacity, len(self._symbols))
+            for c, a in self._state.items():
+                self._state[c] = np.concatenate([a, np.zeros(capacity - len(a), dtype=a.dtype)])
+
+        return mapping[uniques_codes] if len(uniques_codes) > 0 else np.empty(0, dtype=np.int64)
+
+    def _to_df(self, data: dict) -> pd.DataFrame:
+        volume = data['volume']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            vwap = np.where(volume > 0, data['value'] / volume, data['close'])
+
+        timestamps = pd.DatetimeIndex(data['timestamp'].astype('M8[ns]'), name='timestamp')
+        if self._tz is not None:
+            timestamps = timestamps.tz_localize('UTC').tz_convert(self._tz)
+
+        symbols = np.array(self._symbols, dtype=object)[data['code']] if len(self._symbols) > 0 else np.empty(0, dtype=object)
+
+        return pd.DataFrame({'open': data['open'], 'high': data['high'], 'low': data['low'], 'close': data['close'], 'volume': volume, 'vwap': vwap, 'number_of_trades': data['count']},
+                            index=pd.MultiIndex.from_arrays([symbols, timestamps], names=['symbol', 'timestamp']), columns=_BAR_COLUMNS)
+
+    @staticmethod
+    def _format(df: pd.DataFrame, multiindex: bool) -> pd.DataFrame:
+        if multiindex:
+            return df.sort_index()
+
+        return df.reset_index(level='symbol', drop=True)
+
+
+def _last_value(data, key: str):
+    """
+    :return: the value of the field in a dict of values, or its last value in a market snapshot (text fields are decoded). None if the field is missing
+    """
+    if key not in data:
+        return None
+
+    v = data[key]
+    if isinstance(v, np.ndarray):
+        v = v[-1] if len(v) > 0 else None
+
+    return v.decode('ascii') if isinstance(v, bytes) else v
+
+
+class TickBarsListener(object):
+    """
+    Aggregate the trades of the live level_1_update events (IQFeedLevel1Listener) to bars and fire tick_bars events. The events carry either a dict of the update
+    (mkt_snapshot_depth=0) or the market snapshot of the symbol (ring buffer of the last updates with bytes text fields), whose last values are used
+    """
+
+    def __init__(self, listeners, bar_type: str = 'volume', threshold: float = 1000, period_id: str = 'right'):
+        """
+        :param listeners: listeners
+        :param bar_type: 'time', 'tick', 'volume' or 'dollar'
+        :param threshold: see TickBarAggregator
+        :param period_id: see TickBarAggregator
+        """
+        self.listeners = listeners
+        self.listeners += self.on_event
+
+        self.aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold, period_id=period_id)
+        self._last_bucket = None
+
+    def on_event(self, event):
+        if event['type'] == 'level_1_update':
+            self.process_trade(event['data'])
+        elif event['type'] == 'no_data':
+            self._fire(self.aggregator.flush())
+
+    def process_trade(self, data: dict):
+        """
+        :param data: level 1 update. Updates without new trade (bid/ask only) are skipped
+        """
+        message_contents = _last_value(data, 'message_contents')
+        if message_contents is not None and not set(message_contents) & {'C', 'E'}:
+            return
+
+        price, size, time = _last_value(data, 'most_recent_trade'), _last_value(data, 'most_recent_trade_size'), _last_value(data, 'most_recent_trade_time')
+        if price is None or size is None or time is None:
+            return
+
+        trade_date = _last_value(data, 'most_recent_trade_date')
+        if trade_date is not None:
+            date = np.datetime64(trade_date, 'D')
+        else:
+            date = np.datetime64(pd.Timestamp.now(tz='US/Eastern').date(), 'D')
+
+        timestamp = pd.Timestamp(date + np.timedelta64(time, 'us')).tz_localize('US/Eastern').tz_convert('UTC')
+
+        # time bars of the other symbols, which ended before this trade
+        if self.aggregator.bar_type == 'time':
+            bucket = timestamp.value // self.aggregator._interval
+            if self._last_bucket is not None and bucket > self._last_bucket:
+                self._fire(self.aggregator.flush(until=timestamp))
+
+            self._last_bucket = bucket
+
+        self._fire(self.aggregator.aggregate(symbols=[data['symbol']], timestamps=[timestamp], prices=np.array([price]), sizes=np.array([size])))
+
+    def _fire(self, bars: pd.DataFrame):
+        if not bars.empty:
+            self.listeners({'type': 'tick_bars', 'data': bars, 'bar_type': self.aggregator.bar_type, 'threshold': self.aggregator.threshold})
+
+    def tick_bars_stream(self):
+        return EventFilter(listeners=self.listeners,
+                           event_filter=lambda e: True if 'type' in e and e['type'] == 'tick_bars' and e['bar_type'] == self.aggregator.bar_type and e['threshold'] == self.aggregator.threshold else False,
+                           event_transformer=lambda e: (e['data'],))
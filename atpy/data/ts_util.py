@@ -2,10 +2,12 @@
 Time series utils.
 """
 import datetime
-import queue
+import logging
 import threading
 import typing
+from collections.abc import Mapping
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
@@ -184,36 +186,301 @@ def overlap_by_symbol(old_df: pd.DataFrame, new_df: pd.DataFrame, overlap: int):
         return pd.concat([old_df.tail(overlap), new_df], sort=True)
 
 
+def last_rows(df: pd.DataFrame, symbols: typing.List[str]) -> np.array:
+    """
+    Find the last row of each symbol in a single pass (without per symbol index lookups)
+    :param df: dataframe with symbol level in a MultiIndex
+    :param symbols: list of symbols
+    :return: array with the positional index of the last row of each symbol (-1 if the symbol is missing)
+    """
+    symbol_ind = df.index.names.index('symbol')
+    levels, codes = df.index.levels[symbol_ind], df.index.codes[symbol_ind]
+
+    symbol_codes = levels.get_indexer(symbols)
+
+    # the last element represents missing symbols (code -1)
+    requested = np.zeros(len(levels) + 1, dtype=np.bool_)
+    requested[symbol_codes] = True
+    requested[-1] = False
+
+    candidates = np.flatnonzero(requested[codes])[::-1]
+    candidate_codes, first = np.unique(codes[candidates], return_index=True)
+
+    result = np.full(len(levels) + 1, -1, dtype=np.int64)
+    result[candidate_codes] = candidates[first]
+
+    return result[symbol_codes]
+
+
+class RingBuffer(Mapping):
+    """
+    Preallocated ring buffer of structured records with O(1) append. Each record is written twice (at the cursor and at cursor + maxlen),
+    therefore the last records are always contiguous and are read as zero-copy views.
+    The buffer is also a read-only mapping of field -> values of the last records (oldest first). The values are views, which change with the next append
+    """
+
+    def __init__(self, dtype: np.dtype, maxlen: int, constants: dict = None):
+        """
+        :param dtype: structured dtype of the records
+        :param maxlen: maximum number of records
+        :param constants: fields with a fixed value (for example the symbol), which are returned as they are instead of arrays
+        """
+        self.maxlen = maxlen
+        self.constants = constants if constants is not None else dict()
+
+        self._data = np.zeros(2 * maxlen, dtype=dtype)
+
+        # the records are copied as raw bytes. The source records need the same memory layout, but not the same field names
+        self._raw = self._data.view(np.dtype((np.void, self._data.dtype.itemsize)))
+
+        self._cursor = 0
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """number of records in the buffer"""
+        return self._size
+
+    def append(self, record: typing.Union[np.void, np.ndarray]):
+        """
+        :param record: array of a single structured record (or a record) with the same memory layout as the buffer dtype. The array is faster
+        """
+        if isinstance(record, np.ndarray):
+            raw = record.view(self._raw.dtype)[0]
+        else:
+            raw = np.asarray(record).view(self._raw.dtype)
+
+        c = self._cursor
+        self._raw[c] = raw
+        self._raw[c + self.maxlen] = raw
+
+        self._cursor = c + 1 if c + 1 < self.maxlen else 0
+        if self._size < self.maxlen:
+            self._size += 1
+
+    def replace_last(self, record: typing.Union[np.void, np.ndarray]):
+        """
+        Update the latest record in place
+        :param record: same as append
+        """
+        if self._size == 0:
+            raise IndexError("The buffer is empty")
+
+        if isinstance(record, np.ndarray):
+            raw = record.view(self._raw.dtype)[0]
+        else:
+            raw = np.asarray(record).view(self._raw.dtype)
+
+        c = (self._cursor - 1) % self.maxlen
+        self._raw[c] = raw
+        self._raw[c + self.maxlen] = raw
+
+    def last(self, n: int = None) -> np.ndarray:
+        """
+        :param n: number of records (all if None)
+        :return: view of the last n records (oldest first)
+        """
+        n = self._size if n is None else min(n, self._size)
+        end = (self._cursor - 1) % self.maxlen + self.maxlen + 1
+
+        return self._data[end - n:end]
+
+    def last_record(self) -> np.void:
+        """:return: the latest record"""
+        if self._size == 0:
+            raise IndexError("The buffer is empty")
+
+        return self._data[(self._cursor - 1) % self.maxlen]
+
+    def __getitem__(self, key):
+        if key in self.constants:
+            return self.constants[key]
+
+        if key not in self._data.dtype.names:
+            raise KeyError(key)
+
+        return self.last()[key]
+
+    def __iter__(self):
+        return iter(self._data.dtype.names)
+
+    def __len__(self):
+        return len(self._data.dtype.names)
+
+
 class AsyncInPeriodProvider(object):
     """
-    Run InPeriodProvider in async mode
+    Run InPeriodProvider in async mode. Future periods are prefetched in background threads, but are returned in order.
+    If the provider supports random access (len() and [], like postgres_cache.BarsInPeriodProvider), num_workers threads request the periods out of order.
+    Otherwise a single thread iterates over the provider
     """
 
-    def __init__(self, in_period_provider: typing.Iterable):
+    def __init__(self, in_period_provider: typing.Iterable, prefetch: int = 4, num_workers: int = 1):
         """
         :param in_period_provider: provider
+        :param prefetch: maximum number of periods, which are requested or obtained, but not yet consumed
+        :param num_workers: number of worker threads (random access providers only)
         """
 
+        # assigned before the validation, because __del__ calls close() even if the constructor fails
+        self._state = None
+
+        if prefetch < 1:
+            raise ValueError("prefetch >= 1")
+
         self.in_period_provider = in_period_provider
+        self.prefetch = prefetch
+        self.num_workers = num_workers
 
     def __iter__(self):
-        self._q = queue.Queue()
-
-        self.in_period_provider.__iter__()
+        self.close()
 
-        def it():
-            for i in self.in_period_provider:
-                self._q.put(i)
+        provider = self.in_period_provider
 
-            self._q.put(None)
+        if hasattr(provider, '__len__') and hasattr(provider, '__getitem__'):
+            self._state = _PrefetchState(fetch=provider.__getitem__, length=len(provider), prefetch=self.prefetch)
+            num_workers = self.num_workers
+        else:
+            it = iter(provider)
+            self._state = _PrefetchState(fetch=lambda _: next(it), length=None, prefetch=self.prefetch)
+            num_workers = 1
 
-        threading.Thread(target=it, daemon=True).start()
+        for _ in range(num_workers):
+            threading.Thread(target=self._state.work, daemon=True).start()
 
         return self
 
     def __next__(self):
-        result = self._q.get()
+        try:
+            result = self._state.next() if self._state is not None else None
+        except Exception:
+            self.close()
+            raise
+
         if result is None:
+            self.close()
             raise StopIteration()
 
         return result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Cancel the pending requests. Requests in progress are completed, but their results are discarded"""
+        if self._state is not None:
+            self._state.stop()
+
+    @property
+    def queue_depth(self):
+        """Number of obtained, but not yet consumed periods"""
+        return self._state.queue_depth if self._state is not None else 0
+
+    @property
+    def fetch_count(self):
+        """Number of obtained periods"""
+        return self._state.fetch_count if self._state is not None else 0
+
+    @property
+    def fetch_time(self):
+        """Total time spent in period requests (by all workers)"""
+        return self._state.fetch_time if self._state is not None else datetime.timedelta()
+
+    @property
+    def stall_time(self):
+        """Total time the consumer waited for periods"""
+        return self._state.stall_time if self._state is not None else datetime.timedelta()
+
+
+class _PrefetchState(object):
+    """
+    Shared state of the AsyncInPeriodProvider workers. It doesn't reference the AsyncInPeriodProvider itself, so that the provider can be garbage collected (and cancelled) while the workers are running
+    """
+
+    def __init__(self, fetch: typing.Callable, length: typing.Optional[int], prefetch: int):
+        self._fetch = fetch
+        self._end = length
+        self._prefetch = prefetch
+
+        self._cond = threading.Condition()
+        self._results = dict()
+        self._next_request = 0
+        self._next_result = 0
+        self._stopped = False
+
+        self.fetch_count = 0
+        self.fetch_time = datetime.timedelta()
+        self.stall_time = datetime.timedelta()
+
+    @property
+    def queue_depth(self):
+        return len(self._results)
+
+    def _has_requests(self):
+        return not self._stopped and (self._end is None or self._next_request < self._end)
+
+    def work(self):
+        while True:
+            with self._cond:
+                while self._has_requests() and self._next_request >= self._next_result + self._prefetch:
+                    self._cond.wait()
+
+                if not self._has_requests():
+                    return
+
+                i = self._next_request
+                self._next_request += 1
+
+            now = datetime.datetime.now()
+
+            try:
+                result = (self._fetch(i), None)
+            except StopIteration:
+                with self._cond:
+                    self._end = i if self._end is None else min(self._end, i)
+                    self._cond.notify_all()
+
+                return
+            except Exception as err:
+                logging.getLogger(__name__).exception(err)
+                result = (None, err)
+
+            with self._cond:
+                if not self._stopped:
+                    self.fetch_count += 1
+                    self.fetch_time += datetime.datetime.now() - now
+                    self._results[i] = result
+                    self._cond.notify_all()
+
+    def next(self):
+        now = datetime.datetime.now()
+
+        with self._cond:
+            while self._next_result not in self._results and not self._stopped and (self._end is None or self._next_result < self._end):
+                self._cond.wait()
+
+            self.stall_time += datetime.datetime.now() - now
+
+            if self._next_result not in self._results:
+                return None
+
+            result, err = self._results.pop(self._next_result)
+            self._next_result += 1
+            self._cond.notify_all()
+
+        if err is not None:
+            raise err
+
+        return result
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._results.clear()
+            self._cond.notify_all()
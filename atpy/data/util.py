@@ -1,6 +1,8 @@
 from ftplib import FTP
 from io import StringIO
 
+import numba
+import numpy as np
 import pandas as pd
 
 
@@ -61,14 +63,19 @@ def get_s_and_p_500():
 
 def resample_bars(df: pd.DataFrame, rule: str, period_id: str = 'right') -> pd.DataFrame:
     """
-    Resample bars in higher periods
+    Resample bars in higher periods. Fixed frequency rules (for example 5min, 60min, 1D), which divide the day, are computed in a single pass over the int64 timestamps and symbol codes.
+    Other rules are resampled with pandas
     :param df: data frame
     :param rule: conversion target period (for reference see pandas.DataFrame.resample)
     :param period_id: whether to associate the bar with the beginning or the end of the interval
                     (the inclusion is also closed to the left or right respectively)
     """
+    result = _resample_bars_columnar(df, rule, period_id)
+    if result is not None:
+        return result
+
     if isinstance(df.index, pd.MultiIndex):
-        result = df.groupby(level='symbol', group_keys=False, sort=False) \
+        result = df.groupby(level='symbol', sort=False) \
             .resample(rule, closed=period_id, label=period_id, level='timestamp') \
             .agg({'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'}) \
             .dropna()
@@ -78,3 +85,110 @@ def resample_bars(df: pd.DataFrame, rule: str, period_id: str = 'right') -> pd.D
             .dropna()
 
     return result
+
+
+def _resample_bars_columnar(df: pd.DataFrame, rule: str, period_id: str = 'right'):
+    """
+    Columnar resample_bars for fixed frequency rules
+    :return: resampled bars or None, if the rule is not supported
+    """
+    offset = pd.tseries.frequencies.to_offset(rule)
+    if not isinstance(offset, pd.offsets.Tick) or pd.Timedelta(days=1).value % offset.nanos != 0:
+        return None
+
+    step = offset.nanos
+
+    multiindex = isinstance(df.index, pd.MultiIndex)
+    timestamps = pd.DatetimeIndex(df.index.get_level_values('timestamp') if multiindex else df.index)
+
+    # the buckets are computed in UTC (epoch origin), which is equivalent to the local midnight origin of pandas, if the UTC offsets are multiples of the step
+    ts = timestamps.asi8
+    if timestamps.tz is not None and len(ts) > 0 and np.any((timestamps.tz_localize(None).asi8 - ts) % step != 0):
+        return None
+
+    if multiindex:
+        codes, symbols = pd.factorize(df.index.get_level_values('symbol'), sort=False)
+    else:
+        codes, symbols = np.zeros(len(df), dtype=np.int64), None
+
+    codes = codes.astype(np.int64)
+
+    # sort by symbol (in the order of appearance) and timestamp
+    if len(ts) > 1 and np.any((codes[1:] < codes[:-1]) | ((codes[1:] == codes[:-1]) & (ts[1:] < ts[:-1]))):
+        order = np.lexsort((ts, codes))
+    else:
+        order = None
+
+    def column(c):
+        values = df[c].values if order is None else df[c].values[order]
+        return values.astype(np.float64)
+
+    resampled = _resample_ohlcv(codes if order is None else codes[order], ts if order is None else ts[order],
+                        column('open'), column('high'), column('low'), column('close'), column('volume'),
+                        step, period_id == 'right')
+
+    out_code, out_ts, out_open, out_high, out_low, out_close, out_volume = [a[:resampled[0]] for a in resampled[1:]]
+
+    mask = ~(np.isnan(out_open) | np.isnan(out_high) | np.isnan(out_low) | np.isnan(out_close))
+
+    index = pd.DatetimeIndex(out_ts[mask].astype('M8[ns]'), name='timestamp')
+    if timestamps.tz is not None:
+        index = index.tz_localize('UTC').tz_convert(timestamps.tz)
+
+    if multiindex:
+        index = pd.MultiIndex.from_arrays([symbols[out_code[mask]], index], names=['symbol', 'timestamp'])
+    else:
+        index.name = df.index.name
+
+    result = pd.DataFrame({'open': out_open[mask], 'high': out_high[mask], 'low': out_low[mask], 'close': out_close[mask], 'volume': out_volume[mask].astype(df['volume'].dtype)},
+                          index=index, columns=['open', 'high', 'low', 'close', 'volume'])
+
+    return result
+
+
+@numba.jit(nopython=True, nogil=True)
+def _resample_ohlcv(codes: np.array, timestamps: np.array, open_p: np.array, high_p: np.array, low_p: np.array, close_p: np.array, volume: np.array, step: int, right: bool):
+    """
+    Resample bars sorted by symbol code and timestamp in a single pass. The null values are skipped
+    :param codes: symbol codes
+    :param timestamps: int64 timestamps
+    :param step: bucket size (nanoseconds)
+    :param right: buckets closed on the right and labeled with the end of the interval. Otherwise closed on the left and labeled with the beginning
+    :return: number of buckets and arrays of symbol code, label, open, high, low, close and volume of each bucket
+    """
+    n = codes.size
+    o_code = np.empty(n, dtype=np.int64)
+    o_timestamp = np.empty(n, dtype=np.int64)
+    o_open = np.empty(n, dtype=np.float64)
+    o_high = np.empty(n, dtype=np.float64)
+    o_low = np.empty(n, dtype=np.float64)
+    o_close = np.empty(n, dtype=np.float64)
+    o_volume = np.empty(n, dtype=np.float64)
+
+    k = -1
+    for i in range(n):
+        bucket = (timestamps[i] - 1) // step + 1 if right else timestamps[i] // step
+
+        if k < 0 or codes[i] != o_code[k] or bucket * step != o_timestamp[k]:
+            k += 1
+            o_code[k] = codes[i]
+            o_timestamp[k] = bucket * step
+            o_open[k] = o_high[k] = o_low[k] = o_close[k] = np.nan
+            o_volume[k] = 0
+
+        if np.isnan(o_open[k]):
+            o_open[k] = open_p[i]
+
+        if not np.isnan(high_p[i]) and not high_p[i] <= o_high[k]:
+            o_high[k] = high_p[i]
+
+        if not np.isnan(low_p[i]) and not low_p[i] >= o_low[k]:
+            o_low[k] = low_p[i]
+
+        if not np.isnan(close_p[i]):
+            o_close[k] = close_p[i]
+
+        if not np.isnan(volume[i]):
+            o_volume[k] += volume[i]
+
+    return k + 1, o_code, o_timestamp, o_open, o_high, o_low, o_close, o_volume
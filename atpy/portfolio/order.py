@@ -103,6 +103,10 @@ class StopMarketOrder(BaseOrder):
 
         return super().add_position(quantity, price) if self._is_market else False
 
+    @property
+    def triggered(self):
+        return self._is_market
+
 
 class StopLimitOrder(BaseOrder):
     def __init__(self, order_type: Type, symbol: str, quantity: int, stop_price: float, limit_price: float, uid=None):
@@ -120,3 +124,7 @@ class StopLimitOrder(BaseOrder):
             return super().add_position(quantity, price)
 
         return False
+
+    @property
+    def triggered(self):
+        return self._is_limit
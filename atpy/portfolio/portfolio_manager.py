@@ -2,8 +2,10 @@ import logging
 import threading
 from collections import Collection
 
+import numpy as np
 import pandas as pd
 
+from atpy.data.ts_util import last_rows
 from atpy.portfolio.order import *
 from pyevents.events import EventFilter
 
@@ -11,13 +13,18 @@ from pyevents.events import EventFilter
 class PortfolioManager(object):
     """Orders portfolio manager"""
 
-    def __init__(self, listeners, initial_capital: float, fulfilled_orders_event_stream, bar_event_stream=None, tick_event_stream=None, uid=None, orders=None):
+    def __init__(self, listeners, initial_capital: float, fulfilled_orders_event_stream, bar_event_stream=None, tick_event_stream=None, uid=None, orders=None, coalesce_value_updates: bool = False,
+                 tick_batch_event_stream=None):
         """
         :param fulfilled_orders_event_stream: event stream for fulfilled order events
         :param bar_event_stream: event stream for bar data events
         :param tick_event_stream: event stream for tick data events
+        :param tick_batch_event_stream: event stream for batches of tick data (dataframe with one row per tick, see IQFeedLevel1Listener update_batch_interval).
+                A single portfolio_value_update event is emitted for each batch
         :param uid: unique id for this portfolio manager
-        :param orders: a list of pre-existing orders
+        :param orders: a list of pre-existing orders. Orders should only be added via add_order afterwards, because the cash/positions ledger is updated incrementally
+        :param coalesce_value_updates: on each bar event, update the values of all symbols at once and emit a single portfolio_value_update event,
+                which also carries the mark-to-market value of all symbols. Otherwise, emit one event for each order
         """
 
         self.listeners = listeners
@@ -30,18 +37,58 @@ class PortfolioManager(object):
         if tick_event_stream is not None:
             tick_event_stream += self.process_tick_data
 
+        if tick_batch_event_stream is not None:
+            tick_batch_event_stream += self.process_tick_batch
+
         self.initial_capital = initial_capital
+        self.coalesce_value_updates = coalesce_value_updates
         self._id = uid if uid is not None else uuid.uuid4()
         self.orders = orders if orders is not None else list()
         self._lock = threading.RLock()
         self._values = dict()
 
+        self._build_ledger()
+
+    def _build_ledger(self):
+        """Build the incrementally updated cash/positions ledger from the existing orders"""
+        self._uids = set()
+        self._turnover = 0
+        self._commissions = 0
+        self._quantities = dict()
+        self._last_fills = dict()
+
+        for o in self.orders:
+            self._update_ledger(o)
+
+    def _update_ledger(self, order: BaseOrder):
+        self._uids.add(order.uid)
+
+        cost = order.cost
+        if order.order_type == Type.SELL:
+            self._turnover += cost
+        elif order.order_type == Type.BUY:
+            self._turnover -= cost
+
+        self._commissions += order.commission
+
+        quantity = self._quantities.get(order.symbol, 0)
+        if order.order_type == Type.BUY:
+            quantity += order.quantity
+        elif order.order_type == Type.SELL:
+            quantity -= order.quantity
+
+        self._quantities[order.symbol] = quantity
+
+        # the earliest added order wins among orders with the same fulfill time
+        if order.symbol not in self._last_fills or order.fulfill_time > self._last_fills[order.symbol].fulfill_time:
+            self._last_fills[order.symbol] = order
+
     def add_order(self, order: BaseOrder):
         with self._lock:
             if order.fulfill_time is None:
                 raise Exception("Order has no fulfill_time set")
 
-            if len([o for o in self.orders if o.uid == order.uid]) > 0:
+            if order.uid in self._uids:
                 raise Exception("Attempt to fulfill existing order")
 
             if order.order_type == Type.SELL and self._quantity(order.symbol) < order.quantity:
@@ -51,6 +98,7 @@ class PortfolioManager(object):
                 raise Exception("Not enough capital to fulfill order")
 
             self.orders.append(order)
+            self._update_ledger(order)
 
             self.listeners({'type': 'watch_ticks', 'data': order.symbol})
             self.listeners({'type': 'portfolio_update', 'data': self})
@@ -64,7 +112,7 @@ class PortfolioManager(object):
     def symbols(self):
         """Get list of all orders/symbols"""
 
-        return set([o.symbol for o in self.orders])
+        return set(self._quantities)
 
     @property
     def capital(self):
@@ -75,18 +123,7 @@ class PortfolioManager(object):
 
     @property
     def _capital(self):
-        turnover = 0
-        commissions = 0
-        for o in self.orders:
-            cost = o.cost
-            if o.order_type == Type.SELL:
-                turnover += cost
-            elif o.order_type == Type.BUY:
-                turnover -= cost
-
-            commissions += o.commission
-
-        return self.initial_capital + turnover - commissions
+        return self.initial_capital + self._turnover - self._commissions
 
     def quantity(self, symbol=None):
         with self._lock:
@@ -94,23 +131,9 @@ class PortfolioManager(object):
 
     def _quantity(self, symbol=None):
         if symbol is not None:
-            quantity = 0
-
-            for o in [o for o in self.orders if o.symbol == symbol]:
-                if o.order_type == Type.BUY:
-                    quantity += o.quantity
-                elif o.order_type == Type.SELL:
-                    quantity -= o.quantity
-
-            return quantity
+            return self._quantities.get(symbol, 0)
         else:
-            result = dict()
-            for s in set([o.symbol for o in self.orders]):
-                qty = self._quantity(s)
-                if qty > 0:
-                    result[s] = qty
-
-            return result
+            return {s: qty for s, qty in self._quantities.items() if qty > 0}
 
     def value(self, symbol=None, multiply_by_quantity=False):
         with self._lock:
@@ -120,27 +143,34 @@ class PortfolioManager(object):
         if symbol is not None:
             if symbol not in self._values:
                 logging.getLogger(__name__).debug("No current information available for %s. Falling back to last traded price" % symbol)
-                symbol_orders = [o for o in self.orders if o.symbol == symbol]
-                order = sorted(symbol_orders, key=lambda o: o.fulfill_time, reverse=True)[0]
-                return order.last_cost_per_share * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
+                return self._last_fills[symbol].last_cost_per_share * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
             else:
                 return self._values[symbol] * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
         else:
-            result = dict()
-            for s in set([o.symbol for o in self.orders]):
-                result[s] = self._value(symbol=s, multiply_by_quantity=multiply_by_quantity)
-
-            return result
+            return {s: self._value(symbol=s, multiply_by_quantity=multiply_by_quantity) for s in self._quantities}
 
     def process_tick_data(self, data):
         with self._lock:
             symbol = data['symbol']
-            if symbol in [o.symbol for o in self.orders]:
+            if symbol in self._quantities:
                 self._values[symbol] = data['bid'][-1] if isinstance(data['bid'], Collection) else data['bid']
                 self.listeners({'type': 'portfolio_value_update', 'data': self})
 
+    def process_tick_batch(self, data):
+        with self._lock:
+            last = data.drop_duplicates('symbol', keep='last')
+            last = last.loc[last['symbol'].isin(list(self._quantities))]
+
+            if not last.empty:
+                self._values.update(zip(last['symbol'], last['bid']))
+                self.listeners({'type': 'portfolio_value_update', 'data': self})
+
     def process_bar_data(self, data):
         with self._lock:
+            if self.coalesce_value_updates:
+                self._process_bar_data_batch(data)
+                return
+
             symbols = data.index.get_level_values(level='symbol')
 
             for o in [o for o in self.orders if o.symbol in symbols]:
@@ -149,6 +179,15 @@ class PortfolioManager(object):
                     self._values[o.symbol] = slc[-1]
                     self.listeners({'type': 'portfolio_value_update', 'data': self})
 
+    def _process_bar_data_batch(self, data):
+        symbols = list(self._quantities)
+        rows = last_rows(data, symbols)
+
+        found = np.flatnonzero(rows >= 0)
+        if len(found) > 0:
+            self._values.update(zip([symbols[i] for i in found], data['close'].values[rows[found]]))
+            self.listeners({'type': 'portfolio_value_update', 'data': self, 'mark_to_market': self._value(multiply_by_quantity=True)})
+
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
         # all our instance attributes. Always use the dict.copy()
@@ -164,3 +203,7 @@ class PortfolioManager(object):
         # Restore instance attributes (i.e., _lock).
         self.__dict__.update(state)
         self._lock = threading.RLock()
+
+        # state, pickled before the ledger was introduced
+        if '_quantities' not in state:
+            self._build_ledger()
@@ -0,0 +1,23 @@
+#!/bin/python3
+
+import argparse
+import logging
+import os
+
+from atpy.data.cache.mmap_cache import lmdb_to_mmap
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="LMDB to memory mapped bars cache configuration")
+    parser.add_argument('-lmdb_path', type=str, default=None, help="LMDB Path")
+    parser.add_argument('-mmap_path', type=str, default=None, help="Memory mapped cache path")
+    parser.add_argument('-overwrite', action='store_true', default=False, help="Overwrite existing keys")
+
+    args = parser.parse_args()
+
+    lmdb_path = args.lmdb_path if args.lmdb_path is not None else os.environ['ATPY_LMDB_PATH']
+    mmap_path = args.mmap_path if args.mmap_path is not None else os.environ['ATPY_MMAP_PATH']
+
+    for key in lmdb_to_mmap(lmdb_path=lmdb_path, mmap_path=mmap_path, overwrite=args.overwrite):
+        logging.info('Saving ' + key)
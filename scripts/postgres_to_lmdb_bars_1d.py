@@ -8,7 +8,7 @@ import os
 import psycopg2
 from dateutil.relativedelta import relativedelta
 
-from atpy.data.cache.lmdb_cache import *
+from atpy.data.cache.lmdb_cache import LmdbCache
 from atpy.data.cache.postgres_cache import BarsInPeriodProvider
 
 if __name__ == "__main__":
@@ -17,6 +17,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="PostgreSQL to LMDB configuration")
     parser.add_argument('-lmdb_path', type=str, default=None, help="LMDB Path")
     parser.add_argument('-delta_back', type=int, default=8, help="Default number of years to look back")
+    parser.add_argument('-batch_size', type=int, default=16, help="Number of periods, saved in a single transaction")
     args = parser.parse_args()
 
     lmdb_path = args.lmdb_path if args.lmdb_path is not None else os.environ['ATPY_LMDB_PATH']
@@ -29,6 +30,16 @@ if __name__ == "__main__":
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=1, interval_type='d', bars_table='bars_1d', bgn_prd=bgn_prd, delta=relativedelta(years=1),
                                           overlap=relativedelta(microseconds=-1))
 
-    for i, df in enumerate(bars_in_period):
-        logging.info('Saving ' + bars_in_period.current_cache_key())
-        write(bars_in_period.current_cache_key(), df, lmdb_path)
+    with LmdbCache(lmdb_path) as cache:
+        batch = list()
+        for df in bars_in_period:
+            key = bars_in_period.current_cache_key()
+            batch.append((key, df))
+            logging.info('Saving ' + key)
+
+            if len(batch) >= args.batch_size:
+                cache.put_many(batch)
+                batch = list()
+
+        if batch:
+            cache.put_many(batch)
@@ -2,14 +2,13 @@
 
 import argparse
 import datetime
-import functools
 import logging
 import os
 
 import psycopg2
 from dateutil.relativedelta import relativedelta
 
-from atpy.data.cache.lmdb_cache import *
+from atpy.data.cache.lmdb_cache import LmdbCache
 from atpy.data.cache.postgres_cache import BarsInPeriodProvider, request_adjustments
 from atpy.data.splits_dividends import adjust_df
 
@@ -21,6 +20,7 @@ if __name__ == "__main__":
     parser.add_argument('-delta_back', type=int, default=8, help="Default number of years to look back")
     parser.add_argument('-adjust_splits', action='store_true', default=True, help="Adjust splits before saving")
     parser.add_argument('-adjust_dividends', action='store_true', default=False, help="Adjust dividends before saving")
+    parser.add_argument('-batch_size', type=int, default=16, help="Number of periods, saved in a single transaction")
 
     args = parser.parse_args()
 
@@ -40,16 +40,27 @@ if __name__ == "__main__":
     bgn_prd = datetime.datetime(now.year - args.delta_back, 1, 1)
     bgn_prd = bgn_prd + relativedelta(days=7 - bgn_prd.weekday())
 
-    cache_read = functools.partial(read_pickle, lmdb_path=lmdb_path)
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=300, interval_type='s', bars_table='bars_5m', bgn_prd=bgn_prd, delta=relativedelta(days=7),
-                                          overlap=relativedelta(microseconds=-1), cache=cache_read)
+                                          overlap=relativedelta(microseconds=-1))
 
-    for i, df in enumerate(bars_in_period):
-        if cache_read(bars_in_period.current_cache_key()) is None:
+    with LmdbCache(lmdb_path) as cache:
+        batch = list()
+        for i in range(len(bars_in_period)):
+            key = bars_in_period.cache_key(i)
+            if key in cache:
+                logging.info('Cache hit on ' + key)
+                continue
+
+            df = bars_in_period[i]
             if adjustments is not None:
                 adjust_df(df, adjustments)
 
-            write(bars_in_period.current_cache_key(), df, lmdb_path)
-            logging.info('Saving ' + bars_in_period.current_cache_key())
-        else:
-            logging.info('Cache hit on ' + bars_in_period.current_cache_key())
+            batch.append((key, df))
+            logging.info('Saving ' + key)
+
+            if len(batch) >= args.batch_size:
+                cache.put_many(batch)
+                batch = list()
+
+        if batch:
+            cache.put_many(batch)
@@ -11,8 +11,7 @@ from influxdb import InfluxDBClient
 
 import atpy.data.iqfeed.util as iqutil
 from atpy.data.iqfeed.iqfeed_influxdb_cache import update_fundamentals, update_splits_dividends
-from atpy.data.iqfeed.iqfeed_level_1_provider import IQFeedLevel1Listener
-from atpy.data.iqfeed.iqfeed_level_1_provider import get_fundamentals
+from atpy.data.iqfeed.iqfeed_level_1_provider import IQFeedFundamentalsProvider
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -44,10 +43,10 @@ if __name__ == "__main__":
 
     client.switch_database(args.database)
 
-    with IQFeedLevel1Listener(fire_ticks=False) as listener:
+    with IQFeedFundamentalsProvider() as provider:
         all_symbols = set(iqutil.get_symbols(symbols_file=args.symbols_file).keys())
 
-        fundamentals = get_fundamentals(all_symbols)
+        fundamentals = provider.fundamentals(all_symbols)
 
         if args.update_fundamentals:
             update_fundamentals(client=client, fundamentals=fundamentals.values())
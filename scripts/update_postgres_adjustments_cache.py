@@ -11,8 +11,7 @@ import psycopg2
 
 import atpy.data.iqfeed.util as iqutil
 from atpy.data.cache.postgres_cache import insert_df_json, create_json_data
-from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends, IQFeedLevel1Listener
-from pyevents.events import SyncListeners
+from atpy.data.iqfeed.iqfeed_level_1_provider import IQFeedFundamentalsProvider
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -29,8 +28,8 @@ if __name__ == "__main__":
 
     all_symbols = set(iqutil.get_symbols(symbols_file=args.symbols_file).keys())
 
-    with IQFeedLevel1Listener(listeners=SyncListeners(), fire_ticks=False) as listener:
-        adjustments = get_splits_dividends(all_symbols, listener.conn)
+    with IQFeedFundamentalsProvider() as provider:
+        adjustments = provider.splits_dividends(all_symbols)
 
         table_name = 'json_data'
         cur = con.cursor()
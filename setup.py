@@ -80,7 +80,7 @@ setup(
         'influxdb': ['influxdb'],
         'TA-Lib': ['TA-Lib'],
         'quandl': ['quandl'],
-        'postgres': ['psycopg2-binary', 'lmdb'],
+        'postgres': ['psycopg2-binary', 'lmdb', 'lz4'],
         'sqlalchemy': ['sqlalchemy'],
     },
 
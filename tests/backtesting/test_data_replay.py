@@ -1,13 +1,36 @@
 import random
 import unittest
 
-from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
+import numpy as np
+from pandas.util.testing import assert_frame_equal
+
+from atpy.backtesting.data_replay import DataReplay, DataReplayEvents, DataWindow
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.latest_data_snapshot import LatestDataSnapshot
 from atpy.data.ts_util import current_period, AsyncInPeriodProvider
 from pyevents.events import SyncListeners
 
 
+def random_bar_chunks(seed: int, steps: int = 2000, width: int = 20, chunk_len: int = 500):
+    """
+    Generate random timestamp/symbol multiindex bar chunks with missing timestamps and symbols
+    """
+    rng = np.random.RandomState(seed)
+    timestamps = pd.date_range('2018-01-02 14:30', periods=steps, freq='T', tz='UTC')
+    timestamps = timestamps[np.sort(rng.choice(steps, int(steps * 0.8), replace=False))]
+
+    result = list()
+    for i in range(0, len(timestamps), chunk_len):
+        index = pd.MultiIndex.from_product([timestamps[i:i + chunk_len], ['S' + str(j) for j in range(width)]], names=['timestamp', 'symbol'])
+        df = pd.DataFrame({'close': rng.rand(len(index)), 'volume': rng.randint(1, 100, len(index)).astype('uint64')}, index=index)
+        df = df.sample(frac=0.7, random_state=seed + i).sort_index()
+        df['timestamp'] = df.index.get_level_values('timestamp')
+        df['symbol'] = df.index.get_level_values('symbol')
+        result.append(df)
+
+    return result
+
+
 class TestDataReplay(unittest.TestCase):
     """
     Test Data Replay
@@ -343,6 +366,97 @@ class TestDataReplay(unittest.TestCase):
             self.assertIsNotNone(prev_t)
             self.assertEqual(batch_len, snapshots_count['count'])
 
+    def test_array_timeline(self):
+        for historical_depth in (0, 10):
+            dr = DataReplay()
+            array_dr = DataReplay(array_timeline=True)
+
+            for i in range(3):
+                chunks = random_bar_chunks(seed=i)
+                dr.add_source(list(chunks), 'e' + str(i), historical_depth=historical_depth)
+                array_dr.add_source(list(chunks), 'e' + str(i), historical_depth=historical_depth)
+
+            steps = 0
+            for r, array_r in zip(dr, array_dr):
+                self.assertEqual(list(r.keys()), list(array_r.keys()))
+                self.assertEqual(r['timestamp'], array_r['timestamp'])
+
+                for e in [e for e in r if isinstance(r[e], pd.DataFrame)]:
+                    assert_frame_equal(r[e], array_r[e])
+
+                steps += 1
+
+            self.assertGreater(steps, 0)
+            self.assertRaises(StopIteration, next, array_dr)
+
+    def test_zero_copy(self):
+        dr = DataReplay()
+        zero_copy_dr = DataReplay(array_timeline=True)
+
+        for i in range(3):
+            chunks = random_bar_chunks(seed=i)
+            dr.add_source(list(chunks), 'e' + str(i), historical_depth=10)
+            zero_copy_dr.add_source(list(chunks), 'e' + str(i), historical_depth=10, zero_copy=True)
+
+        self.assertRaises(Exception, iter, DataReplay().add_source([], 'e', zero_copy=True))
+
+        steps = 0
+        for r, zero_copy_r in zip(dr, zero_copy_dr):
+            self.assertEqual(list(r.keys()), list(zero_copy_r.keys()))
+
+            for e in [e for e in r if isinstance(r[e], pd.DataFrame)]:
+                df, window = r[e], zero_copy_r[e]
+                self.assertTrue(isinstance(window, DataWindow))
+                self.assertEqual(len(df), len(window))
+                self.assertEqual(list(df.columns), window.columns)
+                self.assertTrue(df.index.equals(window.index))
+
+                for c in df.columns:
+                    np.testing.assert_array_equal(df[c].values, window[c])
+                    self.assertFalse(window[c].flags.writeable)
+                    self.assertIsNotNone(window[c].base)
+
+                assert_frame_equal(df, window.to_frame())
+
+            steps += 1
+
+        self.assertGreater(steps, 0)
+
+    def test_zero_copy_pre_data(self):
+        def add_column(event):
+            df = event['e_full']
+            df['dollar_volume'] = df['close'] * df['volume']
+
+        results = list()
+        for zero_copy in (False, True):
+            listeners = SyncListeners()
+            listeners += add_column
+
+            dr = DataReplay(array_timeline=True).add_source(random_bar_chunks(seed=1), 'e', historical_depth=10, listeners=listeners, zero_copy=zero_copy)
+            results.append([r['e'].to_frame() if zero_copy else r['e'] for r in dr if 'e' in r])
+
+        self.assertGreater(len(results[0]), 0)
+        self.assertEqual(len(results[0]), len(results[1]))
+
+        for df, window_df in zip(*results):
+            self.assertIn('dollar_volume', window_df.columns)
+            assert_frame_equal(df, window_df)
+
+    def test_array_timeline_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        for sources in (1, 4, 8):
+            for array_timeline in (False, True):
+                dr = DataReplay(array_timeline=array_timeline)
+                for i in range(sources):
+                    dr.add_source(random_bar_chunks(seed=i), 'e' + str(i), historical_depth=100)
+
+                now = datetime.datetime.now()
+                steps = sum(1 for _ in dr)
+                elapsed = datetime.datetime.now() - now
+
+                logging.getLogger(__name__).debug('%d sources, array_timeline=%s: %d steps in %s; %.1f steps/s' % (sources, array_timeline, steps, elapsed, steps / elapsed.total_seconds()))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,79 @@
+import random
 import unittest
 
+import numpy as np
+
 from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
 from atpy.backtesting.mock_exchange import MockExchange, StaticSlippageLoss, PerShareCommissionLoss
 from atpy.data.iqfeed.iqfeed_bar_data_provider import *
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.iqfeed.iqfeed_level_1_provider import *
+from atpy.data.iqfeed.util import iqfeed_dtype
+from atpy.data.ts_util import RingBuffer
 from atpy.portfolio.order import *
 from pyevents.events import *
+from tests.backtesting.test_data_replay import random_bar_chunks
+from tests.iqfeed.test_streaming_level_1 import LEVEL_1_DTYPE, level_1_record
+
+
+class LegacyMockExchange(MockExchange):
+    """MockExchange with the original order by order bar matching, used as reference"""
+
+    def process_bar_data(self, data):
+        with self._lock:
+            symbols = data.index.get_level_values(level='symbol')
+
+            symbol_ind = data.index.names.index('symbol')
+
+            for o in [o for o in self._pending_orders if o.symbol in symbols]:
+                ix = pd.IndexSlice[:, o.symbol] if symbol_ind == 1 else pd.IndexSlice[o.symbol, :]
+                slc = data.loc[ix, :]
+
+                if not slc.empty:
+                    price, volume = self.order_processor(o, slc.iloc[-1]['close'], slc.iloc[-1]['volume'])
+
+                    o.add_position(min(o.quantity - o.obtained_quantity, volume), price)
+
+                    o.commission = self.commission_loss(o)
+
+                    if o.fulfill_time is not None:
+                        self._pending_orders.remove(o)
+
+                        self.listeners({'type': 'order_fulfilled', 'data': o})
+
+
+def random_orders(seed: int, count: int, symbols: int):
+    """Random orders of all types"""
+    rnd = random.Random(seed)
+
+    result = list()
+    for i in range(count):
+        order_type, symbol, quantity = rnd.choice([Type.BUY, Type.SELL]), 'S' + str(rnd.randrange(symbols)), rnd.randint(1, 300)
+        kind = rnd.randrange(4)
+        if kind == 0:
+            result.append(MarketOrder(order_type, symbol, quantity))
+        elif kind == 1:
+            result.append(LimitOrder(order_type, symbol, quantity, rnd.random()))
+        elif kind == 2:
+            result.append(StopMarketOrder(order_type, symbol, quantity, rnd.random()))
+        else:
+            result.append(StopLimitOrder(order_type, symbol, quantity, rnd.random(), rnd.random()))
+
+    return result
+
+
+def random_level_1_ticks(seed: int, count: int, symbols: int) -> pd.DataFrame:
+    """Level 1 updates of multiple symbols in the format of the level_1_update_batch events"""
+    rnd = np.random.RandomState(seed)
+
+    price = 1 + np.abs(rnd.randn(count)) * 0.1
+    return pd.DataFrame({'symbol': np.array(['S' + str(i) for i in range(symbols)], dtype=object)[rnd.randint(0, symbols, count)],
+                         'most_recent_trade': price,
+                         'most_recent_trade_size': rnd.randint(1, 100, count),
+                         'bid': price - 0.01,
+                         'bid_size': rnd.randint(0, 3, count) * 10,
+                         'ask': price + 0.01,
+                         'ask_size': rnd.randint(0, 3, count) * 10})
 
 
 class TestMockExchange(unittest.TestCase):
@@ -333,6 +400,139 @@ class TestMockExchange(unittest.TestCase):
         self.assertGreater(o3.cost, 0)
         self.assertIsNotNone(o3.fulfill_time)
 
+    def test_vectorized_bar_matching(self):
+        for order_processor in [StaticSlippageLoss(0.01, max_order_volume=0.5), None]:
+            self._test_vectorized_bar_matching(order_processor)
+
+    def _test_vectorized_bar_matching(self, order_processor):
+        results = list()
+        for exchange_type in [LegacyMockExchange, MockExchange]:
+            listeners = SyncListeners()
+            order_request_events = SyncListeners()
+
+            me = exchange_type(listeners=listeners,
+                               order_requests_event_stream=order_request_events,
+                               order_processor=order_processor,
+                               commission_loss=PerShareCommissionLoss(0.1))
+
+            fulfilled = list()
+            listeners += lambda e: fulfilled.append(e['data'].uid) if e['type'] == 'order_fulfilled' else None
+
+            # orders are placed at different times and some of them are never filled
+            orders = random_orders(seed=5, count=400, symbols=35)
+            it = iter(DataReplay().add_source(random_bar_chunks(seed=3, steps=300, width=30, chunk_len=100), 'data', historical_depth=5))
+            for i, o in enumerate(orders):
+                order_request_events(o)
+                if i % 50 == 0:
+                    me.process_bar_data(next(it)['data'])
+
+            d = next(it, None)
+            while d is not None:
+                me.process_bar_data(d['data'])
+                d = next(it, None)
+
+            results.append((orders, fulfilled))
+
+        (legacy_orders, legacy_fulfilled), (orders, fulfilled) = results
+
+        self.assertGreater(len(fulfilled), 0)
+        self.assertLess(len(fulfilled), len(orders))
+        self.assertEqual([legacy_orders.index(o) for o in legacy_orders if o.uid in legacy_fulfilled], [orders.index(o) for o in orders if o.uid in fulfilled])
+
+        for lo, o in zip(legacy_orders, orders):
+            self.assertEqual(lo.obtained_quantity, o.obtained_quantity)
+            self.assertAlmostEqual(lo.cost, o.cost)
+            self.assertAlmostEqual(lo.commission, o.commission)
+            self.assertEqual(lo.fulfill_time is None, o.fulfill_time is None)
+
+    def test_default_order_processor(self):
+        me = MockExchange(listeners=SyncListeners(), order_requests_event_stream=SyncListeners())
+        o = MarketOrder(Type.BUY, 'S0', 10)
+
+        # the price and the volume are not modified (including fractional and missing volumes)
+        self.assertEqual(me.order_processor(o, 1.5, 2.5), (1.5, 2.5))
+
+        prices, volumes = me.order_processor.process_many(np.array([True, False]), np.array([1.5, 2.5]), np.array([2.5, np.nan]))
+        self.assertEqual(list(prices), [1.5, 2.5])
+        self.assertEqual(volumes[0], 2.5)
+        self.assertTrue(np.isnan(volumes[1]))
+
+    def test_tick_batches(self):
+        ticks = random_level_1_ticks(seed=1, count=5000, symbols=20)
+
+        results = list()
+        for batch in [False, True]:
+            order_request_events = SyncListeners()
+            me = MockExchange(listeners=SyncListeners(), order_requests_event_stream=order_request_events, order_processor=StaticSlippageLoss(0.01), commission_loss=PerShareCommissionLoss(0.1))
+
+            orders = [MarketOrder(Type.BUY if i % 2 == 0 else Type.SELL, 'S' + str(i % 25), 100 + i) for i in range(60)]
+            for o in orders:
+                order_request_events(o)
+
+            if batch:
+                for b in np.array_split(ticks, 50):
+                    me.process_tick_batch(b)
+            else:
+                for t in ticks.to_dict('records'):
+                    me.process_tick_data(t)
+
+            results.append(orders)
+
+        for lo, o in zip(*results):
+            self.assertEqual(lo.obtained_quantity, o.obtained_quantity)
+            self.assertAlmostEqual(lo.cost, o.cost)
+            self.assertAlmostEqual(lo.commission, o.commission)
+            self.assertEqual(lo.fulfill_time is None, o.fulfill_time is None)
+
+        # the orders of the symbols without ticks are pending
+        self.assertTrue(all(o.fulfill_time is None for o in results[1] if o.symbol in {'S20', 'S21', 'S22', 'S23', 'S24'}))
+        self.assertTrue(any(o.fulfill_time is not None for o in results[1]))
+
+    def test_tick_snapshot(self):
+        # market snapshots of IQFeedLevel1Listener with mkt_snapshot_depth > 0 and the default level 1 fields
+        order_request_events = SyncListeners()
+        me = MockExchange(listeners=SyncListeners(), order_requests_event_stream=order_request_events)
+
+        o1 = MarketOrder(Type.BUY, 'IBM', 3)
+        order_request_events(o1)
+
+        o2 = MarketOrder(Type.SELL, 'IBM', 1)
+        order_request_events(o2)
+
+        snapshot = RingBuffer(iqfeed_dtype(LEVEL_1_DTYPE), 5, constants={'symbol': 'IBM'})
+        for i in range(3):
+            snapshot.append(level_1_record('IBM', i))
+
+        me.process_tick_data(snapshot)
+
+        self.assertEqual(o1.obtained_quantity, 3)
+        self.assertAlmostEqual(o1.last_cost_per_share, 50.03)
+        self.assertIsNotNone(o1.fulfill_time)
+
+        self.assertEqual(o2.obtained_quantity, 1)
+        self.assertGreater(o2.cost, 0)
+        self.assertIsNotNone(o2.fulfill_time)
+
+        self.assertEqual(len(me._pending_orders), 0)
+
+    def test_bar_matching_performance(self):
+        data = random_bar_chunks(seed=1, steps=20, width=3000, chunk_len=20)[0]
+
+        for count in [10, 100, 1000]:
+            for exchange_type in [LegacyMockExchange, MockExchange]:
+                order_request_events = SyncListeners()
+                me = exchange_type(listeners=SyncListeners(), order_requests_event_stream=order_request_events, order_processor=StaticSlippageLoss(0.01))
+
+                # limit orders, which are never filled
+                for i in range(count):
+                    order_request_events(LimitOrder(Type.BUY, 'S' + str(i % 3000), 10, -1))
+
+                now = datetime.datetime.now()
+                for _ in range(5):
+                    me.process_bar_data(data)
+
+                logging.getLogger(__name__).debug(exchange_type.__name__ + " with " + str(count) + " orders: " + str((datetime.datetime.now() - now) / 5) + " per bar")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+import logging
+import os
+import unittest
+
+from pandas.util.testing import assert_frame_equal
+
+from atpy.backtesting.mock_exchange import MockExchange, StaticSlippageLoss
+from atpy.backtesting.parameter_sweep import ParameterSweep
+from atpy.portfolio.portfolio_manager import PortfolioManager, MarketOrder, Type
+from pyevents.events import EventFilter
+from tests.backtesting.test_data_replay import random_bar_chunks
+
+
+class BuyOnceStrategy(object):
+    """Buy fixed quantity of a symbol on the first bar"""
+
+    def __init__(self, listeners, bar_event_stream, symbol, quantity):
+        self.listeners = listeners
+        self.symbol = symbol
+        self.quantity = quantity
+        self._done = False
+
+        bar_event_stream += self.on_bar_event
+
+    def on_bar_event(self, data):
+        if not self._done and self.symbol in data.index.get_level_values('symbol'):
+            self._done = True
+            self.listeners({'type': 'order_request', 'data': MarketOrder(Type.BUY, self.symbol, self.quantity)})
+
+    def order_requests_stream(self):
+        return EventFilter(listeners=self.listeners,
+                           event_filter=lambda e: True if ('type' in e and e['type'] == 'order_request') else False,
+                           event_transformer=lambda e: (e['data'],))
+
+
+def build_run(dre, configuration):
+    bars = dre.event_filter_by_source('bars')
+
+    strategy = BuyOnceStrategy(listeners=dre.listeners, bar_event_stream=bars, symbol=configuration['symbol'], quantity=configuration['quantity'])
+
+    me = MockExchange(listeners=dre.listeners,
+                      order_requests_event_stream=strategy.order_requests_stream(),
+                      bar_event_stream=bars,
+                      order_processor=StaticSlippageLoss(configuration['slippage']))
+
+    return PortfolioManager(listeners=dre.listeners, initial_capital=10000, fulfilled_orders_event_stream=me.fulfilled_orders_stream(), bar_event_stream=bars)
+
+
+def build_crashing_run(dre, configuration):
+    # simulate a process, which is killed without posting its result (for example out of memory)
+    if configuration['crash']:
+        os._exit(configuration['exit_code'])
+
+    return build_run(dre, configuration)
+
+
+class TestParameterSweep(unittest.TestCase):
+    """
+    Test parameter sweep
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.INFO)
+
+    def test_sweep(self):
+        configurations = [{'symbol': 'S' + str(i % 4), 'quantity': 10 + i, 'slippage': 0.001 * i} for i in range(8)]
+
+        sweep = ParameterSweep(build_run=build_run, configurations=configurations, array_timeline=True)
+        sweep.add_source(random_bar_chunks(seed=1, steps=1000, width=10), 'bars', historical_depth=5)
+        result = sweep.run()
+
+        self.assertEqual(len(result), len(configurations))
+        self.assertEqual(list(result['quantity']), [c['quantity'] for c in configurations])
+        self.assertTrue((result['orders'] == 1).all())
+        self.assertTrue((result['capital'] < 10000).all())
+        self.assertGreater(sweep.chunks, 0)
+        self.assertIsNotNone(sweep.wall_time)
+        self.assertIsNotNone(sweep.chunk_load_time)
+
+        mp_sweep = ParameterSweep(build_run=build_run, configurations=configurations, array_timeline=True, num_processes=3)
+        mp_sweep.add_source(random_bar_chunks(seed=1, steps=1000, width=10), 'bars', historical_depth=5)
+        mp_result = mp_sweep.run()
+
+        assert_frame_equal(result, mp_result)
+        self.assertEqual(sweep.chunks, mp_sweep.chunks)
+
+        # the processes of a repeated sweep share the resource tracker of this process
+        mp_sweep = ParameterSweep(build_run=build_run, configurations=configurations, array_timeline=False, num_processes=2)
+        mp_sweep.add_source(random_bar_chunks(seed=1, steps=1000, width=10), 'bars', historical_depth=5)
+        assert_frame_equal(result, mp_sweep.run())
+
+    def test_dead_process(self):
+        for exit_code in (1, 0):
+            configurations = [{'symbol': 'S' + str(i % 4), 'quantity': 10 + i, 'slippage': 0.001 * i, 'crash': i == 1, 'exit_code': exit_code} for i in range(4)]
+
+            sweep = ParameterSweep(build_run=build_crashing_run, configurations=configurations, num_processes=2, poll_interval=0.1)
+            sweep.add_source(random_bar_chunks(seed=1, steps=1000, width=10), 'bars', historical_depth=5)
+
+            with self.assertRaises(Exception) as cm:
+                sweep.run()
+
+            self.assertIn("Sweep process 1 exited unexpectedly with exit code " + str(exit_code), str(cm.exception))
+            self.assertIn("'quantity': 11", str(cm.exception))
+            self.assertIn("'quantity': 13", str(cm.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
+from atpy.backtesting.mock_exchange import MockExchange, StaticSlippageLoss, PerShareCommissionLoss
+from atpy.backtesting.random_strategy import RandomStrategy
+from atpy.backtesting.recorder import Recorder, ColumnBuffer
+from atpy.portfolio.portfolio_manager import PortfolioManager
+from pyevents.events import SyncListeners
+from tests.backtesting.test_data_replay import random_bar_chunks
+
+
+class TestRecorder(unittest.TestCase):
+    """
+    Test backtest recorder
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_column_buffer(self):
+        buffer = ColumnBuffer({'a': np.int64, 'b': np.float64}, capacity=2)
+        for i in range(5):
+            buffer.append(a=i, b=i / 2)
+
+        self.assertEqual(len(buffer), 5)
+        self.assertGreaterEqual(buffer.capacity, 5)
+
+        buffer.set_last(b=10)
+        np.testing.assert_array_equal(buffer.columns()['a'], np.arange(5))
+        np.testing.assert_array_equal(buffer.columns()['b'], [0, 0.5, 1, 1.5, 10])
+        self.assertEqual(buffer.last('a'), 4)
+
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        self.assertIsNone(buffer.last('a'))
+
+    def test_recorder(self):
+        for path, fmt, coalesce in [(None, 'npy', False), (self.tmpdir + '/npy', 'npy', False), (self.tmpdir + '/parquet', 'parquet', True)]:
+            random.seed(1)
+
+            listeners = SyncListeners()
+            recorder = Recorder(listeners=listeners, path=path, fmt=fmt, chunk_size=50)
+
+            dre = DataReplayEvents(listeners=listeners,
+                                   data_replay=DataReplay().add_source(random_bar_chunks(seed=4, steps=300, width=10, chunk_len=100), 'bars', historical_depth=2),
+                                   event_name='data')
+
+            bars = dre.event_filter_by_source('bars')
+
+            pm = PortfolioManager(listeners=listeners, initial_capital=100000, fulfilled_orders_event_stream=SyncListeners(), bar_event_stream=bars, coalesce_value_updates=coalesce)
+            strategy = RandomStrategy(listeners=listeners, bar_event_stream=bars, portfolio_manager=pm, max_buys_per_step=2, max_sells_per_step=0)
+            me = MockExchange(listeners=listeners,
+                              order_requests_event_stream=strategy.order_requests_stream(),
+                              bar_event_stream=bars,
+                              order_processor=StaticSlippageLoss(0.001),
+                              commission_loss=PerShareCommissionLoss(0.01))
+
+            fulfilled_orders = me.fulfilled_orders_stream()
+            fulfilled_orders += pm.add_order
+
+            timestamps = list()
+            listeners += lambda e: timestamps.append(e['timestamp']) if e['type'] == 'data' else None
+
+            dre.start()
+            recorder.flush()
+
+            fills = recorder.fills()
+            self.assertEqual(len(fills), len(pm.orders))
+            self.assertGreater(len(fills), 50)
+            self.assertEqual(list(fills['symbol']), [o.symbol for o in pm.orders])
+            self.assertEqual(list(fills['order_type']), [o.order_type.name for o in pm.orders])
+            self.assertEqual(list(fills['quantity']), [o.obtained_quantity for o in pm.orders])
+            np.testing.assert_allclose(fills['cost'].values, [o.cost for o in pm.orders])
+            np.testing.assert_allclose(fills['commission'].values, [o.commission for o in pm.orders])
+            self.assertTrue(fills['timestamp'].isin(timestamps).all())
+
+            equity = recorder.equity_curve()
+            self.assertGreater(len(equity), 100)
+            self.assertTrue(equity.index.is_unique)
+            self.assertTrue(equity.index.is_monotonic_increasing)
+            self.assertAlmostEqual(equity['capital'].iloc[-1], pm.capital)
+            self.assertAlmostEqual(equity['value'].iloc[-1], sum(pm.value(multiply_by_quantity=True).values()))
+            np.testing.assert_allclose(equity['total'].values, equity['capital'].values + equity['value'].values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import datetime
+import logging
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from atpy.data.latest_data_snapshot import LatestDataSnapshot
+from pyevents.events import SyncListeners
+
+
+def random_bar_events(symbols: int, steps: int, seed: int = 0) -> list:
+    """
+    :return: list of bar dataframes with MultiIndex [timestamp, symbol] and timestamp column. Each dataframe is a single timestamp, some symbols are missing
+    """
+    np.random.seed(seed)
+
+    result = list()
+    for t in pd.date_range('2017-03-06 14:30', periods=steps, freq='1min', tz='UTC'):
+        s = np.flatnonzero(np.random.rand(symbols) > 0.2)
+        close = 50 + np.random.randn(len(s))
+        df = pd.DataFrame({'timestamp': t, 'symbol': ['S' + str(i) for i in s], 'close': close, 'volume': np.random.randint(1, 1000, len(s))})
+        result.append(df.set_index(['timestamp', 'symbol'], drop=False))
+
+    return result
+
+
+def legacy_snapshot(events: list, depth: int) -> pd.DataFrame:
+    """per-timestamp concat implementation of the snapshot, used as a reference"""
+    snapshot = OrderedDict()
+    for data in events:
+        for i in data['timestamp'].unique()[-depth:]:
+            snapshot[i] = pd.concat([snapshot[i], data.loc[i]]) if i in snapshot else data.loc[i]
+
+        while len(snapshot) > depth:
+            snapshot.popitem(last=False)
+
+    return pd.concat(snapshot)
+
+
+class TestLatestDataSnapshot(unittest.TestCase):
+    """
+    Test the latest data snapshot
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+    def test_snapshot(self):
+        events = random_bar_events(10, 50)
+
+        listeners = SyncListeners()
+        snapshot = LatestDataSnapshot(listeners=listeners, event='bars', depth=5, fire_update=True)
+
+        updates = list()
+        listeners += lambda e: updates.append(e) if e['type'] == 'bars_snapshot' else None
+
+        for i, e in enumerate(events):
+            listeners({'type': 'bars', 'data': e})
+            self.assertEqual(len(updates[-1]['data'].index.levels[0]), min(5, i + 1))
+
+        self.assertEqual(len(updates), len(events))
+
+        # the oldest timestamps are evicted
+        result = updates[-1]['data']
+        assert_frame_equal(legacy_snapshot(events, 5), result, check_names=False)
+
+        # the frame is cached until the next update
+        latest = list()
+        listeners += lambda e: latest.append(e['data']) if e['type'] == 'snapshot' else None
+        listeners({'type': 'request_latest'})
+        self.assertIs(latest[-1], result)
+
+        # updates of existing timestamps
+        listeners({'type': 'bars', 'data': events[-2].iloc[:2]})
+        self.assertIsNot(updates[-1]['data'], result)
+        assert_frame_equal(legacy_snapshot(events + [events[-2].iloc[:2]], 5), updates[-1]['data'], check_names=False)
+
+    def test_missing_columns(self):
+        events = random_bar_events(3, 4)
+        events[1] = events[1].drop('volume', axis=1)
+        events[2]['open'] = events[2]['close']
+
+        listeners = SyncListeners()
+        snapshot = LatestDataSnapshot(listeners=listeners, event='bars', depth=3)
+        for e in events:
+            listeners({'type': 'bars', 'data': e})
+
+        result = snapshot.snapshot()
+        self.assertEqual(list(result.columns), ['timestamp', 'symbol', 'close', 'volume', 'open'])
+        self.assertTrue(result.loc[events[1].index[0][0], 'volume'].isnull().all())
+        self.assertTrue(result.loc[events[3].index[0][0], 'open'].isnull().all())
+        self.assertEqual(list(result.loc[events[3].index[0][0], 'volume']), list(events[3]['volume']))
+
+    def test_datetime_index(self):
+        df = pd.DataFrame({'close': np.arange(10, dtype=np.float64)}, index=pd.date_range('2017-03-06 14:30', periods=10, freq='1min'))
+
+        listeners = SyncListeners()
+        snapshot = LatestDataSnapshot(listeners=listeners, event='bars', depth=3)
+        listeners({'type': 'bars', 'data': df.iloc[:5]})
+        listeners({'type': 'bars', 'data': df.iloc[5:]})
+
+        result = snapshot.snapshot()
+        self.assertEqual(list(result.index), list(df.index[-3:]))
+        self.assertEqual(list(result['close']), [7, 8, 9])
+
+    def test_performance(self):
+        events = random_bar_events(200, 200)
+
+        for depth in (10, 100):
+            listeners = SyncListeners()
+            snapshot = LatestDataSnapshot(listeners=listeners, event='bars', depth=depth, fire_update=True)
+
+            now = datetime.datetime.now()
+            for e in events:
+                listeners({'type': 'bars', 'data': e})
+
+            log = "Snapshot of depth " + str(depth) + ", " + str(len(events)) + " events: slots " + str(datetime.datetime.now() - now)
+
+            now = datetime.datetime.now()
+            legacy = OrderedDict()
+            for e in events:
+                for i in e['timestamp'].unique()[-depth:]:
+                    legacy[i] = pd.concat([legacy[i], e.loc[i]]) if i in legacy else e.loc[i]
+
+                while len(legacy) > depth:
+                    legacy.popitem(last=False)
+
+                pd.concat(legacy), pd.concat(legacy)
+
+            log += "; per-event concat " + str(datetime.datetime.now() - now)
+            logging.getLogger(__name__).debug(log)
+
+            self.assertEqual(len(snapshot.snapshot().index.levels[0]), depth)
+
+if __name__ == '__main__':
+    unittest.main()
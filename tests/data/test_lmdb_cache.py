@@ -0,0 +1,114 @@
+import datetime
+import importlib.util
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pandas.util.testing import assert_frame_equal
+
+import atpy.data.cache.lmdb_cache as lmdb_cache
+from atpy.data.cache.lmdb_cache import LmdbCache, PickleCodec, Lz4Codec, RawBuffersCodec
+from tests.data.test_mmap_cache import random_weekly_bars
+
+
+def codecs(*args) -> list:
+    """
+    :param args: codecs, which are always available
+    :return: the codecs with Lz4Codec appended, if the optional lz4 package is installed
+    """
+    return list(args) + ([Lz4Codec()] if importlib.util.find_spec('lz4') is not None else [])
+
+
+class TestLmdbCache(unittest.TestCase):
+    """
+    Test LMDB cache
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_codecs(self):
+        df = random_weekly_bars('60min', 20)
+
+        for codec in codecs(PickleCodec(), PickleCodec(compress=False), RawBuffersCodec()):
+            result = codec.decode(codec.encode(df))
+            assert_frame_equal(df, result)
+
+            # the decoded dataframe must be modifiable (for example by splits_dividends.adjust_df)
+            result['close'] *= 2
+            self.assertTrue((result['close'] == df['close'] * 2).all())
+
+    def test_put_many(self):
+        dfs = {'key' + str(i): random_weekly_bars('60min', 10, seed=i) for i in range(10)}
+
+        with LmdbCache(self.tmpdir) as cache:
+            self.assertIsNone(cache('key0'))
+            self.assertFalse('key0' in cache)
+
+            cache.put_many(dfs.items())
+
+            self.assertEqual(sorted(cache.keys()), sorted(dfs.keys()))
+            for k, df in dfs.items():
+                self.assertTrue(k in cache)
+                assert_frame_equal(df, cache(k))
+
+            results = dict()
+
+            def read(k):
+                results[k] = cache.get(k)
+
+            threads = [threading.Thread(target=read, args=(k,)) for k in dfs]
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+            for k, df in dfs.items():
+                assert_frame_equal(df, results[k])
+
+            cache.put('key0', dfs['key1'])
+            assert_frame_equal(dfs['key1'], cache('key0'))
+
+        # compatible with write/read
+        assert_frame_equal(dfs['key2'], lmdb_cache.read_pickle('key2', self.tmpdir))
+
+        lmdb_cache.write('key10', dfs['key3'], self.tmpdir)
+        with LmdbCache(self.tmpdir, readonly=True) as cache:
+            assert_frame_equal(dfs['key3'], cache('key10'))
+
+    def test_codecs_performance(self):
+        dfs = [('key' + str(i), random_weekly_bars('5min', 1000, seed=i)) for i in range(3)]
+
+        now = datetime.datetime.now()
+        for k, df in dfs:
+            lmdb_cache.write(k, df, self.tmpdir)
+
+        for k, _ in dfs:
+            lmdb_cache.read_pickle(k, self.tmpdir)
+
+        logging.getLogger(__name__).debug("write/read_pickle of " + str(len(dfs)) + " chunks: " + str(datetime.datetime.now() - now))
+
+        for codec in codecs(PickleCodec(), RawBuffersCodec()):
+            path = tempfile.mkdtemp(dir=self.tmpdir)
+
+            with LmdbCache(path, codec=codec) as cache:
+                now = datetime.datetime.now()
+                cache.put_many(dfs)
+                write_time = datetime.datetime.now() - now
+
+                now = datetime.datetime.now()
+                for k, df in dfs:
+                    cache(k)
+
+                logging.getLogger(__name__).debug(type(codec).__name__ + " put_many " + str(write_time) + "; get " + str(datetime.datetime.now() - now))
+
+
+if __name__ == '__main__':
+    unittest.main()
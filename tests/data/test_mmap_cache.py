@@ -0,0 +1,143 @@
+import datetime
+import logging
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+import atpy.data.cache.lmdb_cache as lmdb_cache
+import atpy.data.cache.mmap_cache as mmap_cache
+
+
+def random_weekly_bars(interval: str, symbols: int, seed: int = 0):
+    """Random single week of OHLCV bars with the same index and dtypes as postgres_cache.request_bars"""
+    np.random.seed(seed)
+
+    timestamps = pd.date_range(start='2017-03-06 14:30', end='2017-03-10 21:00', freq=interval, tz='UTC', name='timestamp')
+    timestamps = timestamps[timestamps.indexer_between_time('14:30', '21:00')]
+    index = pd.MultiIndex.from_product([timestamps, ['S' + str(i) for i in range(symbols)]], names=['timestamp', 'symbol'])
+
+    # prices are stored as float32 (real) in postgres
+    close = np.random.rand(len(index)).astype(np.float32) * 100
+    df = pd.DataFrame({'open': (close * 1.01).astype(np.float64), 'high': (close * 1.02).astype(np.float64), 'low': (close * 0.99).astype(np.float64), 'close': close.astype(np.float64),
+                       'volume': np.random.randint(1, 10000, len(index)).astype(np.uint64)}, index=index)
+
+    # some symbols have missing bars
+    return df.iloc[np.random.rand(len(df)) > 0.1]
+
+
+class TestMmapCache(unittest.TestCase):
+    """
+    Test memory mapped bars cache
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_write(self):
+        df = random_weekly_bars('60min', 10)
+
+        self.assertIsNone(mmap_cache.read('key', self.tmpdir))
+
+        mmap_cache.write('key', df, self.tmpdir)
+        result = mmap_cache.read('key', self.tmpdir)
+
+        assert_frame_equal(df, result)
+        self.assertEqual(mmap_cache.symbols('key', self.tmpdir), ['S' + str(i) for i in range(10)])
+
+        # single symbol
+        single = df.xs('S3', level='symbol')
+        mmap_cache.write('single', single, self.tmpdir)
+        assert_frame_equal(single, mmap_cache.read('single', self.tmpdir))
+
+        # overwrite
+        mmap_cache.write('key', single, self.tmpdir)
+        self.assertEqual(len(mmap_cache.read('key', self.tmpdir)), len(single))
+
+    def test_float_precision(self):
+        df = random_weekly_bars('60min', 10)
+
+        # float64 prices, which are not representable as float32
+        for c in ['open', 'high', 'low', 'close']:
+            df[c] = np.random.rand(len(df)) * 100
+
+        mmap_cache.write('key', df, self.tmpdir)
+        result = mmap_cache.read('key', self.tmpdir)
+
+        self.assertTrue((result.dtypes == df.dtypes).all())
+        self.assertTrue((result['close'] != df['close']).any())
+
+        # float32 precision
+        for c in ['open', 'high', 'low', 'close']:
+            np.testing.assert_allclose(result[c].values, df[c].values, rtol=2 ** -24, atol=0)
+
+        assert_frame_equal(df, result, check_exact=False, rtol=1e-6)
+        np.testing.assert_array_equal(result['volume'].values, df['volume'].values)
+
+    def test_read_symbol(self):
+        df = random_weekly_bars('5min', 10)
+        mmap_cache.write('key', df, self.tmpdir)
+
+        bgn_prd, end_prd = datetime.datetime(2017, 3, 7, 15, tzinfo=datetime.timezone.utc), datetime.datetime(2017, 3, 8, 18, tzinfo=datetime.timezone.utc)
+
+        for s in ['S0', 'S5', 'S9']:
+            result = mmap_cache.read_symbol('key', s, self.tmpdir, bgn_prd=bgn_prd, end_prd=end_prd)
+            expected = df.xs(s, level='symbol')
+            expected = expected.loc[(expected.index >= bgn_prd) & (expected.index <= end_prd)]
+
+            self.assertTrue(isinstance(result['close'], np.memmap))
+            self.assertFalse(result['close'].flags.writeable)
+            self.assertTrue(result['close'].flags.c_contiguous)
+            np.testing.assert_array_equal(result['timestamp'], expected.index.asi8)
+            np.testing.assert_array_equal(result['close'], expected['close'].values.astype(np.float32))
+            np.testing.assert_array_equal(result['volume'], expected['volume'].values)
+
+        all_bars = mmap_cache.read_symbol('key', 'S1', self.tmpdir)
+        self.assertEqual(len(all_bars['timestamp']), len(df.xs('S1', level='symbol')))
+
+        self.assertIsNone(mmap_cache.read_symbol('key', 'NONE', self.tmpdir))
+        self.assertIsNone(mmap_cache.read_symbol('no_key', 'S1', self.tmpdir))
+
+    def test_lmdb_to_mmap_performance(self):
+        for interval, symbols in [('1min', 200), ('5min', 1000), ('60min', 5000), ('1D', 5000)]:
+            lmdb_path, mmap_path = tempfile.mkdtemp(dir=self.tmpdir), tempfile.mkdtemp(dir=self.tmpdir)
+
+            keys = list()
+            for i in range(3):
+                df = random_weekly_bars(interval, symbols, seed=i)
+                keys.append('2017-03-0' + str(i) + ' - ' + interval)
+                lmdb_cache.write(keys[-1], df, lmdb_path)
+
+            self.assertEqual(sorted(mmap_cache.lmdb_to_mmap(lmdb_path, mmap_path)), sorted(keys))
+            self.assertEqual(mmap_cache.lmdb_to_mmap(lmdb_path, mmap_path), list())
+
+            now = datetime.datetime.now()
+            pickled = [lmdb_cache.read_pickle(k, lmdb_path) for k in keys]
+            pickle_time = datetime.datetime.now() - now
+
+            now = datetime.datetime.now()
+            mmapped = [mmap_cache.read(k, mmap_path) for k in keys]
+            mmap_time = datetime.datetime.now() - now
+
+            for p, m in zip(pickled, mmapped):
+                assert_frame_equal(p, m)
+
+            now = datetime.datetime.now()
+            for k in keys:
+                for s in ['S0', 'S' + str(symbols // 2), 'S' + str(symbols - 1)]:
+                    mmap_cache.read_symbol(k, s, mmap_path)
+            symbol_time = datetime.datetime.now() - now
+
+            logging.getLogger(__name__).debug(interval + " bars with " + str(len(pickled[0])) + " rows per chunk: read_pickle " + str(pickle_time / len(keys))
+                                              + "; mmap read " + str(mmap_time / len(keys)) + "; mmap read_symbol " + str(symbol_time / (len(keys) * 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
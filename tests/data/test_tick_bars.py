@@ -0,0 +1,233 @@
+import datetime
+import logging
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from atpy.data.iqfeed.util import iqfeed_dtype
+from atpy.data.tick_bars import TickBarAggregator, TickBarsListener
+from atpy.data.ts_util import RingBuffer
+from pyevents.events import SyncListeners
+from tests.iqfeed.test_streaming_level_1 import LEVEL_1_DTYPE
+
+
+def random_ticks(symbols: int, ticks: int, seed: int = 0) -> pd.DataFrame:
+    """
+    :return: ticks of multiple symbols with MultiIndex [symbol, timestamp]
+    """
+    np.random.seed(seed)
+
+    symbol = np.random.randint(0, symbols, ticks)
+    timestamp = pd.Timestamp('2017-03-06 14:30', tz='UTC').value + np.sort(np.random.randint(0, 6.5 * 3600 * 10 ** 9, ticks))
+
+    df = pd.DataFrame({'symbol': np.array(['S' + str(i) for i in range(symbols)], dtype=object)[symbol],
+                       'timestamp': pd.DatetimeIndex(timestamp).tz_localize('UTC'),
+                       'last': np.round(50 + np.cumsum(np.random.randn(ticks)) * 0.01, 2),
+                       'last_size': np.random.randint(1, 500, ticks).astype(np.uint64)})
+
+    # duplicate timestamps are valid
+    df = df.set_index(['symbol', 'timestamp'], drop=False).sort_index(level='symbol', sort_remaining=False, kind='mergesort')
+
+    return df
+
+
+def reference_bars(df: pd.DataFrame, bar_type: str, threshold: float) -> pd.DataFrame:
+    """
+    Per-tick python implementation of the tick, volume and dollar bars
+    """
+    rows = list()
+    for symbol, group in df.groupby(level='symbol', sort=True):
+        bar = None
+        for t, p, v in zip(group['timestamp'], group['last'], group['last_size'].astype(np.float64)):
+            if bar is None:
+                bar = {'symbol': symbol, 'open': p, 'high': p, 'low': p, 'volume': 0.0, 'value': 0.0, 'number_of_trades': 0}
+
+            bar['high'], bar['low'], bar['close'] = max(bar['high'], p), min(bar['low'], p), p
+            bar['volume'] += v
+            bar['value'] += p * v
+            bar['number_of_trades'] += 1
+            bar['timestamp'] = t
+
+            measure = {'tick': bar['number_of_trades'], 'volume': bar['volume'], 'dollar': bar['value']}[bar_type]
+            if measure >= threshold:
+                rows.append(bar)
+                bar = None
+
+        if bar is not None:
+            rows.append(bar)
+
+    result = pd.DataFrame(rows)
+    result['vwap'] = result['value'] / result['volume']
+    result = result.set_index(['symbol', 'timestamp'])
+
+    return result[['open', 'high', 'low', 'close', 'volume', 'vwap', 'number_of_trades']]
+
+
+class TestTickBars(unittest.TestCase):
+    """
+    Test tick to bar aggregation
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+    def test_time_bars(self):
+        ticks = random_ticks(5, 20000)
+
+        for period_id in ('right', 'left'):
+            aggregator = TickBarAggregator(bar_type='time', threshold=60, period_id=period_id)
+            bars = pd.concat([aggregator.update(ticks), aggregator.flush()]).sort_index()
+
+            for symbol, group in ticks.groupby(level='symbol'):
+                group = group.reset_index(level='symbol', drop=True)
+                expected = group.resample('1min', closed=period_id, label=period_id).agg({'last': ['first', 'max', 'min', 'last', 'count']})
+                expected.columns = ['open', 'high', 'low', 'close', 'number_of_trades']
+                expected['volume'] = group['last_size'].astype(np.float64).resample('1min', closed=period_id, label=period_id).sum()
+                expected['vwap'] = (group['last'] * group['last_size']).resample('1min', closed=period_id, label=period_id).sum() / expected['volume']
+                expected = expected[expected['number_of_trades'] > 0]
+
+                result = bars.loc[symbol]
+                assert_frame_equal(expected[result.columns], result, check_freq=False, check_names=False)
+
+    def test_threshold_bars(self):
+        ticks = random_ticks(5, 20000)
+
+        for bar_type, threshold in [('tick', 50), ('volume', 10000), ('dollar', 500000)]:
+            aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold)
+            bars = pd.concat([aggregator.update(ticks), aggregator.flush()]).sort_index()
+
+            assert_frame_equal(reference_bars(ticks, bar_type, threshold), bars)
+
+    def test_chunks(self):
+        ticks = random_ticks(10, 50000, seed=1)
+        chunks = np.sort(np.random.randint(0, len(ticks), 20))
+
+        # the chunks are in time order
+        ticks = ticks.iloc[np.argsort(ticks['timestamp'].values, kind='mergesort')]
+
+        for bar_type, threshold in [('time', 300), ('tick', 100), ('volume', 20000), ('dollar', 100000)]:
+            aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold)
+            expected = pd.concat([aggregator.update(ticks), aggregator.flush()]).sort_index()
+
+            aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold)
+            result = pd.concat([aggregator.update(c) for c in np.split(ticks, chunks)] + [aggregator.flush()]).sort_index()
+
+            assert_frame_equal(expected, result)
+
+    def test_single_symbol(self):
+        ticks = random_ticks(1, 1000)
+        expected = TickBarAggregator(bar_type='volume', threshold=5000).update(ticks).reset_index(level='symbol', drop=True)
+
+        # DatetimeIndex with timestamp and symbol columns (as returned by IQFeedHistoryProvider)
+        single = ticks.reset_index(level='symbol', drop=True)
+        aggregator = TickBarAggregator(bar_type='volume', threshold=5000)
+        assert_frame_equal(expected, aggregator.update(single))
+        self.assertIsInstance(aggregator.flush().index, pd.DatetimeIndex)
+
+        # without symbol and timestamp columns
+        assert_frame_equal(expected, TickBarAggregator(bar_type='volume', threshold=5000).update(single.drop(['symbol', 'timestamp'], axis=1)))
+
+    def test_listener(self):
+        ticks = random_ticks(3, 2000)
+        ticks = ticks.iloc[np.argsort(ticks['timestamp'].values, kind='mergesort')]
+
+        for bar_type, threshold in [('time', 60), ('volume', 5000)]:
+            listeners = SyncListeners()
+            listener = TickBarsListener(listeners, bar_type=bar_type, threshold=threshold)
+
+            bars = list()
+            stream = listener.tick_bars_stream()
+            stream += lambda df: bars.append(df)
+
+            eastern = ticks['timestamp'].dt.tz_convert('US/Eastern').dt.tz_localize(None)
+            for s, t, p, v in zip(ticks['symbol'], eastern, ticks['last'], ticks['last_size']):
+                # quote update without trade
+                listeners({'type': 'level_1_update', 'data': {'symbol': s, 'most_recent_trade': p + 1, 'most_recent_trade_size': 1, 'most_recent_trade_time': t - t.normalize(),
+                                                              'most_recent_trade_date': t.date(), 'message_contents': 'b'}})
+
+                listeners({'type': 'level_1_update', 'data': {'symbol': s, 'most_recent_trade': p, 'most_recent_trade_size': v, 'most_recent_trade_time': (t - t.normalize()).to_timedelta64(),
+                                                              'most_recent_trade_date': np.datetime64(t.date()), 'message_contents': 'Cbav'}})
+
+            listeners({'type': 'no_data'})
+
+            aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold)
+            expected = pd.concat([aggregator.update(ticks), aggregator.flush()]).sort_index()
+
+            result = pd.concat(bars)
+            if bar_type == 'time':
+                # the time bars are fired as soon as the next trade of any symbol arrives
+                self.assertTrue(result.index.get_level_values('timestamp').is_monotonic_increasing)
+
+            assert_frame_equal(expected, result.sort_index())
+
+    def test_listener_snapshot(self):
+        ticks = random_ticks(3, 2000)
+        ticks = ticks.iloc[np.argsort(ticks['timestamp'].values, kind='mergesort')]
+
+        # the snapshots have microsecond resolution
+        ticks['timestamp'] = ticks['timestamp'].dt.floor('us')
+        eastern = ticks['timestamp'].dt.tz_convert('US/Eastern').dt.tz_localize(None)
+
+        # the default level 1 fields have no trade date. The trades are assigned to the current date
+        today = pd.Timestamp.now(tz='US/Eastern').normalize().tz_localize(None)
+        ticks['timestamp'] = (today + (eastern - eastern.dt.normalize())).dt.tz_localize('US/Eastern').dt.tz_convert('UTC')
+        ticks = ticks.set_index(['symbol', 'timestamp'], drop=False)
+
+        # market snapshots of IQFeedLevel1Listener with mkt_snapshot_depth > 0
+        dtype = iqfeed_dtype(LEVEL_1_DTYPE)
+
+        listeners = SyncListeners()
+        listener = TickBarsListener(listeners, bar_type='volume', threshold=5000)
+
+        bars = list()
+        stream = listener.tick_bars_stream()
+        stream += lambda df: bars.append(df)
+
+        snapshots = dict()
+        for s, t, p, v in zip(ticks['symbol'], eastern, ticks['last'], ticks['last_size']):
+            if s not in snapshots:
+                snapshots[s] = RingBuffer(dtype, 5, constants={'symbol': s})
+
+            snapshot = snapshots[s]
+            # integer microseconds since midnight
+            time = (t - t.normalize()) // pd.Timedelta(1, 'us')
+
+            # quote update without trade
+            snapshot.append(np.array([(s.encode('ascii'), p + 1, 1, time, 5, 0, p - 0.01, 100, p + 0.01, 100, p, p, p, p, b'b', b'')], dtype=dtype))
+            listeners({'type': 'level_1_update', 'data': snapshot})
+
+            snapshot.append(np.array([(s.encode('ascii'), p, v, time, 5, 0, p - 0.01, 100, p + 0.01, 100, p, p, p, p, b'Cbav', b'')], dtype=dtype))
+            listeners({'type': 'level_1_update', 'data': snapshot})
+
+        aggregator = TickBarAggregator(bar_type='volume', threshold=5000)
+        assert_frame_equal(aggregator.update(ticks), pd.concat(bars).sort_index())
+
+    def test_performance(self):
+        ticks = random_ticks(100, 1000000)
+
+        for bar_type, threshold in [('time', 60), ('volume', 10000)]:
+            aggregator = TickBarAggregator(bar_type=bar_type, threshold=threshold)
+            aggregator.update(ticks.iloc[:10])
+
+            now = datetime.datetime.now()
+            TickBarAggregator(bar_type=bar_type, threshold=threshold).update(ticks)
+            logging.getLogger(__name__).debug(bar_type + " bars of 1M ticks: " + str(datetime.datetime.now() - now))
+
+        # pandas is too slow for 1M ticks
+        ticks = ticks.iloc[:100000]
+
+        now = datetime.datetime.now()
+        TickBarAggregator(bar_type='time', threshold=60).update(ticks)
+        log = "100K ticks: time bars " + str(datetime.datetime.now() - now)
+
+        now = datetime.datetime.now()
+        ticks.reset_index(drop=True).groupby('symbol').resample('1min', on='timestamp').agg({'last': 'ohlc', 'last_size': 'sum'})
+        log += "; groupby resample " + str(datetime.datetime.now() - now)
+
+        logging.getLogger(__name__).debug(log)
+
+
+if __name__ == '__main__':
+    unittest.main()
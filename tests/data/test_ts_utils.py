@@ -1,14 +1,44 @@
 import datetime
 import logging
 import random
+import threading
+import time
 import unittest
 
+import numpy as np
 import pandas as pd
 
 import atpy.data.tradingcalendar as tcal
 from atpy.backtesting.data_replay import DataReplay
 from atpy.data.iqfeed.iqfeed_history_provider import IQFeedHistoryProvider, BarsFilter
-from atpy.data.ts_util import current_period, set_periods, current_day
+from atpy.data.ts_util import current_period, set_periods, current_day, AsyncInPeriodProvider, RingBuffer
+
+
+class SlowPeriodProvider(object):
+    """Random access provider with random latency, which tracks the number of periods in progress"""
+
+    def __init__(self, periods: int):
+        self.periods = periods
+        self.requested = list()
+        self.in_progress = 0
+        self.max_in_progress = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.periods
+
+    def __getitem__(self, i):
+        with self._lock:
+            self.requested.append(i)
+            self.in_progress += 1
+            self.max_in_progress = max(self.max_in_progress, self.in_progress)
+
+        time.sleep(random.random() * 0.01)
+
+        with self._lock:
+            self.in_progress -= 1
+
+        return i
 
 
 class TestTSUtils(unittest.TestCase):
@@ -133,6 +163,70 @@ class TestTSUtils(unittest.TestCase):
             elapsed = datetime.datetime.now() - now
             logging.getLogger(__name__).debug('Time elapsed ' + str(elapsed) + ' for ' + str(i + 1) + ' iterations; ' + str(elapsed / (i % 1000)) + ' per iteration')
 
+    def test_async_in_period_provider(self):
+        provider = SlowPeriodProvider(100)
+        async_provider = AsyncInPeriodProvider(provider, prefetch=8, num_workers=4)
+
+        self.assertEqual(list(async_provider), list(range(100)))
+        self.assertGreater(provider.max_in_progress, 1)
+        self.assertLessEqual(provider.max_in_progress, 4)
+        self.assertEqual(async_provider.fetch_count, 100)
+        self.assertGreater(async_provider.fetch_time, datetime.timedelta())
+        self.assertGreater(async_provider.stall_time, datetime.timedelta())
+
+        # sequential providers
+        self.assertEqual(list(AsyncInPeriodProvider(iter(range(10)), num_workers=4)), list(range(10)))
+
+        # bounded prefetch and cancellation
+        provider = SlowPeriodProvider(100)
+        with AsyncInPeriodProvider(provider, prefetch=5, num_workers=2) as async_provider:
+            for i, p in enumerate(async_provider):
+                self.assertEqual(i, p)
+                time.sleep(0.01)
+                self.assertLessEqual(len(provider.requested), i + 1 + 5)
+                self.assertLessEqual(async_provider.queue_depth, 5)
+
+                if i == 10:
+                    break
+
+        time.sleep(0.1)
+        self.assertLessEqual(len(provider.requested), 11 + 5)
+
+    def test_ring_buffer(self):
+        dtype = np.dtype([('Symbol', 'S8'), ('Price', 'f8'), ('Size', 'u8')])
+        buffer = RingBuffer(np.dtype([('symbol', 'S8'), ('price', 'f8'), ('size', 'u8')]), maxlen=5, constants={'symbol': 'IBM'})
+
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(len(buffer.last()), 0)
+        self.assertRaises(IndexError, buffer.last_record)
+
+        for i in range(13):
+            record = np.array([(b'IBM', i + 0.5, i)], dtype=dtype)
+            buffer.append(record if i % 2 == 0 else record[0])
+
+            self.assertEqual(buffer.size, min(i + 1, 5))
+            self.assertEqual(list(buffer['size']), list(range(max(0, i - 4), i + 1)))
+            self.assertEqual(list(buffer.last(2)['price']), [j + 0.5 for j in range(max(0, i - 1), i + 1)])
+            self.assertEqual(buffer.last_record()['size'], i)
+
+        # zero-copy views
+        self.assertIsNotNone(buffer['price'].base)
+
+        buffer.replace_last(np.array([(b'IBM', 100, 100)], dtype=dtype))
+        self.assertEqual(list(buffer['size']), [8, 9, 10, 11, 100])
+        buffer.append(np.array([(b'IBM', 101, 101)], dtype=dtype))
+        self.assertEqual(list(buffer['size']), [9, 10, 11, 100, 101])
+
+        # mapping interface
+        self.assertEqual(list(buffer), ['symbol', 'price', 'size'])
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer['symbol'], 'IBM')
+        self.assertEqual(dict(buffer.items())['size'][-1], 101)
+        self.assertIn('price', buffer)
+        self.assertNotIn('tick_id', buffer)
+        self.assertIsNone(buffer.get('tick_id'))
+        self.assertRaises(KeyError, lambda: buffer['tick_id'])
+
     def test_current_day(self):
         logging.basicConfig(level=logging.DEBUG)
 
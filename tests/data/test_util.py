@@ -0,0 +1,102 @@
+import datetime
+import logging
+import unittest
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from atpy.data.util import resample_bars
+
+
+def legacy_resample_bars(df: pd.DataFrame, rule: str, period_id: str = 'right') -> pd.DataFrame:
+    """
+    groupby/resample implementation of resample_bars, used as a reference
+    """
+    if isinstance(df.index, pd.MultiIndex):
+        return df.groupby(level='symbol', group_keys=True, sort=False) \
+            .resample(rule, closed=period_id, label=period_id, level='timestamp') \
+            .agg({'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'}) \
+            .dropna()
+    else:
+        return df.resample(rule, closed=period_id, label=period_id) \
+            .agg({'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'}) \
+            .dropna()
+
+
+def random_minute_bars(symbols: int, days: int, tz: str = 'UTC', missing: float = 0.1, seed: int = 0) -> pd.DataFrame:
+    """
+    :return: 1 minute bars (regular session) of multiple symbols with MultiIndex [symbol, timestamp]. Some bars are missing
+    """
+    np.random.seed(seed)
+
+    timestamps = pd.DatetimeIndex(np.concatenate([pd.date_range(d + pd.Timedelta(hours=9, minutes=31), d + pd.Timedelta(hours=16), freq='1min').values
+                                                  for d in pd.bdate_range('2017-03-06', periods=days)])).tz_localize('US/Eastern')
+
+    if tz is None:
+        timestamps = timestamps.tz_localize(None)
+    elif tz != 'US/Eastern':
+        timestamps = timestamps.tz_convert(tz)
+
+    dfs = list()
+    for i in range(symbols):
+        ts = timestamps[np.random.rand(len(timestamps)) > missing]
+        close = 50 + np.cumsum(np.random.randn(len(ts))) * 0.1
+        dfs.append(pd.DataFrame({'open': close + 0.01, 'high': close + 0.1, 'low': close - 0.1, 'close': close, 'volume': np.random.randint(1, 1000, len(ts)).astype(np.uint64),
+                                 'symbol': 'S' + str(i), 'timestamp': ts}))
+
+    return pd.concat(dfs).set_index(['symbol', 'timestamp'], drop=False)
+
+
+class TestUtil(unittest.TestCase):
+    """
+    Test data utilities
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+    def test_resample_bars(self):
+        for tz in ('UTC', 'US/Eastern', None):
+            df = random_minute_bars(5, 5, tz=tz)
+
+            for rule in ('5min', '60min', '1D'):
+                for period_id in ('right', 'left'):
+                    assert_frame_equal(legacy_resample_bars(df, rule, period_id), resample_bars(df, rule, period_id))
+
+                    single = df.loc['S1']
+                    assert_frame_equal(legacy_resample_bars(single, rule, period_id), resample_bars(single, rule, period_id), check_freq=False)
+
+        # timestamp/symbol order
+        df = random_minute_bars(5, 3).swaplevel(0, 1).sort_index()
+        assert_frame_equal(legacy_resample_bars(df, '15min'), resample_bars(df, '15min'))
+
+        # null values
+        df = random_minute_bars(3, 2)
+        df.iloc[::7, df.columns.get_loc('open')] = np.nan
+        df.iloc[::11, df.columns.get_loc('high')] = np.nan
+        df.iloc[2:10, [df.columns.get_loc(c) for c in ['open', 'high', 'low', 'close']]] = np.nan
+        assert_frame_equal(legacy_resample_bars(df, '5min'), resample_bars(df, '5min'))
+
+        # unsupported rules fall back to pandas
+        df = random_minute_bars(3, 10)
+        assert_frame_equal(legacy_resample_bars(df, 'W'), resample_bars(df, 'W'))
+        assert_frame_equal(legacy_resample_bars(df, '7min'), resample_bars(df, '7min'))
+
+    def test_resample_bars_performance(self):
+        df = random_minute_bars(300, 20)
+
+        for rule in ('5min', '60min'):
+            now = datetime.datetime.now()
+            resample_bars(df, rule)
+            log = str(len(df)) + " bars to " + rule + ": columnar " + str(datetime.datetime.now() - now)
+
+            now = datetime.datetime.now()
+            legacy_resample_bars(df, rule)
+            log += "; groupby/resample " + str(datetime.datetime.now() - now)
+
+            logging.getLogger(__name__).debug(log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
+import datetime
 import threading
+import time
 import unittest
 
 from pandas.util.testing import assert_frame_equal
@@ -8,6 +10,188 @@ from atpy.data.util import get_nasdaq_listed_companies, resample_bars
 from pyevents.events import AsyncListeners, SyncListeners
 
 
+BAR_DTYPE = np.dtype([('symbol', 'S64'), ('date', 'M8[D]'), ('time', 'u8'), ('open_p', 'f8'), ('high_p', 'f8'), ('low_p', 'f8'), ('close_p', 'f8'),
+                      ('tot_vlm', 'u8'), ('prd_vlm', 'u8'), ('num_trds', 'u8')])
+
+
+def bar_record(symbol: str, timestamp: datetime.datetime, price: float, volume: int) -> np.array:
+    """pyiqfeed bar with US/Eastern timestamp (the time is in microseconds since midnight)"""
+    return np.array([(symbol.encode('ascii'), np.datetime64(timestamp.date()), (timestamp - datetime.datetime.combine(timestamp.date(), datetime.time())) // datetime.timedelta(microseconds=1),
+                      price, price + 1, price - 1, price + 0.5, volume * 10, volume, volume // 10)], dtype=BAR_DTYPE)
+
+
+class TestIQFeedBarDataBuffers(unittest.TestCase):
+    """
+    Test the live bar buffers without connection
+    """
+
+    def test_bar_updates(self):
+        listeners = SyncListeners()
+        listener = IQFeedBarDataListener(listeners=listeners, interval_len=60, mkt_snapshot_depth=3, adjust_history=False)
+        listener.watched_symbols['IBM'] = None
+
+        events = list()
+        listeners += lambda e: events.append(e) if e['type'] in ('history_bars', 'latest_bar_update', 'live_bar') else None
+
+        # DST transition day
+        start = datetime.datetime(2017, 3, 12, 15, 0)
+        for i in range(3):
+            listener.process_history_bar(bar_record('IBM', start + datetime.timedelta(minutes=i), 100 + i, 10 + i))
+
+        self.assertEqual([e['type'] for e in events], ['history_bars'])
+        df = events[0]['data']
+        self.assertEqual(list(df.columns), ['symbol', 'open', 'high', 'low', 'close', 'total_volume', 'volume', 'number_of_trades'])
+        self.assertEqual(list(df.index), list(pd.date_range(start, periods=3, freq='1min').tz_localize('US/Eastern').tz_convert('UTC')))
+        self.assertEqual(df.index.name, 'timestamp')
+        self.assertEqual(list(df['open']), [100, 101, 102])
+
+        # update of the current bar
+        listener.process_latest_bar_update(bar_record('IBM', start + datetime.timedelta(minutes=2), 200, 50))
+        df = events[-1]['data']
+        self.assertEqual(len(df), 3)
+        self.assertEqual(list(df['open']), [100, 101, 200])
+        self.assertEqual(df['volume'].iloc[-1], 50)
+
+        # new bar
+        listener.process_live_bar(bar_record('IBM', start + datetime.timedelta(minutes=3), 300, 60))
+        df = events[-1]['data']
+        self.assertEqual(events[-1]['symbol'], 'IBM')
+        self.assertEqual(list(df['open']), [101, 200, 300])
+        self.assertEqual(df.index[-1], pd.Timestamp(start + datetime.timedelta(minutes=3)).tz_localize('US/Eastern').tz_convert('UTC'))
+
+        assert_frame_equal(df, listener.bars_frame('IBM'))
+
+        # views instead of dataframes
+        listener.event_frames = False
+        listener.process_latest_bar_update(bar_record('IBM', start + datetime.timedelta(minutes=3), 400, 70))
+        self.assertEqual(list(events[-1]['data']['open_p']), [101, 200, 400])
+
+        # unwatched symbols are ignored
+        listener.process_live_bar(bar_record('MSFT', start, 1, 1))
+        self.assertNotIn('MSFT', listener.watched_symbols)
+
+    def test_bar_updates_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        symbols = ['S' + str(i) for i in range(3000)]
+        start = datetime.datetime(2017, 3, 6, 9, 30)
+
+        # 10 updates per bar
+        records = [bar_record(symbols[i % len(symbols)], start + datetime.timedelta(minutes=i // 30000), 100 + i % 7, i % 1000) for i in range(100000)]
+
+        listener = IQFeedBarDataListener(listeners=SyncListeners(), interval_len=60, mkt_snapshot_depth=100, adjust_history=False, event_frames=False)
+        listener.watched_symbols.update({s: None for s in symbols})
+
+        now = time.time()
+        for r in records:
+            listener.process_latest_bar_update(r)
+
+        elapsed = time.time() - now
+        logging.getLogger(__name__).debug("100K bar updates of 3000 symbols: " + str(elapsed) + "s; " + str(elapsed * 10) + "us per update")
+
+        self.assertEqual(listener.watched_symbols['S0'].size, 4)
+
+
+class TestIQFeedBarMatrix(unittest.TestCase):
+    """
+    Test the aligned bar matrix without connection
+    """
+
+    def test_bar_matrix(self):
+        listeners = SyncListeners()
+        listener = IQFeedBarDataListener(listeners=listeners, interval_len=60, mkt_snapshot_depth=3, adjust_history=False, bar_matrix_depth=3, bar_matrix_grace=1000)
+        for s in ['AAPL', 'IBM', 'MSFT']:
+            listener.watched_symbols[s] = None
+        listener.bar_matrix.add_symbols(['AAPL', 'IBM', 'MSFT'])
+
+        matrices = list()
+        stream = listener.bar_matrix_event_stream()
+        stream += lambda data, symbols, timestamps: matrices.append((data, symbols, timestamps))
+
+        start = datetime.datetime(2017, 3, 13, 10, 0)
+        minute = datetime.timedelta(minutes=1)
+
+        # the interval is complete when all symbols closed their bar
+        listener.process_live_bar(bar_record('AAPL', start, 100, 10))
+        listener.process_live_bar(bar_record('IBM', start, 200, 20))
+        self.assertEqual(len(matrices), 0)
+        listener.process_live_bar(bar_record('MSFT', start, 300, 30))
+        self.assertEqual(len(matrices), 1)
+
+        data, symbols, timestamps = matrices[-1]
+        self.assertEqual(symbols, ['AAPL', 'IBM', 'MSFT'])
+        self.assertEqual(data.shape, (3, 3, 5))
+        self.assertEqual(list(data[:, -1, 0]), [100, 200, 300])
+        self.assertEqual(list(data[:, -1, 3]), [100.5, 200.5, 300.5])
+        self.assertEqual(list(data[:, -1, 4]), [10, 20, 30])
+        self.assertTrue(np.isnan(data[:, :-1]).all())
+        self.assertEqual(timestamps[-1], pd.Timestamp(start).tz_localize('US/Eastern').tz_convert('UTC'))
+
+        # a bar of a later interval completes the earlier intervals of the symbol
+        listener.process_live_bar(bar_record('AAPL', start + minute, 101, 11))
+        listener.process_live_bar(bar_record('IBM', start + minute, 201, 21))
+        listener.process_live_bar(bar_record('AAPL', start + 2 * minute, 102, 12))
+        listener.process_live_bar(bar_record('IBM', start + 2 * minute, 202, 22))
+        self.assertEqual(len(matrices), 1)
+        listener.process_live_bar(bar_record('MSFT', start + 2 * minute, 302, 32))
+        self.assertEqual(len(matrices), 3)
+
+        # the missing bar of MSFT is forward filled
+        data, symbols, timestamps = matrices[-2]
+        self.assertEqual(list(data[2, -1]), [300.5, 300.5, 300.5, 300.5, 0])
+        self.assertEqual(list(data[:2, -1, 0]), [101, 201])
+
+        data, symbols, timestamps = matrices[-1]
+        self.assertEqual(list(data[:, -1, 0]), [102, 202, 302])
+        self.assertEqual(list(data[:, 0, 0]), [100, 200, 300])
+        self.assertEqual(list(timestamps), list(pd.date_range(start, periods=3, freq='1min').tz_localize('US/Eastern').tz_convert('UTC')))
+
+        # the interval is complete after the grace period
+        listener.process_live_bar(bar_record('AAPL', start + 3 * minute, 103, 13))
+        self.assertEqual(listener.bar_matrix.expire(time.time()), 0)
+        self.assertEqual(listener.bar_matrix.expire(listener.bar_matrix.next_deadline()), 1)
+        self.assertIsNone(listener.bar_matrix.next_deadline())
+        self.assertEqual(len(matrices), 4)
+        self.assertEqual(list(matrices[-1][0][:, -1, 0]), [103, 202.5, 302.5])
+
+        # late bars are ignored
+        listener.process_live_bar(bar_record('IBM', start + 3 * minute, 203, 23))
+        self.assertIsNone(listener.bar_matrix.next_deadline())
+        self.assertEqual(listener.bar_matrix.values[1, -1, 0], 202.5)
+
+        # invalid symbols are not waited for
+        listener.process_live_bar(bar_record('AAPL', start + 4 * minute, 104, 14))
+        listener.process_live_bar(bar_record('IBM', start + 4 * minute, 204, 24))
+        self.assertEqual(len(matrices), 4)
+        listener.process_invalid_symbol('MSFT')
+        self.assertEqual(len(matrices), 5)
+        self.assertEqual(list(matrices[-1][0][:, -1, 0]), [104, 204, 302.5])
+
+    def test_grace_timer(self):
+        listeners = SyncListeners()
+        listener = IQFeedBarDataListener(listeners=listeners, interval_len=60, mkt_snapshot_depth=3, adjust_history=False, bar_matrix_depth=2, bar_matrix_grace=0.1)
+        listener.watched_symbols['AAPL'] = listener.watched_symbols['IBM'] = None
+        listener.bar_matrix.add_symbols(['AAPL', 'IBM'])
+
+        e1 = threading.Event()
+        stream = listener.bar_matrix_event_stream()
+        stream += lambda data, symbols, timestamps: e1.set()
+
+        listener._bar_matrix_timer = threading.Thread(target=listener._expire_bar_matrix, daemon=True)
+        listener._bar_matrix_timer.start()
+
+        try:
+            listener.process_live_bar(bar_record('AAPL', datetime.datetime(2017, 3, 13, 10, 0), 100, 10))
+            self.assertTrue(e1.wait(5))
+            self.assertTrue(np.isnan(listener.bar_matrix.values[1, -1]).all())
+        finally:
+            with listener._bar_matrix_cond:
+                listener._stopped = True
+                listener._bar_matrix_cond.notify_all()
+
+            listener._bar_matrix_timer.join()
+
+
 class TestIQFeedBarData(unittest.TestCase):
     """
     IQFeed bar data test, which checks whether the class works in basic terms
@@ -0,0 +1,124 @@
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from pandas.util.testing import assert_frame_equal
+
+from atpy.data.iqfeed.iqfeed_history_cache import HistoryResponseCache
+from atpy.data.iqfeed.iqfeed_history_provider import IQFeedHistoryProvider, BarsInPeriodFilter, BarsFilter
+from tests.iqfeed.test_history_provider import FakeHistoryConn
+
+
+class TestHistoryResponseCache(unittest.TestCase):
+    """
+    Test the history responses cache with fake connections
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_is_cacheable(self):
+        f = BarsInPeriodFilter(ticker='AAPL', bgn_prd=datetime.datetime(2017, 3, 6), end_prd=datetime.datetime(2017, 3, 7), interval_len=60, ascend=True, interval_type='s')
+
+        self.assertTrue(HistoryResponseCache.is_cacheable(f))
+        self.assertTrue(HistoryResponseCache.is_cacheable(f._replace(end_prd=datetime.datetime(2017, 3, 7, tzinfo=datetime.timezone.utc))))
+        self.assertFalse(HistoryResponseCache.is_cacheable(f._replace(end_prd=None)))
+        self.assertFalse(HistoryResponseCache.is_cacheable(f._replace(end_prd=datetime.datetime.now())))
+        self.assertFalse(HistoryResponseCache.is_cacheable(BarsFilter(ticker='AAPL', interval_len=60, interval_type='s', max_bars=100)))
+
+        self.assertEqual(HistoryResponseCache.key(f._replace(timeout=10)), HistoryResponseCache.key(f))
+        self.assertNotEqual(HistoryResponseCache.key(f._replace(ticker='IBM')), HistoryResponseCache.key(f))
+
+    def test_provider_cache(self):
+        requests = list()
+        cache = HistoryResponseCache(self.tmpdir)
+
+        with IQFeedHistoryProvider(num_connections=4, conn_factory=lambda: FakeHistoryConn(latency=0.05, requests=requests), cache=cache) as history:
+            f = BarsInPeriodFilter(ticker=['AAPL', 'IBM'], bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 16), interval_len=60, ascend=True, interval_type='s')
+
+            expected = history.request_data(f)
+            self.assertEqual(len(requests), 2)
+
+            assert_frame_equal(expected, history.request_data(f._replace(timeout=30)))
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(cache.hits, 2)
+
+            ibm = f._replace(ticker='IBM')
+            expected = history.request_data(ibm)
+            self.assertEqual(len(requests), 2)
+
+            # the current day is not cached
+            now = datetime.datetime.now()
+            current = f._replace(bgn_prd=now - datetime.timedelta(seconds=1), end_prd=now)
+            history.request_data(current)
+            history.request_data(current)
+            self.assertEqual(len(requests), 6)
+
+        # the cache persists between sessions
+        requests.clear()
+        with IQFeedHistoryProvider(conn_factory=lambda: FakeHistoryConn(requests=requests), cache=HistoryResponseCache(self.tmpdir)) as history:
+            assert_frame_equal(expected, history.request_data(ibm))
+            self.assertEqual(len(requests), 0)
+
+    def test_coalesce(self):
+        requests = list()
+        cache = HistoryResponseCache(self.tmpdir)
+        conn = FakeHistoryConn(latency=0.2, requests=requests)
+
+        for end_prd in [datetime.datetime(2017, 3, 6, 16), None]:
+            f = BarsInPeriodFilter(ticker='AAPL', bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=end_prd or datetime.datetime.now(), interval_len=60, ascend=True, interval_type='s')
+            requests.clear()
+
+            results = list()
+            threads = [threading.Thread(target=lambda: results.append(cache.request(f, lambda: conn.request_bars_in_period(*f)))) for _ in range(5)]
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(len(results), 5)
+            for r in results:
+                np.testing.assert_array_equal(r, results[0])
+
+    def test_eviction(self):
+        conn = FakeHistoryConn()
+        filters = [BarsInPeriodFilter(ticker='S' + str(i), bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 16), interval_len=60, ascend=True, interval_type='s') for i in range(5)]
+
+        size = len(conn.request_bars_in_period(*filters[0]).tobytes())
+        cache = HistoryResponseCache(self.tmpdir, max_size=int(3.5 * size))
+
+        for f in filters[:3]:
+            cache.request(f, lambda: conn.request_bars_in_period(*f))
+
+        # S0 becomes the most recently used
+        self.assertIsNotNone(cache.get(filters[0]))
+
+        for f in filters[3:]:
+            cache.request(f, lambda: conn.request_bars_in_period(*f))
+
+        self.assertLessEqual(cache.size, cache.max_size)
+        self.assertIsNotNone(cache.get(filters[0]))
+        self.assertIsNone(cache.get(filters[1]))
+        self.assertIsNone(cache.get(filters[2]))
+        self.assertIsNotNone(cache.get(filters[4]))
+
+        # the index is restored from the directory
+        cache = HistoryResponseCache(self.tmpdir, max_size=int(3.5 * size))
+        self.assertEqual(len(cache._entries), 3)
+        np.testing.assert_array_equal(cache.get(filters[4]), conn.request_bars_in_period(*filters[4]))
+
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        self.assertIsNone(cache.get(filters[4]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import datetime
+import logging
+import unittest
+
+import pandas as pd
+
+from atpy.data.iqfeed.iqfeed_history_planner import BackfillPlanner, trading_sessions, coverage_from_ranges
+from atpy.data.iqfeed.iqfeed_history_provider import BarsInPeriodFilter, TicksInPeriodFilter
+
+
+def utc(*args):
+    return pd.Timestamp(datetime.datetime(*args), tz='US/Eastern').tz_convert('UTC')
+
+
+class TestHistoryPlanner(unittest.TestCase):
+    """
+    Test the backfill planner
+    """
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+    def test_trading_sessions(self):
+        sessions = trading_sessions(datetime.datetime(2017, 11, 17, 12), datetime.datetime(2017, 11, 28, 10))
+
+        # weekend and thanksgiving are skipped
+        self.assertEqual([d.day for d in sessions.index], [17, 20, 21, 22, 24, 27, 28])
+
+        # the period clips the first and the last session
+        self.assertEqual(sessions['session_bgn'].iloc[0], pd.Timestamp(2017, 11, 17, 12))
+        self.assertEqual(sessions['session_end'].iloc[-1], pd.Timestamp(2017, 11, 28, 10))
+
+        # early close
+        self.assertEqual(sessions.loc['2017-11-24', 'session_end'], pd.Timestamp(2017, 11, 24, 13))
+        self.assertEqual(sessions.loc['2017-11-22', 'session_end'], pd.Timestamp(2017, 11, 22, 16))
+
+        sessions = trading_sessions(datetime.datetime(2017, 11, 20), datetime.datetime(2017, 11, 21), bgn_time=datetime.time(4), end_time=datetime.time(20))
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions['session_bgn'].iloc[0], pd.Timestamp(2017, 11, 20, 4))
+        self.assertEqual(sessions['session_end'].iloc[0], pd.Timestamp(2017, 11, 20, 20))
+
+    def test_plan(self):
+        bgn_prd, end_prd = datetime.datetime(2017, 11, 20), datetime.datetime(2017, 11, 28, 23)
+
+        planner = BackfillPlanner(interval_len=60, interval_type='s')
+
+        # without coverage the consecutive sessions are requested at once
+        filters = planner.plan(['AAPL', 'IBM'], bgn_prd, end_prd)
+        self.assertEqual(filters, [BarsInPeriodFilter(ticker=['AAPL', 'IBM'], interval_len=60, interval_type='s', bgn_prd=datetime.datetime(2017, 11, 20, 9, 30), end_prd=datetime.datetime(2017, 11, 28, 16),
+                                                      bgn_flt=datetime.time(9, 30), end_flt=datetime.time(16), ascend=True)])
+
+        coverage = {
+            # complete (the bars are labeled at the end of the interval)
+            'FULL': [(utc(2017, 11, 20, 9, 31), utc(2017, 11, 28, 16))],
+            # the first 3 days
+            'HEAD': [(utc(2017, 11, 20, 9, 31), utc(2017, 11, 22, 16))],
+            'HEAD_2': [(utc(2017, 11, 20, 9, 31), utc(2017, 11, 22, 16))],
+            # partial last day
+            'PARTIAL': [(utc(2017, 11, 20, 9, 31), utc(2017, 11, 28, 12))],
+            # per-day coverage with a missing day. The small gaps at the end of the sessions are ignored
+            'DAYS': [(utc(2017, 11, d, 9, 31), utc(2017, 11, d, 15, 50)) for d in [20, 22, 27, 28]] + [(utc(2017, 11, 24, 9, 31), utc(2017, 11, 24, 13))],
+            # naive UTC timestamps
+            'NAIVE': [(utc(2017, 11, 20, 9, 31).tz_localize(None), utc(2017, 11, 27, 16).tz_localize(None))],
+        }
+
+        filters = planner.plan(list(coverage) + ['NEW'], bgn_prd, end_prd, coverage=coverage)
+        periods = {(f.bgn_prd, f.end_prd): f.ticker for f in filters}
+
+        self.assertEqual(periods, {
+            (datetime.datetime(2017, 11, 20, 9, 30), datetime.datetime(2017, 11, 28, 16)): 'NEW',
+            (datetime.datetime(2017, 11, 24, 9, 30), datetime.datetime(2017, 11, 28, 16)): ['HEAD', 'HEAD_2'],
+            (datetime.datetime(2017, 11, 28, 12), datetime.datetime(2017, 11, 28, 16)): 'PARTIAL',
+            (datetime.datetime(2017, 11, 21, 9, 30), datetime.datetime(2017, 11, 21, 16)): 'DAYS',
+            (datetime.datetime(2017, 11, 28, 9, 30), datetime.datetime(2017, 11, 28, 16)): 'NAIVE',
+        })
+
+        self.assertEqual([f.bgn_prd for f in filters], sorted(f.bgn_prd for f in filters))
+
+        filters = planner.plan(['HEAD', 'HEAD_2'], bgn_prd, end_prd, coverage=coverage, group=False)
+        self.assertEqual([f.ticker for f in filters], ['HEAD', 'HEAD_2'])
+
+        # no tolerance
+        planner = BackfillPlanner(interval_len=60, interval_type='s', tolerance=datetime.timedelta(0))
+        filters = planner.plan(['DAYS'], bgn_prd, end_prd, coverage=coverage)
+        self.assertEqual([(f.bgn_prd, f.end_prd) for f in filters], [(datetime.datetime(2017, 11, 20, 15, 50), datetime.datetime(2017, 11, 21, 16))] +
+                         [(datetime.datetime(2017, 11, d, 15, 50), datetime.datetime(2017, 11, d, 16)) for d in [22, 27, 28]])
+
+    def test_max_rows(self):
+        bgn_prd, end_prd = datetime.datetime(2017, 11, 20), datetime.datetime(2017, 11, 28, 23)
+
+        # 390 bars per session (210 on 2017-11-24)
+        planner = BackfillPlanner(interval_len=60, interval_type='s', max_rows=1000)
+        filters = planner.plan(['AAPL'], bgn_prd, end_prd)
+        self.assertEqual([(f.bgn_prd.day, f.end_prd.day) for f in filters], [(20, 21), (22, 27), (28, 28)])
+
+        # the sessions are split
+        planner = BackfillPlanner(interval_len=60, interval_type='s', max_rows=300)
+        filters = planner.plan(['AAPL'], datetime.datetime(2017, 11, 20), datetime.datetime(2017, 11, 21))
+        self.assertEqual([(f.bgn_prd, f.end_prd) for f in filters], [(datetime.datetime(2017, 11, 20, 9, 30), datetime.datetime(2017, 11, 20, 14, 30)),
+                                                                    (datetime.datetime(2017, 11, 20, 14, 30), datetime.datetime(2017, 11, 20, 16))])
+
+        # ticks
+        planner = BackfillPlanner(interval_len=None, max_rows=50000, ascend=False)
+        filters = planner.plan(['AAPL'], bgn_prd, end_prd)
+        self.assertTrue(all(isinstance(f, TicksInPeriodFilter) for f in filters))
+        self.assertEqual(len(filters), 3)
+        self.assertEqual([f.bgn_prd for f in filters], sorted((f.bgn_prd for f in filters), reverse=True))
+
+    def test_coverage_from_ranges(self):
+        ranges = {('AAPL', 60, 's'): (utc(2017, 11, 20, 9, 31), utc(2017, 11, 28, 16)), ('AAPL', 300, 's'): (utc(2017, 11, 20, 9, 35), utc(2017, 11, 28, 16))}
+        self.assertEqual(coverage_from_ranges(ranges, 60, 's'), {'AAPL': [ranges[('AAPL', 60, 's')]]})
+
+    def test_plan_performance(self):
+        symbols = ['S' + str(i) for i in range(2000)]
+        bgn_prd, end_prd = datetime.datetime(2013, 1, 1), datetime.datetime(2017, 12, 31)
+
+        # each symbol has the data of a different number of days
+        days = trading_sessions(bgn_prd, end_prd).index
+        coverage = {s: [(pd.Timestamp(days[i % 100]).tz_localize('US/Eastern'), pd.Timestamp(days[-1 - i % 50]).tz_localize('US/Eastern'))] for i, s in enumerate(symbols)}
+
+        planner = BackfillPlanner(interval_len=60, interval_type='s')
+
+        now = datetime.datetime.now()
+        filters = planner.plan(symbols, bgn_prd, end_prd, coverage=coverage)
+        logging.getLogger(__name__).debug("Plan for " + str(len(symbols)) + " symbols: " + str(len(filters)) + " filters in " + str(datetime.datetime.now() - now))
+
+        self.assertLessEqual(len(filters), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,270 @@
+import time
 import unittest
 
+import numpy as np
+from pandas.util.testing import assert_frame_equal
+
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.util import resample_bars
 from pyevents.events import AsyncListeners, SyncListeners
 
 
+class FakeHistoryConn(object):
+    """
+    Local replacement of pyiqfeed.HistoryConn, which simulates latency. The bars are deterministic functions of the symbol and the timestamp, so that
+    requests for overlapping periods return the same data. Each symbol has some missing bars. The symbol EMPTY has no data
+    """
+
+    _BAR_DTYPE = [('date', 'M8[D]'), ('time', 'm8[us]'), ('high_p', 'f8'), ('low_p', 'f8'), ('open_p', 'f8'), ('close_p', 'f8'), ('tot_vlm', 'u8'), ('prd_vlm', 'u8'), ('num_trds', 'u8')]
+
+    def __init__(self, latency: float = 0.0, requests: list = None, failures: dict = None):
+        """
+        :param latency: latency of each request in seconds. Symbols, which end with _SLOW, have 10 times higher latency
+        :param requests: list of all requests (shared between connections)
+        :param failures: dict of symbol -> number of transient failures before the request succeeds (shared between connections)
+        """
+        self.latency = latency
+        self.requests = requests if requests is not None else list()
+        self.failures = failures if failures is not None else dict()
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def request_bars_in_period(self, ticker: str, interval_len: int, interval_type: str, bgn_prd: datetime.datetime, end_prd: datetime.datetime, bgn_flt: datetime.time = None, end_flt: datetime.time = None,
+                               ascend: bool = False, max_bars: int = None, label_at_begin: int = 0, timeout: int = None):
+        self.requests.append((ticker, bgn_prd, end_prd))
+        time.sleep(self.latency * 10 if ticker.endswith('_SLOW') else self.latency)
+
+        if self.failures.get(ticker, 0) > 0:
+            self.failures[ticker] -= 1
+            raise ConnectionError("Simulated failure")
+
+        seconds = np.arange(np.datetime64(bgn_prd, 's').astype(np.int64), np.datetime64(end_prd, 's').astype(np.int64) + 1, interval_len)
+        seconds = seconds[seconds % interval_len == 0]
+
+        symbol_id = sum(ord(c) for c in ticker)
+        seconds = seconds[(seconds // interval_len + symbol_id) % 7 != 0]
+
+        if ticker == 'EMPTY' or len(seconds) == 0:
+            raise pyiqfeed.exceptions.NoDataError()
+
+        if not ascend:
+            seconds = seconds[::-1]
+
+        result = np.empty(len(seconds), dtype=self._BAR_DTYPE)
+        timestamps = seconds.astype('M8[s]')
+        result['date'] = timestamps.astype('M8[D]')
+        result['time'] = (timestamps - result['date']).astype('m8[us]')
+        result['close_p'] = 50 + 10 * np.sin(seconds / 10000 + symbol_id)
+        result['open_p'] = result['close_p'] * 1.01
+        result['high_p'] = result['close_p'] * 1.02
+        result['low_p'] = result['close_p'] * 0.99
+        result['prd_vlm'] = seconds % 1000 + 1
+        result['tot_vlm'] = seconds % 100000
+        result['num_trds'] = seconds % 10 + 1
+
+        return result
+
+
+class LegacyHistoryProvider(IQFeedHistoryProvider):
+    """
+    Per-symbol groupby implementation of synchronize_timestamps and tz_localize based processing of the raw data, used as a reference for the vectorized ones
+    """
+
+    def _process_ticks(self, data, data_filter):
+        result = pd.DataFrame(data)
+        sf = self.key_suffix
+
+        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
+        result.set_index('timestamp' + sf, inplace=True, drop=False)
+        result.drop(['date', 'time'], axis=1, inplace=True)
+
+        result.rename(
+            {"last": "last" + sf, "last_sz": "last_size" + sf, "tot_vlm": "total_volume" + sf, "bid": "bid" + sf, "ask": "ask" + sf, "tick_id": "tick_id" + sf, "last_type": "basis_for_last" + sf, "mkt_ctr": "trade_market_center" + sf},
+            axis="columns", copy=False, inplace=True)
+        result['symbol'] = data_filter.ticker
+
+        return result
+
+    def _process_bars(self, data, data_filter):
+        result = pd.DataFrame(data)
+        sf = self.key_suffix
+
+        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
+        result.set_index('timestamp' + sf, inplace=True, drop=False)
+        result.drop(['date', 'time'], axis=1, inplace=True)
+
+        result.rename({"high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "tot_vlm": "total_volume" + sf, "prd_vlm": "volume" + sf, "num_trds": "number_of_trades" + sf}, axis="columns",
+                      copy=False, inplace=True)
+        result['symbol'] = data_filter.ticker
+
+        return result
+
+    def synchronize_timestamps(self, signals: map, f: NamedTuple):
+        col = 'timestamp' + self.key_suffix
+        signals = pd.concat(signals)
+        signals.index.set_names('symbol', level=0, inplace=True)
+
+        multi_index = pd.MultiIndex.from_product([signals['symbol'].unique(), signals[col].unique()], names=['symbol', col]).sort_values()
+
+        signals = signals.reindex(multi_index)
+        signals.drop(['symbol', col], axis=1, inplace=True)
+        signals.reset_index(inplace=True)
+        signals.set_index(multi_index, inplace=True)
+
+        for c in [c for c in ['volume', 'number_of_trades'] if c in signals.columns]:
+            signals[c].fillna(0, inplace=True)
+
+        if 'close' in signals.columns:
+            signals['close'] = signals.groupby(level=0)['close'].fillna(method='ffill')
+
+            if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
+                last = self.current_batch.groupby(level=0)['close'].last()
+                signals['close'] = signals.groupby(level=0)['close'].apply(lambda x: x.fillna(last[last.index.get_loc(x.name)]))
+
+            signals['close'] = signals.groupby(level=0)['close'].fillna(method='backfill')
+
+            op = signals['close']
+
+            for c in [c for c in ['open', 'high', 'low'] if c in signals.columns]:
+                signals[c].fillna(op, inplace=True)
+
+        signals = signals.groupby(level=0).fillna(method='ffill')
+
+        if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
+            last = self.current_batch.groupby(level=0).last()
+            signals = signals.groupby(level=0).apply(lambda x: x.fillna(last.iloc[last.index.get_loc(x.name)]))
+
+        signals = signals.groupby(level=0).fillna(method='backfill')
+
+        if not f.ascend:
+            signals.sort_index(level=['symbol', col], inplace=True, ascending=False)
+
+        return signals
+
+
+_TICK_DTYPE = [('tick_id', 'u8'), ('date', 'M8[D]'), ('time', 'm8[us]'), ('last', 'f8'), ('last_sz', 'u8'), ('last_type', 'S1'), ('mkt_ctr', 'u4'), ('tot_vlm', 'u8'), ('bid', 'f8'), ('ask', 'f8'),
+               ('cond1', 'u1'), ('cond2', 'u1'), ('cond3', 'u1'), ('cond4', 'u1')]
+
+
+def random_ticks(n: int, seed=0):
+    """Random ticks with the dtype of pyiqfeed. The ticks are between 4 AM and 8 PM (US/Eastern) from March to November 2017, which includes both DST transitions"""
+    np.random.seed(seed)
+
+    days = np.sort(np.random.randint(0, 275, n)) + np.datetime64('2017-03-01', 'D')
+
+    result = np.empty(n, dtype=_TICK_DTYPE)
+    result['tick_id'] = np.arange(n)
+    result['date'] = days
+    result['time'] = np.random.randint(4 * 3600 * 10 ** 6, 20 * 3600 * 10 ** 6, n).astype('m8[us]')
+    result['last'] = np.random.rand(n) * 100
+    result['last_sz'] = np.random.randint(1, 1000, n)
+    result['last_type'] = np.random.choice([b'C', b'E', b'O'], n)
+    result['mkt_ctr'] = np.random.randint(1, 30, n)
+    result['tot_vlm'] = np.cumsum(result['last_sz'])
+    result['bid'] = result['last'] - 0.01
+    result['ask'] = result['last'] + 0.01
+    for c in ['cond1', 'cond2', 'cond3', 'cond4']:
+        result[c] = np.random.randint(0, 100, n)
+
+    return result
+
+
+def random_bars(symbols: int, bars: int, start='2017-03-06 14:30', missing=0.1, seed=0):
+    """Random 1 minute bars for each symbol with the same columns and dtypes as IQFeedHistoryProvider._process_bars"""
+    np.random.seed(seed)
+
+    timestamps = pd.date_range(start=start, periods=bars, freq='1min', tz='UTC', name='timestamp')
+
+    result = dict()
+    for i in range(symbols):
+        symbol = 'S' + str(i)
+
+        # some symbols start late, which leaves missing values at the beginning of the batch
+        mask = np.random.rand(bars) > missing
+        if missing > 0 and i % 5 == 1:
+            mask[:np.random.randint(1, bars)] = False
+
+        ts = timestamps[mask]
+        close = np.random.rand(len(ts)) * 100
+        df = pd.DataFrame({'high': close * 1.02, 'low': close * 0.99, 'open': close * 1.01, 'close': close,
+                           'total_volume': np.random.randint(1, 100000, len(ts)).astype(np.uint64),
+                           'volume': np.random.randint(1, 1000, len(ts)).astype(np.uint64),
+                           'number_of_trades': np.random.randint(1, 100, len(ts)).astype(np.uint64)})
+
+        if i % 7 == 3 and len(df) > 0:
+            df.loc[0, 'open'] = 0
+
+        df['timestamp'] = ts
+        df.set_index('timestamp', inplace=True, drop=False)
+        df['symbol'] = symbol
+
+        if len(df) > 0:
+            result[symbol] = df
+
+    return result
+
+
+class FakeAdjustmentsHistoryEvents(IQFeedHistoryEvents):
+    """
+    History events with fake splits/dividends instead of the fundamental data of the streaming conn. Each symbol has a split and a dividend
+    """
+
+    def __init__(self, *args, adjustments_latency: float = 0.0, adjustments_failures: int = 0, **kwargs):
+        """
+        :param adjustments_latency: latency of each splits/dividends request in seconds
+        :param adjustments_failures: number of failed requests after the first one
+        """
+        super().__init__(*args, **kwargs)
+        self.adjustments_latency = adjustments_latency
+        self.adjustments_failures = adjustments_failures
+        self.adjustments_requests = list()
+
+    def _fetch_adjustments(self, ticker):
+        self.adjustments_requests.append(ticker)
+        time.sleep(self.adjustments_latency)
+
+        if 1 < len(self.adjustments_requests) <= 1 + self.adjustments_failures:
+            raise Exception("Connection refused")
+
+        return fake_splits_dividends(ticker)
+
+
+class ImmediateExecutor(concurrent.futures.Executor):
+    """Executes the tasks in the calling thread, therefore the futures are done before submit returns"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+def fake_splits_dividends(ticker):
+    symbols = sorted([ticker] if isinstance(ticker, str) else ticker)
+
+    dates = [datetime.datetime(2017, 3, 8), datetime.datetime(2017, 3, 7), datetime.datetime(2017, 3, 9), datetime.datetime(2017, 3, 10)]
+
+    result = pd.DataFrame({'timestamp': [d for d in dates for _ in symbols],
+                           'symbol': symbols * len(dates),
+                           'type': ['split'] * len(symbols) + ['dividend'] * len(symbols) * (len(dates) - 1),
+                           'value': [0.5] * len(symbols) + [0.1] * len(symbols) * (len(dates) - 1),
+                           'provider': 'iqfeed'})
+
+    result = result.set_index(['timestamp', 'symbol', 'type', 'provider'])
+    result = result.tz_localize('US/Eastern', level=0).tz_convert('UTC', level=0)
+    result.sort_index(inplace=True)
+
+    return result
+
+
 class TestIQFeedHistory(unittest.TestCase):
     """
     IQFeed history provider test, which checks whether the class works in basic terms
@@ -385,6 +645,281 @@ class TestIQFeedHistory(unittest.TestCase):
             requested_data = history.request_data(BarsInPeriodFilter(ticker=["AAPL", "IBM"], bgn_prd=datetime.datetime(2017, 4, 1), end_prd=end_prd, interval_len=3600, ascend=True, interval_type='s'), sync_timestamps=True)
             self.assertEqual(requested_data.loc['AAPL'].shape, requested_data.loc['IBM'].shape)
 
+    def test_synchronize_timestamps_vectorized(self):
+        history, legacy = IQFeedHistoryProvider(), LegacyHistoryProvider()
+
+        for ascend in [True, False]:
+            f = BarsInPeriodFilter(ticker=None, bgn_prd=None, end_prd=None, interval_len=60, ascend=ascend, interval_type='s')
+
+            # previous batch is carried over only for ascending filters
+            for p in [history, legacy]:
+                p.current_filter, p.current_batch = None, None
+
+            for i, missing in enumerate([0.1, 0.5, 0.0]):
+                signals = random_bars(30, 50, start=pd.Timestamp('2017-03-06 14:30') + pd.Timedelta(minutes=50 * i), missing=missing, seed=i)
+
+                result = history.synchronize_timestamps({k: v.copy() for k, v in signals.items()}, f)
+                expected = legacy.synchronize_timestamps({k: v.copy() for k, v in signals.items()}, f)
+
+                assert_frame_equal(expected, result)
+                self.assertFalse(result.isnull().values.any())
+
+                for p in [history, legacy]:
+                    p.current_filter, p.current_batch = f, expected
+
+    def test_synchronize_timestamps_performance(self):
+        history, legacy = IQFeedHistoryProvider(), LegacyHistoryProvider()
+        f = BarsInPeriodFilter(ticker=None, bgn_prd=None, end_prd=None, interval_len=60, ascend=True, interval_type='s')
+
+        for symbols in [100, 1000, 5000]:
+            signals = random_bars(symbols, 390)
+
+            now = datetime.datetime.now()
+            history.synchronize_timestamps(signals, f)
+            log = str(symbols) + " symbols: vectorized " + str(datetime.datetime.now() - now)
+
+            # the groupby implementation is too slow for larger batches
+            if symbols <= 1000:
+                now = datetime.datetime.now()
+                legacy.synchronize_timestamps(signals, f)
+                log += "; groupby " + str(datetime.datetime.now() - now)
+
+            logging.getLogger(__name__).debug(log)
+
+    def test_request_data_stream(self):
+        requests = list()
+        with IQFeedHistoryProvider(num_connections=3, min_connections=3, conn_factory=lambda: FakeHistoryConn(latency=0.05, requests=requests)) as history:
+            tickers = ['S' + str(i) for i in range(10)] + ['A_SLOW', 'EMPTY']
+            f = BarsInPeriodFilter(ticker=tickers, bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 16), interval_len=60, ascend=True, interval_type='s')
+
+            requested = list()
+            results = dict()
+            for ft, data in history.request_data_stream(f, max_pending=4):
+                requested.append(len(requests))
+                results[ft.ticker] = data
+
+            # the consumer limits the number of requests ahead
+            self.assertLessEqual(requested[0], 5)
+
+            # the slowest symbol arrives last
+            self.assertEqual(list(results)[-1], 'A_SLOW')
+            self.assertEqual(set(results), set(tickers) - {'EMPTY'})
+
+            for t, data in results.items():
+                assert_frame_equal(history.request_data(f._replace(ticker=t)), data)
+
+            expected = history.request_data(f, sync_timestamps=False)
+            for t, data in results.items():
+                assert_frame_equal(expected.loc[t], data)
+
+            # stop early
+            stream = history.request_data_stream(f, max_pending=2)
+            next(stream)
+            stream.close()
+
+    def test_request_synchronized_windows(self):
+        with IQFeedHistoryProvider(num_connections=3, conn_factory=lambda: FakeHistoryConn(latency=0.01)) as history:
+            tickers = ['S' + str(i) for i in range(8)] + ['EMPTY']
+            f = BarsInPeriodFilter(ticker=tickers, bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 15, 59), interval_len=60, ascend=True, interval_type='s')
+
+            windows = list(history.request_synchronized_windows(f, window=relativedelta(hours=1)))
+
+            self.assertEqual(len(windows), 7)
+            self.assertEqual([w.bgn_prd for w, _ in windows], [datetime.datetime(2017, 3, 6, 9 + i, 30) for i in range(7)])
+            self.assertEqual([w.end_prd for w, _ in windows], [datetime.datetime(2017, 3, 6, 10 + i, 29, 59) for i in range(6)] + [datetime.datetime(2017, 3, 6, 15, 59)])
+
+            for w, data in windows:
+                self.assertEqual(len(data.index.levels[0]), 8)
+                self.assertFalse(data.isnull().values.any())
+
+            # the windows are equivalent to a single synchronized request
+            assert_frame_equal(history.request_data(f, sync_timestamps=True), pd.concat([d for _, d in windows]).sort_index())
+
+            windows = list(history.request_synchronized_windows(f._replace(ascend=False), window=relativedelta(hours=1)))
+            self.assertEqual([w.bgn_prd for w, _ in windows], [datetime.datetime(2017, 3, 6, 9 + i, 30) for i in reversed(range(7))])
+            for w, data in windows:
+                self.assertTrue(data.index.is_monotonic_decreasing)
+
+    def test_process_data(self):
+        history, legacy = IQFeedHistoryProvider(key_suffix='_x'), LegacyHistoryProvider(key_suffix='_x')
+
+        f = TicksInPeriodFilter(ticker='AAPL', bgn_prd=datetime.datetime(2017, 3, 1), end_prd=datetime.datetime(2017, 12, 1), ascend=True)
+        ticks = random_ticks(100000)
+        assert_frame_equal(legacy._process_data(ticks, f), history._process_data(ticks, f))
+
+        # transition days, including the hours around the transition
+        ticks = random_ticks(1000)
+        ticks['date'] = np.datetime64('2017-11-05')
+        ticks['time'] = np.sort(np.random.randint(0, 24 * 3600 * 10 ** 6, len(ticks))).astype('m8[us]')
+        ticks = ticks[(ticks['time'] < np.timedelta64(1, 'h')) | (ticks['time'] >= np.timedelta64(2, 'h'))]
+        assert_frame_equal(legacy._process_data(ticks, f), history._process_data(ticks, f))
+
+        conn = FakeHistoryConn()
+        f = BarsInPeriodFilter(ticker='AAPL', bgn_prd=datetime.datetime(2017, 3, 13), end_prd=datetime.datetime(2017, 3, 18), interval_len=60, ascend=True, interval_type='s')
+        bars = conn.request_bars_in_period(*f)
+        assert_frame_equal(legacy._process_data(bars, f), history._process_data(bars, f))
+
+    def test_process_data_performance(self):
+        history, legacy = IQFeedHistoryProvider(), LegacyHistoryProvider()
+        f = TicksInPeriodFilter(ticker='AAPL', bgn_prd=datetime.datetime(2017, 3, 1), end_prd=datetime.datetime(2017, 12, 1), ascend=True)
+        ticks = random_ticks(1000000)
+
+        # build the offsets table
+        history._process_data(ticks[:10], f)
+
+        now = datetime.datetime.now()
+        history._process_data(ticks, f)
+        log = "1M ticks: per-day offsets " + str(datetime.datetime.now() - now)
+
+        now = datetime.datetime.now()
+        legacy._process_data(ticks, f)
+        log += "; tz_localize " + str(datetime.datetime.now() - now)
+
+        logging.getLogger(__name__).debug(log)
+
+    def test_connection_pool(self):
+        requests = list()
+        failures = {'S1': 2, 'S2': 10}
+
+        with IQFeedHistoryProvider(num_connections=4, min_connections=4, conn_factory=lambda: FakeHistoryConn(latency=0.02, requests=requests, failures=failures)) as history:
+            history.pool.backoff = 0.01
+
+            tickers = ['S' + str(i) for i in range(20)]
+            f = BarsInPeriodFilter(ticker=tickers, bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 16), interval_len=60, ascend=True, interval_type='s')
+
+            data = history.request_data(f, sync_timestamps=False)
+
+            # S1 succeeds after 2 retries and S2 fails after max_retries
+            self.assertEqual(set(data.index.levels[0]), set(tickers) - {'S2'})
+            self.assertEqual(len(requests), 20 + 2 + 3)
+
+            stats = history.connection_stats()
+            self.assertEqual(len(stats), 4)
+            self.assertEqual(stats['requests'].sum(), 20)
+            self.assertEqual(stats['retries'].sum(), 5)
+            self.assertEqual(stats['failures'].sum(), 1)
+            self.assertEqual(stats['rows'].sum(), len(data))
+            self.assertTrue((stats.loc[stats['rows'] > 0, 'rows_per_second'] > 0).all())
+
+    def test_connection_pool_growth(self):
+        gate = threading.Event()
+
+        with IQFeedHistoryProvider(num_connections=4, min_connections=1, conn_factory=FakeHistoryConn) as history:
+            self.assertEqual(history.pool.num_connections, 1)
+
+            def fn(f, conn):
+                gate.wait()
+                return history._request_raw_data(f, conn)
+
+            # at most one task per connection runs while the gate is closed, therefore the queued tasks grow the pool to its maximum
+            done = threading.Semaphore(0)
+            for i in range(20):
+                f = BarsInPeriodFilter(ticker='S' + str(i), bgn_prd=datetime.datetime(2017, 3, 6, 9, 30), end_prd=datetime.datetime(2017, 3, 6, 16), interval_len=60, ascend=True, interval_type='s')
+                history.pool.submit(fn, f, callback=lambda *args: done.release())
+
+            self.assertEqual(history.pool.num_connections, 4)
+
+            gate.set()
+            for i in range(20):
+                done.acquire()
+
+            stats = history.connection_stats()
+            self.assertEqual(len(stats), 4)
+            self.assertEqual(stats['requests'].sum(), 20)
+            self.assertEqual(stats['failures'].sum(), 0)
+            self.assertTrue((stats.loc[stats['rows'] > 0, 'rows_per_second'] > 0).all())
+
+    def test_pipelined_adjustments(self):
+        tickers = ['S' + str(i) for i in range(5)]
+        # each batch spans two days and contains at least one adjustment
+        filters = [BarsInPeriodFilter(ticker=tickers, bgn_prd=datetime.datetime(2017, 3, d, 9, 30), end_prd=datetime.datetime(2017, 3, d + 1, 16), interval_len=60, ascend=True, interval_type='s')
+                   for d in range(6, 10)]
+
+        # legacy sequential request, synchronization and adjustment
+        expected, unadjusted = list(), list()
+        with IQFeedHistoryProvider(num_connections=5, min_connections=5, conn_factory=FakeHistoryConn) as history:
+            for f in filters:
+                d = history.request_data(f)
+                unadjusted.append(d.copy())
+                d = d.swaplevel(0, 1)
+                d.sort_index(inplace=True)
+                d = adjust_df(data=d, adjustments=fake_splits_dividends(tickers)).swaplevel(0, 1)
+                history.current_filter, history.current_batch = f, d
+                expected.append(d)
+
+        with FakeAdjustmentsHistoryEvents(listeners=SyncListeners(), filter_provider=filters, num_connections=5, min_connections=5, conn_factory=lambda: FakeHistoryConn(latency=0.3),
+                                          adjustments_latency=0.3) as events:
+            now = time.time()
+            batches = list()
+            for d, f in events.next_batch():
+                # slow consumer, which overlaps with the next history request
+                time.sleep(0.3)
+                batches.append(d)
+
+            elapsed = time.time() - now
+
+            # the fundamentals are requested once per symbol set
+            self.assertEqual(len(events.adjustments_requests), 1)
+
+        self.assertEqual(len(batches), len(expected))
+        for d, e in zip(batches, expected):
+            assert_frame_equal(e, d)
+
+        for d, u in zip(batches, unadjusted):
+            self.assertFalse(np.allclose(d['close'], u['close']))
+
+        # sequential execution takes 4 * (0.3 + 0.3) seconds plus the synchronization and adjustment of each batch
+        self.assertLess(elapsed, 2.8)
+
+    def test_adjustments_refresh(self):
+        with FakeAdjustmentsHistoryEvents(listeners=SyncListeners(), conn_factory=FakeHistoryConn, adjustments_ttl=0, adjustments_latency=0.1) as events:
+            first = events._get_adjustments(['S0', 'S1'])
+            self.assertEqual(len(events.adjustments_requests), 1)
+
+            # the expired value is returned without waiting, while the refresh runs in the background
+            now = time.time()
+            self.assertIs(events._get_adjustments(['S1', 'S0']), first)
+            self.assertLess(time.time() - now, 0.1)
+
+            time.sleep(0.3)
+            self.assertEqual(len(events.adjustments_requests), 2)
+            assert_frame_equal(first, events._get_adjustments(['S0', 'S1']))
+
+    def test_adjustments_refresh_done(self):
+        # the refresh is done before its callback is registered
+        with FakeAdjustmentsHistoryEvents(listeners=SyncListeners(), conn_factory=FakeHistoryConn, adjustments_ttl=0) as events:
+            events._fundamentals_executor.shutdown()
+            events._fundamentals_executor = ImmediateExecutor()
+
+            first = events._get_adjustments(['S0', 'S1'])
+            self.assertIs(events._get_adjustments(['S0', 'S1']), first)
+
+            second = events._get_adjustments(['S0', 'S1'])
+            self.assertIsNot(second, first)
+            assert_frame_equal(first, second)
+            self.assertEqual(len(events.adjustments_requests), 3)
+
+        # the refresh fails immediately. The previous value remains in use
+        with FakeAdjustmentsHistoryEvents(listeners=SyncListeners(), conn_factory=FakeHistoryConn, adjustments_ttl=0, adjustments_failures=2) as events:
+            events._fundamentals_executor.shutdown()
+            events._fundamentals_executor = ImmediateExecutor()
+
+            first = events._get_adjustments(['S0', 'S1'])
+            self.assertIs(events._get_adjustments(['S0', 'S1']), first)
+            self.assertIs(events._get_adjustments(['S0', 'S1']), first)
+            self.assertIsNone(events._adjustments[frozenset(['S0', 'S1'])]['refresh'])
+            self.assertEqual(len(events.adjustments_requests), 3)
+
+    def test_adjustments_refresh_zero_latency(self):
+        for failures in (0, 1):
+            with FakeAdjustmentsHistoryEvents(listeners=SyncListeners(), conn_factory=FakeHistoryConn, adjustments_ttl=0, adjustments_failures=failures) as events:
+                first = events._get_adjustments(['S0', 'S1'])
+
+                for _ in range(100):
+                    assert_frame_equal(first, events._get_adjustments(['S0', 'S1']))
+
+                self.assertGreater(len(events.adjustments_requests), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
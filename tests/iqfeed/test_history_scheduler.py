@@ -0,0 +1,161 @@
+import datetime
+import threading
+import time
+import unittest
+
+from atpy.data.iqfeed.iqfeed_history_provider import BarsInPeriodFilter, TicksInPeriodFilter, BarsDailyFilter, TicksFilter
+from atpy.data.iqfeed.iqfeed_history_scheduler import HistoryConnectionPool, estimate_cost
+from tests.iqfeed.test_history_provider import FakeHistoryConn
+
+
+class TestHistoryScheduler(unittest.TestCase):
+    """
+    Test the history connection pool with fake connections
+    """
+
+    def test_estimate_cost(self):
+        bgn_prd, end_prd = datetime.datetime(2017, 3, 1), datetime.datetime(2017, 4, 1)
+
+        ticks = estimate_cost(TicksInPeriodFilter(ticker='AAPL', bgn_prd=bgn_prd, end_prd=end_prd, ascend=True))
+        minute_bars = estimate_cost(BarsInPeriodFilter(ticker='AAPL', bgn_prd=bgn_prd, end_prd=end_prd, interval_len=60, ascend=True, interval_type='s'))
+        hour_bars = estimate_cost(BarsInPeriodFilter(ticker='AAPL', bgn_prd=bgn_prd, end_prd=end_prd, interval_len=3600, ascend=True, interval_type='s'))
+        daily = estimate_cost(BarsDailyFilter(ticker='AAPL', num_days=30))
+
+        self.assertGreater(ticks, minute_bars)
+        self.assertGreater(minute_bars, hour_bars)
+        self.assertGreater(hour_bars, daily)
+        self.assertEqual(estimate_cost(TicksFilter(ticker='AAPL', max_ticks=100, ascend=True, timeout=None)), 100)
+
+    def test_largest_first(self):
+        gate, running = threading.Event(), threading.Event()
+        executed = list()
+
+        def fn(task, conn):
+            if task == 'gate':
+                running.set()
+                gate.wait()
+
+            executed.append(task)
+
+        with HistoryConnectionPool(conn_factory=FakeHistoryConn, min_connections=1, max_connections=1) as pool:
+            pool.submit(fn, 'gate', cost=1)
+            running.wait()
+
+            for task, cost in [('small', 1), ('large', 100), ('medium', 10)]:
+                pool.submit(fn, task, cost=cost)
+
+            gate.set()
+            pool.request(fn, 'last', cost=0)
+
+        self.assertEqual(executed, ['gate', 'large', 'medium', 'small', 'last'])
+
+    def test_work_stealing(self):
+        gates = {'a': threading.Event(), 'c': threading.Event()}
+        running = {'a': threading.Event(), 'c': threading.Event()}
+        executed = dict()
+        done = threading.Semaphore(0)
+
+        def fn(task, conn):
+            if task in gates:
+                running[task].set()
+                gates[task].wait()
+
+            executed[task] = conn
+
+        with HistoryConnectionPool(conn_factory=FakeHistoryConn, min_connections=2, max_connections=2, grow_threshold=100) as pool:
+            pool.submit(fn, 'a', cost=100, callback=lambda *args: done.release())
+            running['a'].wait()
+
+            pool.submit(fn, 'c', cost=200, callback=lambda *args: done.release())
+            running['c'].wait()
+
+            # the small tasks go to the queue of the less loaded connection, which is busy with 'a'
+            for i in range(4):
+                pool.submit(fn, 'b' + str(i), cost=1, callback=lambda *args: done.release())
+
+            # the connection, which executed 'c', steals the small tasks
+            gates['c'].set()
+            for i in range(5):
+                done.acquire()
+
+            gates['a'].set()
+            done.acquire()
+
+            stats = pool.stats()
+
+        for i in range(4):
+            self.assertIs(executed['b' + str(i)], executed['c'])
+
+        self.assertGreaterEqual(stats['steals'].sum(), 4)
+        self.assertEqual(stats['requests'].sum(), 6)
+
+    def test_grow_shrink(self):
+        def fn(task, conn):
+            time.sleep(0.02)
+            return [task]
+
+        with HistoryConnectionPool(conn_factory=FakeHistoryConn, min_connections=1, max_connections=4, grow_threshold=1, idle_timeout=0.2) as pool:
+            self.assertEqual(pool.num_connections, 1)
+
+            done = threading.Semaphore(0)
+            for i in range(20):
+                pool.submit(fn, i, cost=1, callback=lambda *args: done.release())
+
+            self.assertEqual(pool.num_connections, 4)
+
+            for i in range(20):
+                done.acquire()
+
+            time.sleep(1)
+            self.assertEqual(pool.num_connections, 1)
+
+            stats = pool.stats()
+            self.assertEqual(len(stats), 4)
+            self.assertEqual(stats['active'].sum(), 1)
+            self.assertEqual(stats['rows'].sum(), 20)
+
+    def test_retry(self):
+        attempts = {'ok': 0, 'fail': 0}
+        connections = list()
+
+        def fn(task, conn):
+            connections.append(conn)
+            attempts[task] += 1
+            if task == 'fail' or attempts[task] < 3:
+                raise ConnectionError("Simulated failure")
+
+            return 'result'
+
+        with HistoryConnectionPool(conn_factory=FakeHistoryConn, max_retries=3, backoff=0.01) as pool:
+            self.assertEqual(pool.request(fn, 'ok', cost=1), 'result')
+            self.assertEqual(attempts['ok'], 3)
+
+            # each retry uses a new connection
+            self.assertEqual(len(set(id(c) for c in connections)), 3)
+
+            self.assertRaises(ConnectionError, pool.request, fn, 'fail', cost=1)
+            self.assertEqual(attempts['fail'], 4)
+
+            stats = pool.stats()
+            self.assertEqual(stats['retries'].sum(), 5)
+            self.assertEqual(stats['failures'].sum(), 1)
+
+    def test_no_retry(self):
+        attempts = list()
+
+        def fn(task, conn):
+            attempts.append(task)
+            raise ValueError("Simulated parsing error")
+
+        with HistoryConnectionPool(conn_factory=FakeHistoryConn, max_retries=3, backoff=0.01) as pool:
+            # deterministic errors are not retried
+            self.assertRaises(ValueError, pool.request, fn, 'parse', cost=1)
+            self.assertEqual(attempts, ['parse'])
+
+            stats = pool.stats()
+            self.assertEqual(stats['retries'].sum(), 0)
+            self.assertEqual(stats['failures'].sum(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
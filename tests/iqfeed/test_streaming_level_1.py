@@ -1,11 +1,250 @@
+import datetime
 import unittest
 from collections import OrderedDict
 
 from atpy.data.iqfeed.iqfeed_level_1_provider import *
+from atpy.data.iqfeed.util import iqfeed_to_deque, get_last_value, last_value
+from atpy.data.ts_util import RingBuffer
 from atpy.data.util import get_nasdaq_listed_companies
 from pyevents.events import *
 
 
+class FakeQuoteConn(object):
+    """
+    QuoteConn without connection. The data is sent by the tests
+    """
+
+    def __init__(self):
+        self.listeners = list()
+        self.watched = set()
+        self.max_watched = 0
+        self.watch_requests = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def watch(self, symbol: str):
+        with self.lock:
+            self.watched.add(symbol)
+            self.max_watched = max(self.max_watched, len(self.watched))
+            self.watch_requests += 1
+
+    def unwatch(self, symbol: str):
+        with self.lock:
+            self.watched.discard(symbol)
+
+
+class FakeFundamentalsConn(FakeQuoteConn):
+    """
+    QuoteConn, which answers the watch requests with fundamentals after a delay. Symbols starting with BAD are invalid and symbols starting with SILENT never respond
+    """
+
+    def __init__(self, delay: float = 0.05):
+        super().__init__()
+        self.delay = delay
+
+    def watch(self, symbol: str):
+        super().watch(symbol)
+
+        if symbol.startswith('BAD'):
+            threading.Timer(self.delay, lambda: [l.process_invalid_symbol(symbol) for l in self.listeners]).start()
+        elif not symbol.startswith('SILENT'):
+            fund = np.array([(symbol.encode('ascii'), 10.5, np.datetime64('2017-11-10'), 0.5, np.datetime64('NaT'), np.nan, np.datetime64('NaT'), np.nan)],
+                            dtype=[('Symbol', 'S10'), ('PE', 'f8'), ('Ex-dividend Date', 'M8[D]'), ('Dividend Amount', 'f8'),
+                                   ('Split Factor 1 Date', 'M8[D]'), ('Split Factor 1', 'f8'), ('Split Factor 2 Date', 'M8[D]'), ('Split Factor 2', 'f8')])
+            threading.Timer(self.delay, lambda: [l.process_fundamentals(fund) for l in self.listeners]).start()
+
+
+# default level 1 update fields. pyiqfeed sends the times as integer microseconds since midnight
+LEVEL_1_DTYPE = np.dtype([('Symbol', 'S64'), ('Most Recent Trade', 'f8'), ('Most Recent Trade Size', 'u8'), ('Most Recent Trade Time', 'u8'),
+                          ('Most Recent Trade Market Center', 'u1'), ('Total Volume', 'u8'), ('Bid', 'f8'), ('Bid Size', 'u8'), ('Ask', 'f8'), ('Ask Size', 'u8'),
+                          ('Open', 'f8'), ('High', 'f8'), ('Low', 'f8'), ('Close', 'f8'), ('Message Contents', 'S9'), ('Most Recent Trade Conditions', 'S16')])
+
+
+def level_1_record(symbol: str, i: int) -> np.array:
+    return np.array([(symbol.encode('ascii'), 50 + i / 100, i, i, 5, i * 10, 49.99 + i / 100, 100, 50.01 + i / 100, 200, 49, 51, 48, 50, b'Cbav', b'3D')],
+                    dtype=LEVEL_1_DTYPE)
+
+
+class TestIQFeedLevel1Snapshot(unittest.TestCase):
+    """
+    Test the level 1 market snapshot without connection
+    """
+
+    def test_snapshot(self):
+        listeners = SyncListeners()
+        with IQFeedLevel1Listener(listeners=listeners, mkt_snapshot_depth=3, conn=FakeQuoteConn()) as listener:
+            listener.watched_symbols.update({'IBM': None, 'AAPL': None})
+
+            updates = list()
+            listener.level_1_update_filter().__iadd__(lambda data: updates.append((data['symbol'], data['most_recent_trade_size'].copy())))
+
+            listener.process_summary(level_1_record('IBM', 0))
+            for i in range(1, 6):
+                listener.process_update(level_1_record('IBM', i))
+                listener.process_update(level_1_record('AAPL', i * 10))
+
+            self.assertEqual(updates[0][0], 'IBM')
+            self.assertEqual(list(updates[0][1]), [0, 1])
+            self.assertEqual(updates[-2][0], 'IBM')
+            self.assertEqual(list(updates[-2][1]), [3, 4, 5])
+            self.assertEqual(list(updates[-1][1]), [30, 40, 50])
+
+            snapshot = listener.watched_symbols['IBM']
+            self.assertEqual(len(snapshot), 16)
+            self.assertEqual(next(iter(snapshot)), 'symbol')
+            self.assertEqual(last_value(snapshot, 'bid'), 49.99 + 5 / 100)
+            self.assertEqual(get_last_value(snapshot)['message_contents'], b'Cbav')
+            self.assertEqual(get_last_value(snapshot)['symbol'], 'IBM')
+
+            # updates of unwatched symbols are not stored
+            listener.process_update(level_1_record('MSFT', 1))
+            self.assertNotIn('MSFT', listener.watched_symbols)
+
+    def test_update_batches(self):
+        listeners = SyncListeners()
+        with IQFeedLevel1Listener(listeners=listeners, update_batch_size=50, conn=FakeQuoteConn()) as listener:
+            updates, batches = list(), list()
+            listener.level_1_update_filter().__iadd__(lambda data: updates.append(data))
+            listener.level_1_update_batch_filter().__iadd__(lambda data: batches.append(data))
+
+            for i in range(230):
+                listener.process_update(level_1_record('S' + str(i % 3), i))
+
+            self.assertEqual([len(b) for b in batches], [50] * 4)
+
+            listener.flush_batch()
+            self.assertEqual([len(b) for b in batches], [50] * 4 + [30])
+            self.assertEqual(len(updates), 0)
+
+            df = pd.concat(batches, ignore_index=True)
+            self.assertEqual(list(df['most_recent_trade_size']), list(range(230)))
+            self.assertEqual(list(df['symbol']), ['S' + str(i % 3) for i in range(230)])
+            self.assertEqual(df['message_contents'].iloc[0], 'Cbav')
+            self.assertEqual(len(df.columns), 16)
+
+        # the interval flushes the batches
+        batches.clear()
+        with IQFeedLevel1Listener(listeners=listeners, update_batch_interval=0.05, conn=FakeQuoteConn()) as listener:
+            for i in range(2000):
+                listener.process_update(level_1_record('S' + str(i % 3), i))
+
+            time.sleep(0.2)
+            self.assertGreaterEqual(len(batches), 1)
+            self.assertEqual(sum(len(b) for b in batches), 2000)
+
+            listener.process_update(level_1_record('S1', 2000))
+
+        self.assertEqual(list(pd.concat(batches, ignore_index=True)['most_recent_trade_size']), list(range(2001)))
+
+    def test_snapshot_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        symbols = ['S' + str(i) for i in range(3000)]
+        records = [level_1_record(symbols[i % len(symbols)], i) for i in range(100000)]
+
+        with IQFeedLevel1Listener(listeners=SyncListeners(), mkt_snapshot_depth=200, conn=FakeQuoteConn()) as listener:
+            listener.watched_symbols.update({s: None for s in symbols})
+
+            # the buffers are allocated by the summary messages
+            for s in symbols:
+                listener.process_summary(level_1_record(s, 0))
+
+            now = datetime.datetime.now()
+            for r in records:
+                listener.process_update(r)
+
+        log = "100K updates of 3000 symbols: ring buffer " + str(datetime.datetime.now() - now)
+
+        # the previous dict of deques implementation
+        snapshots = {s: iqfeed_to_deque([level_1_record(s, 0)], maxlen=200) for s in symbols}
+
+        now = datetime.datetime.now()
+        for r in records:
+            update = r[0]
+            data = snapshots[update[0].decode("ascii")]
+            for key, v in zip(data, update):
+                if key != 'symbol':
+                    if isinstance(v, bytes):
+                        v = v.decode('ascii')
+
+                    data[key].append(v)
+
+        log += "; deque " + str(datetime.datetime.now() - now)
+
+        logging.getLogger(__name__).debug(log)
+
+
+class TestIQFeedFundamentalsProvider(unittest.TestCase):
+    """
+    Test the fundamentals service with a fake connection
+    """
+
+    def test_fundamentals(self):
+        conn = FakeFundamentalsConn()
+        symbols = ['S' + str(i) for i in range(200)] + ['BAD1', 'SILENT1']
+
+        with IQFeedFundamentalsProvider(conn=conn, window=50, timeout=1, ttl=3600) as provider:
+            now = time.time()
+            funds = provider.fundamentals(symbols + ['BAD2'])
+
+            # invalid symbols and timeouts don't block
+            self.assertLess(time.time() - now, 3)
+            self.assertEqual(set(funds), set(symbols[:200]))
+            self.assertEqual(funds['S5']['pe'], 10.5)
+            self.assertEqual(funds['S5']['symbol'], 'S5')
+
+            self.assertLessEqual(conn.max_watched, 50)
+            self.assertEqual(conn.watched, set())
+
+            # cached. The symbols, which timed out, are requested again
+            conn.watch_requests = 0
+            futures = provider.request(['S1', 'S2', 'BAD1', 'SILENT1'])
+            self.assertTrue(futures['S1'].done() and futures['BAD1'].done())
+            self.assertIsNone(futures['BAD1'].result())
+            self.assertIsNone(futures['SILENT1'].result())
+            self.assertEqual(conn.watch_requests, 1)
+
+            sd = provider.splits_dividends(['S1', 'S2'])
+            self.assertEqual(len(sd), 2)
+            self.assertEqual(set(sd.index.get_level_values('type')), {'dividend'})
+
+        self.assertEqual(conn.listeners, list())
+
+    def test_ttl(self):
+        conn = FakeFundamentalsConn(delay=0.01)
+
+        with IQFeedFundamentalsProvider(conn=conn, ttl=0.2) as provider:
+            provider.fundamentals(['IBM', 'AAPL'])
+            provider.fundamentals(['IBM', 'AAPL'])
+            self.assertEqual(conn.watch_requests, 2)
+
+            time.sleep(0.3)
+            provider.fundamentals(['IBM'])
+            self.assertEqual(conn.watch_requests, 3)
+
+    def test_unwatch_on_exit(self):
+        conn = FakeFundamentalsConn()
+
+        with IQFeedFundamentalsProvider(conn=conn, timeout=100) as provider:
+            futures = provider.request(['SILENT1', 'SILENT2', 'IBM'])
+            self.assertIsNotNone(futures['IBM'].result())
+
+        self.assertEqual(conn.watched, set())
+        self.assertTrue(futures['SILENT1'].cancelled())
+
+
 class TestIQFeedLevel1(unittest.TestCase):
     """
     IQFeed streaming news test, which checks whether the class works in basic terms
@@ -99,11 +338,14 @@ class TestIQFeedLevel1(unittest.TestCase):
 
             def on_update_item(data):
                 try:
+                    # ring buffer of the symbol (the text fields are bytes, except the symbol)
                     self.assertEqual(len(data), 16)
-                    self.assertTrue(isinstance(data, OrderedDict))
-                    self.assertGreater(len(next(iter(data.values()))), 1)
+                    self.assertTrue(isinstance(data, RingBuffer))
+                    self.assertGreater(data.size, 1)
                     self.assertEqual(next(iter(data.keys())), 'symbol')
                     self.assertTrue(isinstance(data['symbol'], str))
+                    self.assertEqual(len(data['most_recent_trade']), data.size)
+                    self.assertTrue(isinstance(data['message_contents'][-1], bytes))
                 finally:
                     e2.set()
 
@@ -141,12 +383,12 @@ class TestIQFeedLevel1(unittest.TestCase):
             def on_update_item(data):
                 try:
                     self.assertEqual(len(data), 16)
-                    self.assertTrue(isinstance(data, OrderedDict))
-                    self.assertGreater(len(next(iter(data.values()))), 1)
+                    self.assertTrue(isinstance(data, RingBuffer))
                     trade_times = data['most_recent_trade_time']
+                    self.assertEqual(len(trade_times), data.size)
                     self.assertEqual(len(trade_times), len(set(trade_times)))
                 finally:
-                    if len(trade_times) == mkt_snapshot_depth:
+                    if data.size == mkt_snapshot_depth:
                         e2.set()
 
             update_filter = listener.level_1_update_filter()
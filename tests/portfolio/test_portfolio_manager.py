@@ -1,3 +1,5 @@
+import pickle
+import random
 import unittest
 
 from atpy.backtesting.data_replay import DataReplayEvents, DataReplay
@@ -5,8 +7,91 @@ from atpy.backtesting.mock_exchange import MockExchange, PerShareCommissionLoss,
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.iqfeed.iqfeed_level_1_provider import *
 from atpy.portfolio.portfolio_manager import *
-from pyevents.events import AsyncListeners
+from pyevents.events import AsyncListeners, SyncListeners
 from pyevents_util.mongodb.mongodb_store import *
+from tests.backtesting.test_data_replay import random_bar_chunks
+from tests.backtesting.test_mock_exchange import random_level_1_ticks
+
+
+class LegacyPortfolioManager(PortfolioManager):
+    """PortfolioManager, which scans all orders on each query, used as reference"""
+
+    def add_order(self, order: BaseOrder):
+        with self._lock:
+            if order.fulfill_time is None:
+                raise Exception("Order has no fulfill_time set")
+
+            if len([o for o in self.orders if o.uid == order.uid]) > 0:
+                raise Exception("Attempt to fulfill existing order")
+
+            if order.order_type == Type.SELL and self._quantity(order.symbol) < order.quantity:
+                raise Exception("Attempt to sell more shares than available")
+
+            if order.order_type == Type.BUY and self._capital < order.cost:
+                raise Exception("Not enough capital to fulfill order")
+
+            self.orders.append(order)
+
+    @property
+    def symbols(self):
+        return set([o.symbol for o in self.orders])
+
+    @property
+    def _capital(self):
+        turnover = 0
+        commissions = 0
+        for o in self.orders:
+            cost = o.cost
+            if o.order_type == Type.SELL:
+                turnover += cost
+            elif o.order_type == Type.BUY:
+                turnover -= cost
+
+            commissions += o.commission
+
+        return self.initial_capital + turnover - commissions
+
+    def _quantity(self, symbol=None):
+        if symbol is not None:
+            quantity = 0
+
+            for o in [o for o in self.orders if o.symbol == symbol]:
+                if o.order_type == Type.BUY:
+                    quantity += o.quantity
+                elif o.order_type == Type.SELL:
+                    quantity -= o.quantity
+
+            return quantity
+        else:
+            result = dict()
+            for s in set([o.symbol for o in self.orders]):
+                qty = self._quantity(s)
+                if qty > 0:
+                    result[s] = qty
+
+            return result
+
+    def process_tick_data(self, data):
+        with self._lock:
+            symbol = data['symbol']
+            if symbol in [o.symbol for o in self.orders]:
+                self._values[symbol] = data['bid'][-1] if isinstance(data['bid'], Collection) else data['bid']
+                self.listeners({'type': 'portfolio_value_update', 'data': self})
+
+    def _value(self, symbol=None, multiply_by_quantity=False):
+        if symbol is not None:
+            if symbol not in self._values:
+                symbol_orders = [o for o in self.orders if o.symbol == symbol]
+                order = sorted(symbol_orders, key=lambda o: o.fulfill_time, reverse=True)[0]
+                return order.last_cost_per_share * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
+            else:
+                return self._values[symbol] * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
+        else:
+            result = dict()
+            for s in set([o.symbol for o in self.orders]):
+                result[s] = self._value(symbol=s, multiply_by_quantity=multiply_by_quantity)
+
+            return result
 
 
 class TestPortfolioManager(unittest.TestCase):
@@ -375,6 +460,142 @@ class TestPortfolioManager(unittest.TestCase):
         self.assertGreater(pm.value('AAPL'), 0)
         self.assertGreater(pm.value('IBM'), 0)
 
+    def test_ledger(self):
+        rnd = random.Random(7)
+
+        pms = [pm_type(listeners=SyncListeners(), initial_capital=100000, fulfilled_orders_event_stream=SyncListeners()) for pm_type in [LegacyPortfolioManager, PortfolioManager]]
+
+        def assert_equal_state(legacy, pm):
+            self.assertEqual(legacy.capital, pm.capital)
+            self.assertEqual(legacy.quantity(), pm.quantity())
+            self.assertEqual(legacy.symbols, pm.symbols)
+            self.assertEqual(legacy.value(), pm.value())
+            self.assertEqual(legacy.value(multiply_by_quantity=True), pm.value(multiply_by_quantity=True))
+
+            for s in legacy.symbols:
+                self.assertEqual(legacy.quantity(s), pm.quantity(s))
+                self.assertEqual(legacy.value(s), pm.value(s))
+
+        fulfill_time = datetime.datetime(2018, 1, 1)
+        added = 0
+        for i in range(1500):
+            symbol = 'S' + str(rnd.randrange(20))
+
+            if rnd.random() < 0.1:
+                bid = rnd.random() * 100
+                for pm in pms:
+                    pm.process_tick_data({'symbol': symbol, 'bid': bid})
+
+                continue
+
+            o = MarketOrder(rnd.choice([Type.BUY, Type.SELL]), symbol, rnd.randint(1, 100))
+            for _ in range(rnd.randint(1, 3)):
+                if o.obtained_quantity < o.quantity:
+                    o.add_position(rnd.randint(1, o.quantity), rnd.random() * 100)
+
+            if o.obtained_quantity < o.quantity:
+                o.add_position(o.quantity - o.obtained_quantity, rnd.random() * 100)
+
+            o.commission = rnd.random()
+
+            # some orders have the same fulfill time
+            if rnd.random() < 0.7:
+                fulfill_time += datetime.timedelta(seconds=1)
+
+            o.fulfill_time = fulfill_time
+
+            errors = list()
+            for pm in pms:
+                try:
+                    pm.add_order(o)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(str(e))
+
+            self.assertEqual(errors[0], errors[1])
+            added += 1 if errors[0] is None else 0
+
+            # duplicate order
+            if errors[0] is None and rnd.random() < 0.05:
+                for pm in pms:
+                    self.assertRaises(Exception, pm.add_order, o)
+
+            assert_equal_state(*pms)
+
+        self.assertGreater(added, 500)
+
+        # pickling
+        legacy, pm = pms
+        restored = pickle.loads(pickle.dumps(pm))
+        assert_equal_state(legacy, restored)
+
+        # state without ledger
+        state = pm.__getstate__()
+        for k in ['_uids', '_turnover', '_commissions', '_quantities', '_last_fills']:
+            del state[k]
+
+        restored = PortfolioManager.__new__(PortfolioManager)
+        restored.__setstate__(state)
+        assert_equal_state(legacy, restored)
+
+    def test_coalesced_value_updates(self):
+        orders = list()
+        for i in range(0, 40, 2):
+            o = MarketOrder(Type.BUY, 'S' + str(i), i + 1)
+            o.add_position(i + 1, 1)
+            orders.append(o)
+
+        events = list()
+        pms = list()
+        for coalesce in [False, True]:
+            listeners = SyncListeners()
+            listeners += lambda e, c=coalesce: events.append((c, e)) if e['type'] == 'portfolio_value_update' else None
+            pms.append(PortfolioManager(listeners=listeners, initial_capital=10000, fulfilled_orders_event_stream=SyncListeners(), orders=list(orders), coalesce_value_updates=coalesce))
+
+        steps = 0
+        for d in DataReplay().add_source(random_bar_chunks(seed=2, steps=200, width=30, chunk_len=50), 'data', historical_depth=3):
+            steps += 1
+            for pm in pms:
+                pm.process_bar_data(d['data'])
+
+            self.assertEqual(pms[0]._values, pms[1]._values)
+            self.assertEqual(pms[0].value(multiply_by_quantity=True), pms[1].value(multiply_by_quantity=True))
+
+        coalesced = [e for c, e in events if c]
+        self.assertEqual(len(coalesced), steps)
+        self.assertGreater(len(events) - len(coalesced), 5 * steps)
+        self.assertEqual(coalesced[-1]['mark_to_market'], pms[1].value(multiply_by_quantity=True))
+        self.assertEqual(len(coalesced[-1]['mark_to_market']), len(orders))
+
+    def test_tick_batches(self):
+        orders = list()
+        for i in range(0, 10, 2):
+            o = MarketOrder(Type.BUY, 'S' + str(i), i + 1)
+            o.add_position(i + 1, 1)
+            orders.append(o)
+
+        ticks = random_level_1_ticks(seed=3, count=2000, symbols=12)
+
+        events = list()
+        pms = list()
+        for batch in [False, True]:
+            listeners = SyncListeners()
+            listeners += lambda e, b=batch: events.append(b) if e['type'] == 'portfolio_value_update' else None
+            pms.append(PortfolioManager(listeners=listeners, initial_capital=10000, fulfilled_orders_event_stream=SyncListeners(), orders=list(orders)))
+
+        for t in ticks.to_dict('records'):
+            pms[0].process_tick_data(t)
+
+        for b in np.array_split(ticks, 20):
+            pms[1].process_tick_batch(b)
+
+        self.assertEqual(pms[0]._values, pms[1]._values)
+        self.assertEqual(pms[0].value(multiply_by_quantity=True), pms[1].value(multiply_by_quantity=True))
+
+        # a single event per batch
+        self.assertEqual(events.count(True), 20)
+        self.assertGreater(events.count(False), 20)
+
 
 if __name__ == '__main__':
     unittest.main()